@@ -7,6 +7,7 @@ from kahi_ciarp_works.process_one import process_one
 from kahi_impactu_utils.Utils import doi_processor
 from kahi_impactu_utils.Mapping import ciarp_mapping
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
 
 
 class Kahi_ciarp_works(KahiBase):
@@ -51,7 +52,11 @@ class Kahi_ciarp_works(KahiBase):
         self.collection.create_index("authors.id")
         self.collection.create_index([("titles.title", TEXT)])
 
-        if all(key in config["ciarp_works"] for key in ["es_index", "es_url", "es_user", "es_password"]):
+        if "local_index" in config["ciarp_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["ciarp_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif all(key in config["ciarp_works"] for key in ["es_index", "es_url", "es_user", "es_password"]):
             es_index = config["ciarp_works"]["es_index"]
             es_url = config["ciarp_works"]["es_url"]
             if config["ciarp_works"]["es_user"] and config["ciarp_works"]["es_password"]:
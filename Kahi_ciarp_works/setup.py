@@ -87,7 +87,8 @@ def main():
             'kahi_impactu_utils',
             'mohan',
             'langcodes',
-            'iso639~=0.1.4'
+            'iso639~=0.1.4',
+            'Kahi_similarity_utils'
         ],
     )
 
@@ -1,8 +1,9 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
 from kahi_dspace_works.utils import get_doi, process_affiliation, is_similarity_reg, thesis_types
-from kahi_dspace_works.process_one import process_one
+from kahi_dspace_works.process_one import process_one, process_block
 from joblib import Parallel, delayed
 
 
@@ -23,7 +24,11 @@ class Kahi_dspace_works(KahiBase):
 
         self.verbose = config["verbose"] if "verbose" in config else 0
 
-        if (
+        if "local_index" in config["dspace_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["dspace_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif (
             "es_index" in config["dspace_works"].keys() and "es_url" in config["dspace_works"].keys(
             ) and "es_user" in config["dspace_works"].keys() and "es_password" in config["dspace_works"].keys()
         ):  # noqa: E501
@@ -60,6 +65,11 @@ class Kahi_dspace_works(KahiBase):
             if "verbose" in config["dspace_works"].keys()
             else 0
         )
+        self.es_batch_size = (
+            config["dspace_works"]["es_batch_size"]
+            if "es_batch_size" in config["dspace_works"].keys()
+            else 1
+        )
 
         thresholds = config["dspace_works"]["thresholds"] if "thresholds" in config["dspace_works"].keys(
         ) else None
@@ -120,6 +130,23 @@ class Kahi_dspace_works(KahiBase):
                     "OAI-PMH.GetRecord.record.metadata.dim:dim.dim:field.@element": "title"
                 }
             )
+            works = [work for work in list(work_cursor) if is_similarity_reg(work)]
+            if self.es_batch_size > 1:
+                # the similarity searches of every block are sent in a single _msearch request
+                Parallel(n_jobs=self.n_jobs, verbose=10, backend="threading")(
+                    delayed(process_block)(
+                        dspace_regs=works[i:i + self.es_batch_size],
+                        affiliation=affiliation,
+                        base_url=base_url,
+                        db=self.db,
+                        collection=self.collection,
+                        empty_work=self.empty_work(),
+                        es_handler=self.es_handler,
+                        thresholds=self.thresholds,
+                        verbose=self.verbose,
+                    )
+                    for i in range(0, len(works), self.es_batch_size))
+                return
             Parallel(n_jobs=self.n_jobs, verbose=10, backend="threading")(
                 delayed(process_one)(
                     dspace_reg=work,
@@ -133,7 +160,7 @@ class Kahi_dspace_works(KahiBase):
                     thresholds=self.thresholds,
                     verbose=self.verbose,
                 )
-                for work in list(work_cursor) if is_similarity_reg(work))
+                for work in works)
 
     def run(self):
         print(
@@ -1,7 +1,9 @@
 from kahi_impactu_utils.Utils import compare_author
 from kahi_dspace_works.parser import parse_dspace
-from kahi_dspace_works.utils import set_source, get_doi, check_work, str_normilize, title_similarity
-from bson import ObjectId
+from kahi_dspace_works.utils import set_source, get_doi, title_similarity
+from kahi_similarity_utils.scoring import best_match, str_normilize
+from kahi_similarity_utils.es_batch import BatchSearch, find_work
+from copy import deepcopy
 from unidecode import unidecode
 
 
@@ -194,16 +196,15 @@ def process_one_insert(entry, affiliation, db, collection, es_handler, verbose):
             print("No elasticsearch index provided")
 
 
-def process_one(dspace_reg, affiliation, base_url, db, collection, empty_work, es_handler, similarity, thresholds, verbose=0):
+def parse_entry(dspace_reg, base_url, db, collection, empty_work, verbose=0):
     """
-    Dspace record is parsed and processed to be inserted/updated in the works collection.
+    Parses a dspace record and sets its source, the records already in the works collection
+    or without title are skipped.
 
     Parameters:
     -----------
     dspace_reg : dict
         dspace record.
-    affiliation : dict | None
-        affiliation record, or None if affiliation is not found.
     base_url : str
         base url of the dspace instance.
     db : pymongo.database.Database
@@ -212,96 +213,150 @@ def process_one(dspace_reg, affiliation, base_url, db, collection, empty_work, e
         collection object to kahi(ETL) database.
     empty_work : dict
         empty work record.
-    es_handler : elasticsearch.Elasticsearch
-        elasticsearch handler.
-    similarity : bool
-        if True, it will search for similar works in the works collection.
     verbose : int
         verbosity level.
+
+    Returns:
+    --------
+    dict | None
+        the parsed entry, or None if the record must be skipped.
     """
     if collection.find_one({"external_ids.id": dspace_reg["_id"]}):
         if verbose > 4:
             print("Record with id {} already exists in the works collection".format(
                 dspace_reg["_id"]))
-        return
+        return None
     # processing bad dois as well
     entry = parse_dspace(dspace_reg, empty_work,
                          base_url, verbose)
     if len(entry["titles"]) == 0:
         if verbose > 4:
             print("No title found in dspace record {}".format(dspace_reg["_id"]))
-        return
+        return None
     set_source(entry, db)  # setting source to entry
+    return entry
+
+
+def similarity_query(entry):
+    """
+    Builds the elasticsearch similarity search (Similarity.search_work) of a parsed entry.
+
+    Parameters:
+    -----------
+    entry : dict
+        parsed dspace record.
+
+    Returns:
+    --------
+    tuple
+        (work, query) where work has the title and authors used to check the hits
+        and query are the arguments of search_work.
+    """
+    work = {}
+    work["title"] = entry["titles"][0]["title"]
+    work["source"] = (
+        entry["source"]["name"] if "name" in entry["source"].keys() else ""
+    )
+    work["year"] = entry["year_published"] if entry["year_published"] else "0"
+    work["volume"] = (
+        entry["bibliographic_info"]["volume"]
+        if "volume" in entry["bibliographic_info"].keys()
+        else ""
+    )
+    work["issue"] = (
+        entry["bibliographic_info"]["issue"]
+        if "issue" in entry["bibliographic_info"].keys()
+        else ""
+    )
+    work["first_page"] = (
+        entry["bibliographic_info"]["first_page"]
+        if "first_page" in entry["bibliographic_info"].keys()
+        else ""
+    )
+    work["last_page"] = (
+        entry["bibliographic_info"]["last_page"]
+        if "last_page" in entry["bibliographic_info"].keys()
+        else ""
+    )
+    authors = []
+    for author in entry["authors"]:
+        if len(authors) >= 5:
+            break
+        if "full_name" in author.keys():
+            authors.append(str_normilize(author["full_name"]))
+    work["authors"] = authors
+    work["provenance"] = "dspace"
+    query = {
+        "title": str_normilize(work["title"]),
+        "source": work["source"],
+        "year": str(work["year"]),
+        "authors": authors,
+        "volume": work["volume"],
+        "issue": work["issue"],
+        "page_start": work["first_page"],
+        "page_end": work["last_page"],
+        "use_es_thold": True,
+        "es_thold": 0,
+        "hits": 20
+    }
+    return work, query
+
+
+def process_one(dspace_reg, affiliation, base_url, db, collection, empty_work, es_handler, similarity, thresholds, verbose=0, entry=None):
+    """
+    Dspace record is parsed and processed to be inserted/updated in the works collection.
+
+    Parameters:
+    -----------
+    dspace_reg : dict
+        dspace record.
+    affiliation : dict | None
+        affiliation record, or None if affiliation is not found.
+    base_url : str
+        base url of the dspace instance.
+    db : pymongo.database.Database
+        database object to kahi(ETL) database.
+    collection : pymongo.collection.Collection
+        collection object to kahi(ETL) database.
+    empty_work : dict
+        empty work record.
+    es_handler : elasticsearch.Elasticsearch
+        elasticsearch handler.
+    similarity : bool
+        if True, it will search for similar works in the works collection.
+    verbose : int
+        verbosity level.
+    entry : dict, optional
+        the record already parsed with parse_entry, if None it is parsed here.
+    """
+    if entry is None:
+        entry = parse_entry(dspace_reg, base_url, db, collection, empty_work, verbose)
+        if entry is None:
+            return
     # setting affiliation to authors
     # set_affiliation(entry, affiliation, db['person'])
     if similarity:
-        work = {}
-        work["title"] = entry["titles"][0]["title"]
-        work["source"] = (
-            entry["source"]["name"] if "name" in entry["source"].keys() else ""
-        )
-        work["year"] = entry["year_published"] if entry["year_published"] else "0"
-        work["volume"] = (
-            entry["bibliographic_info"]["volume"]
-            if "volume" in entry["bibliographic_info"].keys()
-            else ""
-        )
-        work["issue"] = (
-            entry["bibliographic_info"]["issue"]
-            if "issue" in entry["bibliographic_info"].keys()
-            else ""
-        )
-        work["first_page"] = (
-            entry["bibliographic_info"]["first_page"]
-            if "first_page" in entry["bibliographic_info"].keys()
-            else ""
-        )
-        work["last_page"] = (
-            entry["bibliographic_info"]["last_page"]
-            if "last_page" in entry["bibliographic_info"].keys()
-            else ""
-        )
-        authors = []
-        for author in entry["authors"]:
-            if len(authors) >= 5:
-                break
-            if "full_name" in author.keys():
-                authors.append(str_normilize(author["full_name"]))
-        work["authors"] = authors
-        work["provenance"] = "dspace"
-        responses = es_handler.search_work(
-            title=str_normilize(work["title"]),
-            source=work["source"],
-            year=str(work["year"]),
-            authors=authors,
-            volume=work["volume"],
-            issue=work["issue"],
-            page_start=work["first_page"],
-            page_end=work["last_page"],
-            use_es_thold=True,
-            es_thold=0,
-            hits=20
-        )
+        work, query = similarity_query(entry)
+        authors = work["authors"]
+        responses = es_handler.search_work(**query)
         if responses:
-            found = False
-            for response in responses:
-                found = check_work(
-                    work["title"], authors, response, thresholds)
-                if found:
-                    colav_reg = collection.find_one(
-                        {"_id": ObjectId(response["_id"])})
-                    if colav_reg:
-                        process_one_update(
-                            entry, colav_reg, db, collection, verbose)
-                        return
-                    else:
-                        if verbose > 4:
-                            print("Register with {} not found in mongodb".format(
-                                response["_id"]))
-                        return
-            if not found:
-                process_one_insert(entry, affiliation, db,
-                                   collection, es_handler, verbose)
+            # all the hits are scored in a single call, the first similar one is updated
+            response, title_score, author_score = best_match(work["title"], authors, responses, thresholds)
+            if response:
+                if verbose > 4:
+                    print(f"INFO: similar work {response['_id']} title score {title_score} author score {author_score}")
+                colav_reg = find_work(collection, es_handler, response["_id"])
+                if colav_reg:
+                    process_one_update(
+                        entry, colav_reg, db, collection, verbose)
+                    return
+                else:
+                    if verbose > 4:
+                        print("Register with {} not found in mongodb".format(
+                            response["_id"]))
+                    return
+            process_one_insert(entry, affiliation, db,
+                               collection, es_handler, verbose)
         else:  # insert new register
             process_one_insert(entry, affiliation, db,
                                collection, es_handler, verbose)
@@ -323,3 +378,39 @@ def process_one(dspace_reg, affiliation, base_url, db, collection, empty_work, e
         else:
             print(
                 f"WARNING: invalid doi found in dspace record {dspace_reg['_id']} ")
+
+
+def process_block(dspace_regs, affiliation, base_url, db, collection, empty_work, es_handler, thresholds, verbose=0):
+    """
+    Processes a block of dspace records with similarity, the similarity queries of the block are sent
+    in a single _msearch request and the works of the hits are read with a single query (see kahi_similarity_utils.es_batch.BatchSearch).
+
+    Parameters:
+    -----------
+    dspace_regs : list
+        dspace records.
+    affiliation : dict | None
+        affiliation record, or None if affiliation is not found.
+    base_url : str
+        base url of the dspace instance.
+    db : pymongo.database.Database
+        database object to kahi(ETL) database.
+    collection : pymongo.collection.Collection
+        collection object to kahi(ETL) database.
+    empty_work : dict
+        empty work record, copied for every record.
+    es_handler : elasticsearch.Elasticsearch
+        elasticsearch handler.
+    verbose : int
+        verbosity level.
+    """
+    entries = []
+    for dspace_reg in dspace_regs:
+        entry = parse_entry(dspace_reg, base_url, db, collection, deepcopy(empty_work), verbose)
+        if entry is not None:
+            entries.append((dspace_reg, entry))
+    handler = BatchSearch(es_handler, collection)
+    handler.prefetch([similarity_query(entry)[1] for _, entry in entries])
+    for dspace_reg, entry in entries:
+        process_one(dspace_reg, affiliation, base_url, db, collection, empty_work, handler,
+                    True, thresholds, verbose, entry=entry)
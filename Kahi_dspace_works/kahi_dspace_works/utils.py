@@ -1,6 +1,5 @@
 from kahi_impactu_utils.Utils import doi_processor
-from thefuzz import process, fuzz
-from unidecode import unidecode
+from kahi_similarity_utils.scoring import score_matrix, str_normilize
 
 
 def get_doi(reg):
@@ -86,68 +85,6 @@ def process_affiliation(ror_id, db):
     return aff
 
 
-def str_normilize(word):
-    """
-    Normalize a string to lowercase and remove accents.
-
-    Parameters
-    ----------
-    word : str
-        string to be normalized.
-
-    Returns
-    -------
-    str
-        normalized string.
-    """
-    return unidecode(word).lower().strip().replace(".", "")
-
-
-def check_work(title_work, authors, response, thresholds):
-    """
-    Check if the title and authors of the dspace work are similar to the title and authors of the elasticsearch work.
-
-    Parameters
-    ----------
-    title_work : str
-        title of the dspace work.
-    authors : list
-        authors of the dspace work.
-    response : dict
-        elasticsearch work.
-    thresholds : dict
-        thresholds to consider a work as similar.
-
-    Returns
-    -------
-    bool
-        True if the works are similar, False otherwise.
-    """
-    author_found = False
-    if authors:
-        if authors[0] != "":
-            _authors = []
-            for author in response["_source"]["authors"]:
-                _authors.append(str_normilize(author))
-            scores = process.extract(str_normilize(
-                authors[0]), _authors, scorer=fuzz.partial_ratio)
-            for score in scores:
-                if score[1] >= thresholds["author_thd"]:
-                    author_found = True
-                    break
-    es_title = response["_source"]["title"]
-    if es_title:
-        score = fuzz.ratio(str_normilize(title_work),
-                           str_normilize(es_title))
-        if author_found:
-            if score >= thresholds["paper_thd_low"]:
-                return True
-        else:
-            if score >= thresholds["paper_thd_high"]:
-                return True
-    return False
-
-
 thesis_types = ['http://purl.org/coar/resource_type/c_46ec',
                 'http://purl.org/coar/resource_type/c_bdcc',
                 'http://purl.org/coar/resource_type/c_db06',
@@ -335,11 +272,7 @@ def title_similarity(titles, titles_kahi, threshold=60):
     bool
         True if the titles are similar, False otherwise.
     """
-    for dtitle in titles:
-        for ktitle in titles_kahi:
-            score = fuzz.ratio(
-                str_normilize(dtitle["title"]), str_normilize(ktitle["title"])
-            )
-            if score >= threshold:
-                return True
-    return False
+    # all the pairs of titles are scored in a single call
+    scores = score_matrix([str_normilize(dtitle["title"]) for dtitle in titles],
+                          [str_normilize(ktitle["title"]) for ktitle in titles_kahi])
+    return bool((scores >= threshold).any())
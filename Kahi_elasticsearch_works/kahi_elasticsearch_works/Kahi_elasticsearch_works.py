@@ -1,8 +1,18 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
 from math import isnan
+from json import dumps
+from queue import Queue, Full
+from threading import Thread, Event, Lock
+from time import time
+from bson import ObjectId
 
+from elasticsearch.helpers import streaming_bulk, scan
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
+
+works_projection = {"titles": 1, "source": 1, "year_published": 1,
+                    "bibliographic_info": 1, "authors.full_name": 1}
 
 
 class Kahi_elasticsearch_works(KahiBase):
@@ -30,75 +40,127 @@ class Kahi_elasticsearch_works(KahiBase):
         self.es_url = config["elasticsearch_works"]["es_url"] if "es_url" in config["elasticsearch_works"].keys(
         ) else "http://localhost:9200"
 
-        self.es_client = Similarity(
-            es_index=self.index,
-            es_uri=self.es_url,
-            es_auth=(
-                config["elasticsearch_works"]["es_user"],
-                config["elasticsearch_works"]["es_password"]
-            ),
-        )
-
         self.task = config["elasticsearch_works"]["task"] if "task" in config["elasticsearch_works"].keys(
         ) else None
 
+        # path of the embedded similarity index (sqlite), used instead of elasticsearch
+        self.local_index = config["elasticsearch_works"]["local_index"] if "local_index" in config["elasticsearch_works"].keys(
+        ) else None
+        self.sample_size = config["elasticsearch_works"]["sample_size"] if "sample_size" in config["elasticsearch_works"].keys(
+        ) else 1000
+
+        if self.local_index and self.task != "compare":
+            self.es_client = LocalSimilarity(self.local_index, es_index=self.index)
+        else:
+            self.es_client = Similarity(
+                es_index=self.index,
+                es_uri=self.es_url,
+                es_auth=(
+                    config["elasticsearch_works"]["es_user"],
+                    config["elasticsearch_works"]["es_password"]
+                ),
+            )
+
         self.verbose = config["elasticsearch_works"]["verbose"] if "verbose" in config["elasticsearch_works"].keys(
         ) else 0
         self.bulk_size = config["elasticsearch_works"]["bulk_size"] if "bulk_size" in config["elasticsearch_works"].keys(
         ) else 100
 
+        self.pipeline = config["elasticsearch_works"]["pipeline"] if "pipeline" in config["elasticsearch_works"].keys(
+        ) else False
+        self.num_readers = config["elasticsearch_works"]["num_readers"] if "num_readers" in config["elasticsearch_works"].keys(
+        ) else 2
+        self.num_senders = config["elasticsearch_works"]["num_senders"] if "num_senders" in config["elasticsearch_works"].keys(
+        ) else 4
+        self.queue_size = config["elasticsearch_works"]["queue_size"] if "queue_size" in config["elasticsearch_works"].keys(
+        ) else 2 * self.num_senders
+        self.bulk_bytes = config["elasticsearch_works"]["bulk_bytes"] if "bulk_bytes" in config["elasticsearch_works"].keys(
+        ) else 10 * 1024 * 1024
+        self.max_retries = config["elasticsearch_works"]["max_retries"] if "max_retries" in config["elasticsearch_works"].keys(
+        ) else 8
+        self.page_size = config["elasticsearch_works"]["page_size"] if "page_size" in config["elasticsearch_works"].keys(
+        ) else 1000
+
+        # full reconciliation of the index with the works collection, reads every _id of the index
+        self.remove_deleted = config["elasticsearch_works"]["remove_deleted"] if "remove_deleted" in config["elasticsearch_works"].keys(
+        ) else False
+        # log of the removed works ({"_id": work id, "time": removal time}) written by the steps that delete or merge works
+        self.removed_log = config["elasticsearch_works"]["removed_log"] if "removed_log" in config["elasticsearch_works"].keys(
+        ) else "works_removed"
+        # the watermark of the incremental task is stored in the checkpoints collection of the log database
+        self.checkpoints = (self.client[config["log_database"]] if "log_database" in config.keys(
+        ) else self.db)["checkpoints"]
+        self.watermark_key = f"elasticsearch_works/{self.index}"
+
         self.inserted_ids = []
 
+    def build_entry(self, reg):
+        """
+        Builds the elasticsearch bulk entry for a work of the kahi database.
+
+        Parameters
+        ----------
+        reg : dict
+            Work with titles, source, year_published, bibliographic_info and authors.full_name.
+
+        Returns
+        -------
+        dict | None
+            The bulk entry {"_index", "_id", "_source"} or None if the work has no title.
+        """
+        work = {
+            "title": "",
+            "source": "",
+            "year": "",
+            "volume": "",
+            "issue": "",
+            "start_page": "",
+            "end_page": "",
+            "authors": [],
+            "provenance": "elasticsearch",
+
+        }
+        if "titles" not in reg.keys():
+            return None
+        if not reg["titles"]:
+            return None
+        work["title"] = reg["titles"][0]["title"]
+        if "name" in reg["source"].keys():
+            work["source"] = reg["source"]["name"] if reg["source"]["name"] else ""
+        if "year_published" in reg.keys():
+            work["year"] = reg["year_published"] if reg["year_published"] else ""
+        if "volume" in reg["bibliographic_info"].keys():
+            work["volume"] = reg["bibliographic_info"]["volume"] if reg["bibliographic_info"]["volume"] else ""
+        if "issue" in reg["bibliographic_info"].keys():
+            work["issue"] = reg["bibliographic_info"]["issue"] if reg["bibliographic_info"]["issue"] else ""
+        if "start_page" in reg["bibliographic_info"].keys():
+            work["start_page"] = reg["bibliographic_info"]["start_page"] if reg["bibliographic_info"]["start_page"] else ""
+        if "end_page" in reg["bibliographic_info"].keys():
+            work["end_page"] = reg["bibliographic_info"]["end_page"] if reg["bibliographic_info"]["end_page"] else ""
+        authors = []
+        for author in reg["authors"]:
+            authors.append(author["full_name"])
+            if len(authors) == 5:
+                break
+        work["authors"] = authors
+        # double checking for nan
+        for key, val in work.items():
+            if isinstance(val, float) and isnan(val):
+                work[key] = ""
+        return {
+            "_index": self.index,
+            "_id": str(reg["_id"]),
+            "_source": work
+        }
+
     def bulk_insert(self):
         es_entries = []
-        paper_list = self.collection.find(
-            {}, {"titles": 1, "source": 1, "year_published": 1, "bibliographic_info": 1, "authors.full_name": 1})
+        paper_list = self.collection.find({}, works_projection)
         paper_list_count = self.collection.count_documents({})
         for i, reg in enumerate(paper_list):
-            work = {
-                "title": "",
-                "source": "",
-                "year": "",
-                "volume": "",
-                "issue": "",
-                "start_page": "",
-                "end_page": "",
-                "authors": [],
-                "provenance": "elasticsearch",
-
-            }
-            if "titles" not in reg.keys():
-                continue
-            if not reg["titles"]:
+            entry = self.build_entry(reg)
+            if entry is None:
                 continue
-            work["title"] = reg["titles"][0]["title"]
-            if "name" in reg["source"].keys():
-                work["source"] = reg["source"]["name"] if reg["source"]["name"] else ""
-            if "year_published" in reg.keys():
-                work["year"] = reg["year_published"] if reg["year_published"] else ""
-            if "volume" in reg["bibliographic_info"].keys():
-                work["volume"] = reg["bibliographic_info"]["volume"] if reg["bibliographic_info"]["volume"] else ""
-            if "issue" in reg["bibliographic_info"].keys():
-                work["issue"] = reg["bibliographic_info"]["issue"] if reg["bibliographic_info"]["issue"] else ""
-            if "start_page" in reg["bibliographic_info"].keys():
-                work["start_page"] = reg["bibliographic_info"]["start_page"] if reg["bibliographic_info"]["start_page"] else ""
-            if "end_page" in reg["bibliographic_info"].keys():
-                work["end_page"] = reg["bibliographic_info"]["end_page"] if reg["bibliographic_info"]["end_page"] else ""
-            authors = []
-            for author in reg["authors"]:
-                authors.append(author["full_name"])
-                if len(authors) == 5:
-                    break
-            work["authors"] = authors
-            # double checking for nan
-            for key, val in work.items():
-                if isinstance(val, float) and isnan(val):
-                    work[key] = ""
-            entry = {
-                "_index": self.index,
-                "_id": str(reg["_id"]),
-                "_source": work
-            }
             es_entries.append(entry)
             if len(es_entries) == self.bulk_size or paper_list_count <= self.bulk_size or i + 1 == paper_list_count:
                 try:
@@ -111,18 +173,369 @@ class Kahi_elasticsearch_works(KahiBase):
                 if self.verbose > 4:
                     print(f"""{i + 1} entries inserted""")
 
+    # Pipelined bulk insert
+
+    def id_ranges(self, n_ranges):
+        """
+        Splits the works collection in n_ranges ranges of _id with (almost) the same number of documents.
+
+        Returns
+        -------
+        list
+            List of (start_id, end_id) tuples, start_id is inclusive and end_id exclusive,
+            None means unbounded.
+        """
+        count = self.collection.count_documents({})
+        bounds = []
+        for i in range(1, n_ranges):
+            reg = self.collection.find_one(
+                {}, {"_id": 1}, sort=[("_id", 1)], skip=i * count // n_ranges)
+            if reg and (not bounds or bounds[-1] != reg["_id"]):
+                bounds.append(reg["_id"])
+        starts = [None] + bounds
+        ends = bounds + [None]
+        return list(zip(starts, ends))
+
+    def normalize_entry(self, entry):
+        """
+        Normalizes the title, source and authors of an entry as mohan's insert_bulk does.
+        """
+        work = entry["_source"]
+        work["title"] = self.es_client.str_normilize(work["title"])
+        work["source"] = self.es_client.str_normilize(work["source"])
+        work["authors"] = [self.es_client.str_normilize(
+            author) for author in work["authors"]]
+        return entry
+
+    def read_range(self, start_id, end_id, batches, stop, errors):
+        """
+        Producer: reads the works of an _id range in pages, shapes them and puts batches of entries in the queue.
+        A batch is closed when it has bulk_size entries or bulk_bytes bytes.
+        If the reading fails the pipeline is stopped.
+
+        Parameters
+        ----------
+        start_id : ObjectId | None
+            First _id of the range (inclusive).
+        end_id : ObjectId | None
+            Last _id of the range (exclusive).
+        batches : queue.Queue
+            Bounded queue shared with the senders.
+        stop : threading.Event
+            Set when a reader or a sender fails, the reader stops reading.
+        errors : list
+            Exceptions raised by the threads of the pipeline.
+        """
+        try:
+            self.read_pages(start_id, end_id, batches, stop)
+        except Exception as e:
+            print(f"[Kahi_elasticsearch_works] ERROR: {e}")
+            errors.append(e)
+            stop.set()
+
+    def read_pages(self, start_id, end_id, batches, stop):
+        """
+        Reading loop of read_range.
+        """
+        batch = []
+        batch_bytes = 0
+        last_id = None
+        while not stop.is_set():
+            bounds = {}
+            if last_id is not None:
+                bounds["$gt"] = last_id
+            elif start_id is not None:
+                bounds["$gte"] = start_id
+            if end_id is not None:
+                bounds["$lt"] = end_id
+            page = list(self.collection.find(
+                {"_id": bounds} if bounds else {}, dict(works_projection)).sort("_id", 1).limit(self.page_size))
+            if not page:
+                break
+            last_id = page[-1]["_id"]
+            for reg in page:
+                entry = self.build_entry(reg)
+                if entry is None:
+                    continue
+                entry = self.normalize_entry(entry)
+                batch.append(entry)
+                batch_bytes += len(dumps(entry["_source"], default=str))
+                if len(batch) >= self.bulk_size or batch_bytes >= self.bulk_bytes:
+                    self.put_batch(batches, batch, stop)
+                    batch = []
+                    batch_bytes = 0
+        if batch:
+            self.put_batch(batches, batch, stop)
+
+    def put_batch(self, batches, batch, stop):
+        """
+        Puts a batch in the bounded queue, waiting while it is full unless the pipeline is stopped.
+        """
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=1)
+                return
+            except Full:
+                continue
+
+    def send_batches(self, batches, stop, errors, counter):
+        """
+        Consumer: sends the batches of the queue to elasticsearch until it gets None.
+        Requests rejected with 429 (too many requests) are retried with exponential backoff by streaming_bulk.
+        If a batch fails the pipeline is stopped, the remaining batches are discarded.
+        """
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if stop.is_set():
+                continue
+            try:
+                for ok, item in streaming_bulk(
+                        self.es_client.es,
+                        batch,
+                        chunk_size=len(batch),
+                        max_chunk_bytes=self.bulk_bytes,
+                        max_retries=self.max_retries,
+                        initial_backoff=2,
+                        request_timeout=self.es_client.es_req_timeout):
+                    pass
+            except Exception as e:
+                print(f"[Kahi_elasticsearch_works] ERROR: {e}")
+                errors.append(e)
+                stop.set()
+                continue
+            with counter["lock"]:
+                counter["count"] += len(batch)
+                if self.verbose > 4:
+                    print(f"""{counter["count"]} entries inserted""")
+
+    def pipelined_bulk_insert(self):
+        """
+        Inserts the works with num_readers threads reading disjoint _id ranges of the works collection and
+        num_senders threads sending the bulk requests, connected by a queue of at most queue_size batches.
+        The index is refreshed once at the end instead of after every bulk request.
+        """
+        batches = Queue(maxsize=self.queue_size)
+        stop = Event()
+        errors = []
+        counter = {"count": 0, "lock": Lock()}
+        readers = [Thread(target=self.read_range, args=(start_id, end_id, batches, stop, errors))
+                   for start_id, end_id in self.id_ranges(self.num_readers)]
+        senders = [Thread(target=self.send_batches, args=(batches, stop, errors, counter))
+                   for _ in range(self.num_senders)]
+        for thread in readers + senders:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        for _ in senders:
+            batches.put(None)
+        for thread in senders:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.es_client.refresh_index()
+        if self.verbose > 0:
+            print(f"""{counter["count"]} entries inserted in index {self.index}""")
+
+    # Incremental reindex
+
+    def index_works(self, query):
+        """
+        Indexes the works matching query, reading them in pages sorted by _id and sending batches of bulk_size entries.
+
+        Returns
+        -------
+        int
+            Number of entries sent to elasticsearch.
+        """
+        count = 0
+        last_id = None
+        es_entries = []
+        while True:
+            page_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+            page = list(self.collection.find(page_query, dict(works_projection)).sort("_id", 1).limit(self.page_size))
+            if not page:
+                break
+            last_id = page[-1]["_id"]
+            for reg in page:
+                entry = self.build_entry(reg)
+                if entry is not None:
+                    es_entries.append(entry)
+                if len(es_entries) == self.bulk_size:
+                    self.es_client.insert_bulk(es_entries)
+                    count += len(es_entries)
+                    es_entries = []
+                    if self.verbose > 4:
+                        print(f"""{count} entries inserted""")
+        if es_entries:
+            self.es_client.insert_bulk(es_entries)
+            count += len(es_entries)
+        return count
+
+    def delete_pages(self, ids):
+        """
+        Checks the ids against mongodb in pages of page_size and removes from the index the ones
+        that are not in the works collection.
+
+        Returns
+        -------
+        int
+            Number of documents removed from the index.
+        """
+        removed = 0
+        es_ids = []
+        for _id in ids:
+            es_ids.append(_id)
+            if len(es_ids) == self.page_size:
+                removed += self.delete_missing_page(es_ids)
+                es_ids = []
+        if es_ids:
+            removed += self.delete_missing_page(es_ids)
+        return removed
+
+    def delete_logged(self, watermark):
+        """
+        Removes from the index the works logged in the removed_log collection since the watermark,
+        only the log entries of the run are read.
+
+        Returns
+        -------
+        int
+            Number of documents removed from the index.
+        """
+        query = {} if watermark is None else {"time": {"$gte": watermark}}
+        return self.delete_pages(str(reg["_id"]) for reg in self.db[self.removed_log].find(query, {"_id": 1}))
+
+    def delete_missing(self):
+        """
+        Removes from the index the documents of works that are not in the works collection anymore (deleted or merged).
+        Every _id of the index is read and checked against mongodb, it is a full reconciliation to run periodically.
+
+        Returns
+        -------
+        int
+            Number of documents removed from the index.
+        """
+        if isinstance(self.es_client, LocalSimilarity):
+            index_ids = self.es_client.ids()
+        else:
+            index_ids = (hit["_id"] for hit in scan(self.es_client.es, index=self.index,
+                                                    query={"query": {"match_all": {}}, "_source": False}))
+        return self.delete_pages(index_ids)
+
+    def delete_missing_page(self, es_ids):
+        """
+        Deletes from the index the ids in es_ids that are not in the works collection.
+        """
+        ids = [ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id in es_ids]
+        found = {str(reg["_id"]) for reg in self.collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+        if isinstance(self.es_client, LocalSimilarity):
+            return self.es_client.delete_ids([_id for _id in es_ids if _id not in found])
+        actions = [{"_op_type": "delete", "_index": self.index, "_id": _id}
+                   for _id in es_ids if _id not in found]
+        if not actions:
+            return 0
+        removed = 0
+        for ok, item in streaming_bulk(self.es_client.es, actions, raise_on_error=False,
+                                       max_retries=self.max_retries, request_timeout=self.es_client.es_req_timeout):
+            if ok:
+                removed += 1
+        return removed
+
+    def incremental(self):
+        """
+        Indexes only the works updated (updated.time) since the last successful incremental run and
+        removes from the index the works logged as removed since then, with remove_deleted every
+        _id of the index is also checked against the works collection.
+        The watermark is saved only if the run finishes, the first run indexes all the works.
+        """
+        self.collection.create_index("updated.time")
+        reg = self.checkpoints.find_one({"_id": self.watermark_key})
+        watermark = reg["time"] if reg else None
+        start = int(time())
+        if watermark is None:
+            query = {}
+            if self.verbose > 0:
+                print("INFO: no watermark found, indexing all the works")
+        else:
+            # $gte, a work updated in the same second of the previous run is indexed again
+            query = {"updated.time": {"$gte": watermark}}
+            if self.verbose > 0:
+                print(f"INFO: indexing works updated since {watermark}")
+        count = self.index_works(query)
+        removed = self.delete_missing() if self.remove_deleted else self.delete_logged(watermark)
+        self.es_client.refresh_index()
+        self.checkpoints.update_one(
+            {"_id": self.watermark_key},
+            {"$set": {"time": start, "indexed": count, "removed": removed}},
+            upsert=True)
+        if self.verbose > 0:
+            print(f"INFO: {count} works indexed, {removed} removed from index {self.index}")
+
+    def compare(self):
+        """
+        Validates the local similarity index against elasticsearch: the works of a sample of sample_size works
+        are searched in both (as the works plugins do, with es_thold 0 and 20 hits) and the number of
+        searches with the same best hit and the mean overlap of the hits are reported.
+
+        Returns
+        -------
+        dict
+            sample, same_best (searches with the same best hit) and overlap (mean fraction of the
+            elasticsearch hits found by the local index).
+        """
+        local = LocalSimilarity(self.local_index, es_index=self.index)
+        total = 0
+        same_best = 0
+        overlap = 0
+        for reg in self.collection.aggregate([{"$sample": {"size": self.sample_size}}, {"$project": works_projection}]):
+            entry = self.build_entry(reg)
+            if entry is None:
+                continue
+            work = entry["_source"]
+            query = {"title": work["title"], "source": work["source"], "year": work["year"], "authors": work["authors"],
+                     "volume": work["volume"], "issue": work["issue"], "page_start": work["start_page"],
+                     "page_end": work["end_page"], "use_es_thold": True, "es_thold": 0, "hits": 20}
+            es_hits = [hit["_id"] for hit in self.es_client.search_work(**query) or []]
+            local_hits = [hit["_id"] for hit in local.search_work(**query) or []]
+            total += 1
+            if es_hits[:1] == local_hits[:1]:
+                same_best += 1
+            if es_hits:
+                overlap += len(set(es_hits) & set(local_hits)) / len(es_hits)
+        local.close()
+        result = {"sample": total, "same_best": same_best, "overlap": overlap / total if total else 0}
+        print(f"INFO: {same_best} of {total} works with the same best hit, mean overlap of the hits {result['overlap']:.3f}")
+        return result
+
     def delete(self):
         self.es_client.delete_index(self.index)
+        self.checkpoints.delete_one({"_id": self.watermark_key})
 
     def run(self):
         if self.task == "bulk_insert":
             if self.verbose > 0:
                 print(f"""Bulk inserting index {self.index}""")
-            self.bulk_insert()
+            if self.pipeline and not self.local_index:
+                self.pipelined_bulk_insert()
+            else:
+                self.bulk_insert()
         elif self.task == "delete":
             if self.verbose > 0:
                 print(f"""Deleting index {self.index}""")
             self.delete()
+        elif self.task == "incremental":
+            if self.verbose > 0:
+                print(f"""Incremental reindex of index {self.index}""")
+            self.incremental()
+        elif self.task == "compare":
+            if not self.local_index:
+                raise Exception(
+                    "[Kahi_elasticsearch_works] ERROR: Please specify the local_index to compare")
+            if self.verbose > 0:
+                print(f"""Comparing index {self.index} with the local index {self.local_index}""")
+            self.compare()
         else:
             raise Exception("Please specify a task to execute")
         if self.debug:
@@ -82,7 +82,9 @@ def main():
         install_requires=[
             'kahi',
             'pymongo',
-            'mohan'
+            'mohan',
+            'elasticsearch',
+            'Kahi_similarity_utils'
         ],
     )
 
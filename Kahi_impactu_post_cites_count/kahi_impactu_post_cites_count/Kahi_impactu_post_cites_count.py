@@ -1,5 +1,5 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from joblib import Parallel, delayed
 
 
@@ -26,7 +26,12 @@ class Kahi_impactu_post_cites_count(KahiBase):
             impactu_post_cites_count:
                 num_jobs: 20
                 verbose: 5
+                single_pass: True
+                bulk_size: 1000
         ```
+        single_pass (default False) computes person, institution, faculty, department, group and source counts
+        with one scan over works instead of one aggregation per entity,
+        the results are written with bulk_write in batches of bulk_size.
         """
         self.config = config
         self.mongodb_url = config["database_url"]
@@ -34,6 +39,10 @@ class Kahi_impactu_post_cites_count(KahiBase):
 
         self.n_jobs = self.config["impactu_post_cites_count"]["num_jobs"]
         self.verbose = self.config["impactu_post_cites_count"]["verbose"]
+        self.single_pass = self.config["impactu_post_cites_count"]["single_pass"] if "single_pass" in self.config["impactu_post_cites_count"].keys(
+        ) else False
+        self.bulk_size = self.config["impactu_post_cites_count"]["bulk_size"] if "bulk_size" in self.config["impactu_post_cites_count"].keys(
+        ) else 1000
 
         self.client = MongoClient(self.mongodb_url)
         self.db = self.client[self.database_name]
@@ -186,11 +195,160 @@ class Kahi_impactu_post_cites_count(KahiBase):
         self.sources_collection.update_one(
             {"_id": sid["_id"]}, {"$set": rec}, upsert=True)
 
+    def accumulate(self, counts, eid, citations):
+        """
+        Adds one product and its citations to the counts of an entity.
+
+        Parameters
+        ----------
+        counts : dict
+            entity id -> [products_count, {citations source: count}]
+        eid : ObjectId
+            id of the entity.
+        citations : list
+            (source, count) pairs of the work.
+        """
+        rec = counts.get(eid)
+        if rec is None:
+            rec = counts[eid] = [0, {}]
+        rec[0] += 1
+        for source, count in citations:
+            rec[1][source] = rec[1].get(source, 0) + count
+
+    def write_counts(self, collection, query, counts):
+        """
+        Writes citations_count and products_count to every document of collection matching query,
+        documents without products get an empty citations_count and products_count 0.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            Collection to update.
+        query : dict
+            Filter of the documents to update.
+        counts : dict
+            entity id -> [products_count, {citations source: count}]
+        """
+        operations = []
+        for reg in collection.find(query, {"_id": 1}):
+            products, citations = counts.get(reg["_id"], (0, {}))
+            rec = {
+                "citations_count": [{"source": source, "count": count} for source, count in citations.items()],
+                "products_count": products
+            }
+            operations.append(UpdateOne({"_id": reg["_id"]}, {"$set": rec}))
+            if len(operations) >= self.bulk_size:
+                collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+
+    def get_person_units(self):
+        """
+        Builds the membership index of persons in faculties, departments and groups from person.affiliations.id.
+
+        Returns
+        -------
+        dict
+            person id -> tuple of unit ids
+        """
+        unit_ids = set(reg["_id"] for reg in self.affiliations_collection.find(
+            {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id": 1}))
+        person_units = {}
+        for person in self.person_collection.find({"affiliations.id": {"$in": list(unit_ids)}}, {"affiliations.id": 1}):
+            units = set(aff["id"] for aff in person["affiliations"] if aff.get("id") in unit_ids)
+            if units:
+                person_units[person["_id"]] = tuple(units)
+        return person_units
+
+    def count_cites_products_single_pass(self):
+        """
+        Method to calculate the citation and product count for each person, institution, faculty, department,
+        group and source with a single scan over the works collection.
+
+        Every work adds one product and its citations (per citations source) to each distinct author,
+        each distinct affiliation of its authors and its source. The results are kept in memory and
+        written with bulk_write, the same values computed by the per entity aggregations.
+
+        As in count_cites_products_faculty_department_group, the citations of a faculty, department or group
+        are the citations of the distinct works of its members (person.affiliations.id), every work adds its
+        citations once to the union of the units of its authors, while the products count is given by
+        authors.affiliations.id.
+        """
+        person_units = self.get_person_units()
+        if self.verbose > 0:
+            print("{} authors belong to faculties, departments or groups".format(
+                len(person_units)))
+        person_counts = {}
+        affiliation_counts = {}
+        source_counts = {}
+        unit_counts = {}
+        works = self.works_collection.find(
+            {}, {"authors.id": 1, "authors.affiliations.id": 1, "source.id": 1, "citations_count": 1})
+        for i, work in enumerate(works):
+            citations = {}
+            for cites in work.get("citations_count") or []:
+                count = cites.get("count")
+                if not isinstance(count, (int, float)) or isinstance(count, bool):
+                    count = 0  # same as $sum, non numeric values are ignored
+                citations[cites.get("source")] = citations.get(cites.get("source"), 0) + count
+            citations = list(citations.items())
+            person_ids = set()
+            aff_ids = set()
+            for author in work.get("authors") or []:
+                if author.get("id"):
+                    person_ids.add(author["id"])
+                for aff in author.get("affiliations") or []:
+                    if aff.get("id"):
+                        aff_ids.add(aff["id"])
+            for pid in person_ids:
+                self.accumulate(person_counts, pid, citations)
+            for aid in aff_ids:
+                self.accumulate(affiliation_counts, aid, citations)
+            units = set()
+            for pid in person_ids:
+                units.update(person_units.get(pid, ()))
+            for uid in units:
+                self.accumulate(unit_counts, uid, citations)
+            if isinstance(work.get("source"), dict) and work["source"].get("id"):
+                self.accumulate(source_counts, work["source"]["id"], citations)
+            if self.verbose > 4 and (i + 1) % 100000 == 0:
+                print(f"{i + 1} works processed")
+
+        if self.verbose > 0:
+            print("Writing cites and products count for {} authors".format(
+                len(person_counts)))
+        self.write_counts(self.person_collection, {}, person_counts)
+        if self.verbose > 0:
+            print("Writing cites and products count for {} institutions".format(
+                len(affiliation_counts)))
+        self.write_counts(self.affiliations_collection,
+                          {"types.type": {"$nin": ["department", "faculty", "group"]}}, affiliation_counts)
+        if self.verbose > 0:
+            print("Writing cites and products count for {} faculties, departments and groups".format(
+                len(unit_counts)))
+        unit_counts = {uid: [affiliation_counts[uid][0] if uid in affiliation_counts else 0, citations]
+                       for uid, (_, citations) in unit_counts.items()}
+        for uid, (products, _) in affiliation_counts.items():
+            if uid not in unit_counts:
+                unit_counts[uid] = [products, {}]
+        self.write_counts(self.affiliations_collection,
+                          {"types.type": {"$in": ["department", "faculty", "group"]}}, unit_counts)
+        if self.verbose > 0:
+            print("Writing cites and products count for {} sources".format(
+                len(source_counts)))
+        self.write_counts(self.sources_collection, {}, source_counts)
+
     def run_cites_count(self):
         """
         Method to run the cites and products count calculation for each person, institution, faculty, department and group.
         """
 
+        if self.single_pass:
+            # Count cites for each author, institution, faculty, department, group and source
+            self.count_cites_products_single_pass()
+            return
+
         # Count cites for each author
         person_ids = list(self.person_collection.find({}, {"_id"}))
         if self.verbose > 0:
@@ -3,15 +3,19 @@ from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
 import subprocess
 from spacy import cli, load
-from kahi_impactu_postcalculations.process_one import network_creation_process_one, top_words_process_one, count_works_one, load_nlp_models
+from kahi_impactu_postcalculations.process_one import network_creation_process_one, top_words_process_one, count_works_one, load_nlp_models, unit_members
 from kahi_impactu_postcalculations.indexes import create_indexes
-from kahi_impactu_postcalculations.denormalization import denormalize
-from kahi_impactu_postcalculations.typing import process_type
-from kahi_impactu_postcalculations.topics import process_topic
-from kahi_impactu_postcalculations.person_persistent_ids import process_person_id
+from kahi_impactu_postcalculations.denormalization import denormalize, incremental_queries
+from kahi_impactu_postcalculations.typing import build_type_lookups, process_types_source
+from kahi_impactu_postcalculations.topics import process_topic, process_topics
+from kahi_impactu_postcalculations.person_persistent_ids import process_person_id, migrate_person_ids
+from kahi_impactu_postcalculations.networks import CoauthorshipIndex, network_creation_from_index
+from kahi_impactu_postcalculations.lemmas import build_lemma_cache
+from kahi_impactu_postcalculations.stages import StageRunner
 from pathlib import Path
 import pandas as pd
 import gc
+from time import time
 
 
 class Kahi_impactu_postcalculations(KahiBase):
@@ -44,6 +48,40 @@ class Kahi_impactu_postcalculations(KahiBase):
 
         self.author_count = self.config["impactu_postcalculations"][
             "author_count"] if "author_count" in self.config["impactu_postcalculations"] else 6
+        self.fused_denormalization = self.config["impactu_postcalculations"][
+            "fused_denormalization"] if "fused_denormalization" in self.config["impactu_postcalculations"] else False
+        self.denormalization_batch_size = self.config["impactu_postcalculations"][
+            "denormalization_batch_size"] if "denormalization_batch_size" in self.config["impactu_postcalculations"] else 1000
+        self.denormalization_jobs = self.config["impactu_postcalculations"][
+            "denormalization_jobs"] if "denormalization_jobs" in self.config["impactu_postcalculations"] else 1
+        self.coauthorship_index = self.config["impactu_postcalculations"][
+            "coauthorship_index"] if "coauthorship_index" in self.config["impactu_postcalculations"] else True
+        self.incremental_denormalization = self.config["impactu_postcalculations"][
+            "incremental_denormalization"] if "incremental_denormalization" in self.config["impactu_postcalculations"] else False
+        self.incremental_max_ids = self.config["impactu_postcalculations"][
+            "incremental_max_ids"] if "incremental_max_ids" in self.config["impactu_postcalculations"] else 100000
+        self.lemmas_cache = self.config["impactu_postcalculations"][
+            "lemmas_cache"] if "lemmas_cache" in self.config["impactu_postcalculations"] else True
+        self.nlp_batch_size = self.config["impactu_postcalculations"][
+            "nlp_batch_size"] if "nlp_batch_size" in self.config["impactu_postcalculations"] else 1000
+        self.nlp_n_process = self.config["impactu_postcalculations"][
+            "nlp_n_process"] if "nlp_n_process" in self.config["impactu_postcalculations"] else 1
+        self.topics_batch_size = self.config["impactu_postcalculations"][
+            "topics_batch_size"] if "topics_batch_size" in self.config["impactu_postcalculations"] else 32
+        self.topics_jobs = self.config["impactu_postcalculations"][
+            "topics_jobs"] if "topics_jobs" in self.config["impactu_postcalculations"] else self.n_jobs
+        self.topics_max_retries = self.config["impactu_postcalculations"][
+            "topics_max_retries"] if "topics_max_retries" in self.config["impactu_postcalculations"] else 3
+        self.persistent_ids_bulk = self.config["impactu_postcalculations"][
+            "persistent_ids_bulk"] if "persistent_ids_bulk" in self.config["impactu_postcalculations"] else True
+        self.persistent_ids_batch_size = self.config["impactu_postcalculations"][
+            "persistent_ids_batch_size"] if "persistent_ids_batch_size" in self.config["impactu_postcalculations"] else 1000
+        self.stages = self.config["impactu_postcalculations"][
+            "stages"] if "stages" in self.config["impactu_postcalculations"] else None
+        self.skip_stages = self.config["impactu_postcalculations"][
+            "skip_stages"] if "skip_stages" in self.config["impactu_postcalculations"] else []
+        self.resume = self.config["impactu_postcalculations"][
+            "resume"] if "resume" in self.config["impactu_postcalculations"] else True
         self._check_and_install_spacy_models()
         self.types_file = str(
             Path(__file__).parent.resolve()) + "/Tipos_ImpactU_Definitivo.xlsx"
@@ -76,6 +114,7 @@ class Kahi_impactu_postcalculations(KahiBase):
 
         self.types["Tipo"] = self.types["Tipo"].apply(
             lambda x: " ".join(x.split()).strip() if isinstance(x, str) else x)
+        self.types_lookups = build_type_lookups(self.types, self.types_priority)
 
     def _check_and_install_spacy_models(self):
         """
@@ -111,6 +150,7 @@ class Kahi_impactu_postcalculations(KahiBase):
                        "download", "es_core_news_sm"])
 
     def process_types(self, db):
+        counts = {}
         for source in self.types_priority:
             print(f"INFO: processing types for {source}")
             pipe = [{"$match": {"types.source": {"$ne": "impactu"}}},
@@ -127,11 +167,17 @@ class Kahi_impactu_postcalculations(KahiBase):
                 {"$project": {"types": 1}},
             ]
             data = db["works"].aggregate(pipe)
-            Parallel(n_jobs=self.n_jobs, verbose=10, backend="threading")(delayed(process_type)(db, work, source, self.types
-                                                                                                ) for work in data)
+            count = process_types_source(db, data, source, self.types_lookups)
+            print(f"INFO: {count} works with impactu type for {source}")
+            counts[source] = count
+        return counts
 
     def process_person_ids(self, client):
         db = client[self.database_name]
+        if self.persistent_ids_bulk:
+            errors = migrate_person_ids(client, db["person"], db["works"], self.person_priority,
+                                        self.persistent_ids_batch_size, self.verbose)
+            return {"errors": len(errors)}
         for source in self.person_priority:
             print("INFO: PERSISTENT ID SOURCE  ", source)
             # Paso 1: Buscar todos los documentos 'person' (con o sin COD_RH)
@@ -148,34 +194,158 @@ class Kahi_impactu_postcalculations(KahiBase):
             Parallel(n_jobs=self.n_jobs, backend="threading", verbose=10)(
                 delayed(process_person_id)(client, db["person"], db["works"], person, source) for person in cursor
             )
+        return {"person": db["person"].count_documents({"_id_old": {"$exists": True}})}
 
-    def run(self):
+    def create_networks_from_index(self, db, impactu_client, net):
         """
-        Execute the plugin to create co-authorship networks and extract top words.
+        Creates the co-authorship networks of the institutions or the authors with works from
+        a co-authorship index built reading the works collection once.
+
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            Kahi database.
+        impactu_client : pymongo.MongoClient
+            Client of the calculations database.
+        net : str
+            "affiliations" or "person".
+
+        Returns
+        -------
+        int
+            Number of networks.
         """
+        db_out = impactu_client[self.impactu_database_name]
+
+        print(f"INFO: Building {net} co-authorship index")
+        index = CoauthorshipIndex(db["works"], net, self.author_count, self.verbose)
+        if net == "affiliations":
+            ids = [aff["_id"] for aff in db["affiliations"].find(
+                {"types.type": {"$nin": ["faculty", "department", "group"]}}, {"_id": 1}) if index.has_works(aff["_id"])]
+            print("INFO: Creating affiliations networks")
+        else:
+            ids = [x["_id"] for x in db["person"].find({}, {"_id": 1}) if index.has_works(x["_id"])]
+            print(f"INFO: total authors {len(ids)}")
+            print("INFO: Creating authors networks")
+        # the index is shared in memory, so the threading backend is used
+        Parallel(n_jobs=self.n_jobs, verbose=10, backend="threading")(
+            delayed(network_creation_from_index)(db, db_out, index, idx) for idx in ids)
+        del index
+        gc.collect()
+        return len(ids)
 
-        client = MongoClient(self.mongodb_url)
-        db = client[self.database_name]
-
-        impactu_client = MongoClient(self.impactu_database_url)
-
-        openalex_client = MongoClient(self.openalex_database_url)
-        openalex_db = openalex_client[self.openalex_database_name]
-
-        print("INFO: Setting up persistent ids for authors")
-        self.process_person_ids(client)
-
-        print("INFO: Setting up impactu types for works")
-        self.process_types(db)
-
-        print(f"INFO: Denormalizing data in {self.database_name}")
-        denormalize(db)
+    def create_networks(self, client, db, impactu_client, net):
+        """
+        Creates the co-authorship networks of the institutions or the authors with works.
+
+        Parameters
+        ----------
+        client : pymongo.MongoClient
+            Client of the kahi database.
+        db : pymongo.database.Database
+            Kahi database.
+        impactu_client : pymongo.MongoClient
+            Client of the calculations database.
+        net : str
+            "affiliations" or "person".
+
+        Returns
+        -------
+        dict
+            Number of networks.
+        """
+        if self.coauthorship_index:
+            return {net: self.create_networks_from_index(db, impactu_client, net)}
+        if net == "affiliations":
+            # Getting the list of institutions ids with works
+            print("INFO: Getting affiliations ids")
+            ids = []
+            for aff in db["affiliations"].find({"types.type": {"$nin": ["faculty", "department", "group"]}}, {"_id": 1}):
+                count = db["works"].count_documents(
+                    {"authors.affiliations.id": aff["_id"]})
+                if count != 0:
+                    ids.append(aff["_id"])
+            print("INFO: Creating affiliations networks")
+        else:
+            # Getting the list of authors ids with works
+            print("INFO: Checking authors with works")
+            authors_ids = [x["_id"] for x in db["person"].find({}, {"_id": 1})]
+
+            # this could be threads, is a basic thing.
+            ids = Parallel(n_jobs=self.n_jobs, backend="threading", verbose=1)(
+                delayed(count_works_one)(
+                    db,
+                    author
+                ) for author in authors_ids)
+
+            # remove Nones
+            ids = [x for x in ids if x is not None]
+
+            print(f"INFO: total authors {len(ids)}")
+            # Creating the networks of coauthorship for each author
+            print("INFO: Creating authors networks")
+        if ids:
+            Parallel(
+                n_jobs=self.n_jobs,
+                verbose=10,
+                backend=self.backend)(
+                    delayed(network_creation_process_one)(
+                        self.config,
+                        client if self.backend == "threading" else None,
+                        impactu_client if self.backend == "threading" else None,
+                        idx,
+                        self.author_count,
+                        net,
+                        self.backend
+                    ) for idx in ids)
+        return {net: len(ids)}
 
+    def denormalize_data(self, client, db, start):
+        """
+        Denormalizes the data, in incremental mode only the documents related to the entities updated since
+        the last successful denormalization (the watermark) are processed.
+
+        Parameters
+        ----------
+        client : pymongo.MongoClient
+            Client of the kahi database.
+        db : pymongo.database.Database
+            Kahi database.
+        start : int
+            Start time of the run, saved as the new watermark.
+        """
+        queries = None
+        if self.incremental_denormalization:
+            checkpoints = (client[self.config["log_database"]] if "log_database" in self.config.keys() else db)["checkpoints"]
+            key = f"impactu_postcalculations/{self.database_name}/denormalization"
+            reg = checkpoints.find_one({"_id": key})
+            if reg:
+                print(f"INFO: Incremental denormalization of the entities updated since {reg['time']}")
+                for collection_name in ["works", "person", "affiliations", "sources"]:
+                    db[collection_name].create_index("updated.time")
+                db["works"].create_index("authors.id")
+                db["works"].create_index("authors.affiliations.id")
+                db["works"].create_index("groups.id")
+                db["works"].create_index("source.id")
+                queries = incremental_queries(db, reg["time"], self.incremental_max_ids)
+                if queries is None:
+                    print(f"INFO: More than {self.incremental_max_ids} updated entities, denormalizing all the data")
+            else:
+                print("INFO: No denormalization watermark found, denormalizing all the data")
+        denormalize(db, fused=self.fused_denormalization,
+                    batch_size=self.denormalization_batch_size, verbose=self.verbose,
+                    n_jobs=self.denormalization_jobs, queries=queries)
+        if self.incremental_denormalization:
+            checkpoints.update_one({"_id": key}, {"$set": {"time": start}}, upsert=True)
+
+    def create_backend_indexes(self, db):
         print(f"INFO: Creating indexes in db {self.database_name} for backend")
         db["works"].create_index("authors.id")
         create_indexes(db)
 
+    def process_works_topics(self, db, openalex_db):
         print("INFO: Setting up topics for works")
+        count = db["works"].count_documents({"primary_topic": {}})
         works_cursor = db["works"].find(
             {"primary_topic": {}},
             {
@@ -186,98 +356,78 @@ class Kahi_impactu_postcalculations(KahiBase):
                 "topics": 1,
             },
         )
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=10,
-            backend="threading",
-        )(
-            delayed(process_topic)(
+        if self.topics_batch_size > 1:
+            process_topics(
                 db["works"],
                 openalex_db["topics"],
-                work,
+                works_cursor,
                 self.inference_endpoint,
-            )
-            for work in works_cursor
-        )
-
-        # Getting the list of institutions ids with works
-        print("INFO: Getting authors and affiliations ids")
-        institutions_ids = []
-        for aff in db["affiliations"].find({"types.type": {"$nin": ["faculty", "department", "group"]}}, {"_id": 1}):
-            count = db["works"].count_documents(
-                {"authors.affiliations.id": aff["_id"]})
-            if count != 0:
-                institutions_ids.append(aff["_id"])
-
-        # Creating the networks of coauthorship for each affiliation
-        print("INFO: Creating affiliations networks")
-        if institutions_ids:
-            Parallel(
-                n_jobs=self.n_jobs,
+                batch_size=self.topics_batch_size,
+                n_jobs=self.topics_jobs,
+                max_retries=self.topics_max_retries,
                 verbose=10,
-                backend=self.backend)(
-                    delayed(network_creation_process_one)(
-                        self.config,
-                        client if self.backend == "threading" else None,
-                        impactu_client if self.backend == "threading" else None,
-                        idx,
-                        self.author_count,
-                        "affiliations",
-                        self.backend
-                    ) for idx in institutions_ids)
-
-        # Getting the list of authors ids with works
-        print("INFO: Checking authors with works")
-        authors_ids = [x["_id"] for x in db["person"].find({}, {"_id": 1})]
-
-        # this could be threads, is a basic thing.
-        authors_ids = Parallel(n_jobs=self.n_jobs, backend="threading", verbose=1)(
-            delayed(count_works_one)(
-                db,
-                author
-            ) for author in authors_ids)
-
-        # remove Nones
-        authors_ids = [x for x in authors_ids if x is not None]
-
-        print(f"INFO: total authors {len(authors_ids)}")
-        # Creating the networks of coauthorship for each author
-        print("INFO: Creating authors networks")
-        if authors_ids:
+            )
+        else:
             Parallel(
                 n_jobs=self.n_jobs,
                 verbose=10,
-                backend=self.backend)(
-                    delayed(network_creation_process_one)(
-                        self.config,
-                        client if self.backend == "threading" else None,
-                        impactu_client if self.backend == "threading" else None,
-                        idx,
-                        self.author_count,
-                        "person",
-                        self.backend
-                    ) for idx in authors_ids)
-        # Getting the top words for each institution
-        print("INFO: Creating top words for institutions")
-        affiliations_cursor = list(db["affiliations"].find({}, {"_id": 1}))
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=10,
-            backend=self.backend)(
-                delayed(top_words_process_one)(
-                    self.config,
-                    client if self.backend == "threading" else None,
-                    impactu_client if self.backend == "threading" else None,
-                    aff,
-                    self.stopwords,
-                    "affiliations",
-                    self.backend
-                ) for aff in affiliations_cursor)
-
-        # Getting the top words for others organizations
-        print("INFO: Creating top words for others affiliations such as faculty, department, group")
-        affiliations_cursor = list(db["affiliations"].find(
-            {"types.type": {"$in": ["faculty", "department", "group"]}}, {"_id": 1}))
+                backend="threading",
+            )(
+                delayed(process_topic)(
+                    db["works"],
+                    openalex_db["topics"],
+                    work,
+                    self.inference_endpoint,
+                )
+                for work in works_cursor
+            )
+        return {"works": count}
+
+    def lemmatize_titles(self, db, impactu_client):
+        if not self.lemmas_cache:
+            return {}
+        # Lemmatizing the titles of the works once for all the top words
+        print("INFO: Lemmatizing the titles of the works")
+        count = build_lemma_cache(db, impactu_client[self.impactu_database_name], self.es_model, self.en_model, self.stopwords,
+                                  self.nlp_batch_size, self.nlp_n_process, verbose=self.verbose)
+        return {"works": count}
+
+    def create_top_words(self, client, db, impactu_client, top_words):
+        """
+        Creates the top words of the institutions ("affiliations"), the faculties, departments and groups
+        ("affiliations_others") or the authors ("person").
+
+        Parameters
+        ----------
+        client : pymongo.MongoClient
+            Client of the kahi database.
+        db : pymongo.database.Database
+            Kahi database.
+        impactu_client : pymongo.MongoClient
+            Client of the calculations database.
+        top_words : str
+            "affiliations", "affiliations_others" or "person".
+
+        Returns
+        -------
+        dict
+            Number of entities processed.
+        """
+        members = {}
+        if top_words == "affiliations":
+            # Getting the top words for each institution
+            print("INFO: Creating top words for institutions")
+            cursor = list(db["affiliations"].find({}, {"_id": 1}))
+        elif top_words == "affiliations_others":
+            # Getting the top words for others organizations
+            print("INFO: Creating top words for others affiliations such as faculty, department, group")
+            cursor = list(db["affiliations"].find(
+                {"types.type": {"$in": ["faculty", "department", "group"]}}, {"_id": 1}))
+            members = unit_members(db, [aff["_id"] for aff in cursor])
+        else:
+            # Getting the top words for each author
+            print("INFO: Creating top words for person")
+            cursor = list(db["person"].find({}, {"_id": 1}))
         Parallel(
             n_jobs=self.n_jobs,
             verbose=10,
@@ -286,26 +436,62 @@ class Kahi_impactu_postcalculations(KahiBase):
                     self.config,
                     client if self.backend == "threading" else None,
                     impactu_client if self.backend == "threading" else None,
-                    aff,
+                    entity,
                     self.stopwords,
-                    "affiliations",
-                    self.backend
-                ) for aff in affiliations_cursor)
+                    top_words,
+                    self.backend,
+                    self.lemmas_cache,
+                    members.get(entity["_id"], []) if top_words == "affiliations_others" else None
+                ) for entity in cursor)
+        return {top_words: len(cursor)}
 
-        # Getting the top words for each author
-        print("INFO: Creating top words for person")
-        authors_cursor = list(db["person"].find({}, {"_id": 1}))
+    def run(self):
+        """
+        Execute the plugin to create co-authorship networks and extract top words.
 
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=10,
-            backend=self.backend)(
-                delayed(top_words_process_one)(
-                    self.config,
-                    client if self.backend == "threading" else None,
-                    impactu_client if self.backend == "threading" else None,
-                    author,
-                    self.stopwords,
-                    "person",
-                    self.backend
-                ) for author in authors_cursor)
+        The post calculations are run as stages (see StageRunner), the stages can be selected with the
+        options stages and skip_stages, and the stages completed by a failed run are not run again.
+        """
+        start = int(time())
+
+        client = MongoClient(self.mongodb_url)
+        db = client[self.database_name]
+
+        impactu_client = MongoClient(self.impactu_database_url)
+
+        openalex_client = MongoClient(self.openalex_database_url)
+        openalex_db = openalex_client[self.openalex_database_name]
+
+        stages = [
+            ("person_ids", self.process_person_ids, (client,)),
+            ("types", self.process_types, (db,)),
+            ("denormalization", self.denormalize_data, (client, db, start)),
+            ("indexes", self.create_backend_indexes, (db,)),
+            ("topics", self.process_works_topics, (db, openalex_db)),
+            ("affiliations_networks", self.create_networks, (client, db, impactu_client, "affiliations")),
+            ("person_networks", self.create_networks, (client, db, impactu_client, "person")),
+            ("lemmas", self.lemmatize_titles, (db, impactu_client)),
+            ("top_words_affiliations", self.create_top_words, (client, db, impactu_client, "affiliations")),
+            ("top_words_affiliations_others", self.create_top_words, (client, db, impactu_client, "affiliations_others")),
+            ("top_words_person", self.create_top_words, (client, db, impactu_client, "person")),
+        ]
+        names = [name for name, func, args in stages]
+        for name in (self.stages or []) + self.skip_stages:
+            if name not in names:
+                print(f"ERROR: Invalid stage {name}, options are {names}")
+                return None
+
+        log_db = client[self.config["log_database"]] if "log_database" in self.config.keys() else db
+        runner = StageRunner(log_db, f"impactu_postcalculations/{self.database_name}/stages",
+                             start, resume=self.resume, verbose=self.verbose)
+        for name, func, args in stages:
+            if (self.stages and name not in self.stages) or name in self.skip_stages:
+                print(f"INFO: Skipping stage {name}")
+                continue
+            runner.run(name, func, *args)
+        runner.finish()
+
+        client.close()
+        impactu_client.close()
+        openalex_client.close()
+        return 0
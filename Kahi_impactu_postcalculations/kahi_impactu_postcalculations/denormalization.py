@@ -1,3 +1,8 @@
+from kahi_impactu_postcalculations.works_denormalization import denormalize_works
+from joblib import Parallel, delayed
+from time import time
+
+
 def set_works_authors_affiliations_country(collection) -> None:
     """
     Method to set the country of the affiliations of the authors of the works
@@ -2369,7 +2374,172 @@ DENORMALIZATION_PIPELINES = {
 }
 
 
-def denormalize(db):
+# pipelines grouping documents of different _id, they can not be split in _id ranges or restricted to some documents
+PARTITION_UNSAFE = [
+    set_sources_products_count,
+    set_sources_citations_count_openalex,
+]
+
+
+class FilteredCollection:
+    """
+    Wrapper of a collection restricted to the documents matching a query, the functions of
+    DENORMALIZATION_PIPELINES receive it as a collection: a $match stage with the query is prepended
+    to the aggregations and the query is added to the filter of update_many.
+    """
+
+    def __init__(self, collection, query):
+        """
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            Collection to wrap.
+        query : dict
+            Filter of the documents, ex: {"_id": {"$gte": min_id, "$lt": max_id}}
+        """
+        self.collection = collection
+        self.query = query
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        return self.collection.aggregate([{"$match": self.query}] + pipeline, *args, **kwargs)
+
+    def update_many(self, filter, update, *args, **kwargs):
+        return self.collection.update_many({"$and": [filter, self.query]}, update, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def id_partitions(collection, n_partitions):
+    """
+    Splits a collection in n_partitions ranges of _id with $bucketAuto.
+
+    If the ranges do not cover all the documents (the _id values have different types and the
+    range queries are type bracketed) the collection is not split.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to split.
+    n_partitions : int
+        Number of ranges.
+
+    Returns
+    -------
+    list
+        List of _id bounds, [None] if the collection is not split.
+    """
+    if n_partitions <= 1:
+        return [None]
+    buckets = list(collection.aggregate(
+        [{"$bucketAuto": {"groupBy": "$_id", "buckets": n_partitions}}], allowDiskUse=True))
+    if len(buckets) <= 1:
+        return [None]
+    partitions = []
+    for i, bucket in enumerate(buckets):
+        bounds = {}
+        if i > 0:
+            bounds["$gte"] = bucket["_id"]["min"]
+        if i < len(buckets) - 1:
+            bounds["$lt"] = buckets[i + 1]["_id"]["min"]
+        partitions.append(bounds)
+    covered = sum(collection.count_documents({"_id": bounds}) for bounds in partitions)
+    if covered != collection.count_documents({}):
+        print(f"WARNING: _id ranges of {collection.name} do not cover all the documents, it will not be partitioned")
+        return [None]
+    return partitions
+
+
+def run_partition(pipeline_func, collection, query, index):
+    """
+    Runs a denormalization function over the documents of the collection matching query.
+
+    Returns
+    -------
+    tuple
+        (index, elapsed seconds)
+    """
+    start = time()
+    pipeline_func(collection if query is None else FilteredCollection(collection, query))
+    return index, time() - start
+
+
+def combine_queries(restriction, bounds):
+    """
+    Returns the query of the documents in the restriction and the _id bounds, None if there is neither.
+    """
+    queries = []
+    if restriction is not None:
+        queries.append(restriction)
+    if bounds is not None:
+        queries.append({"_id": bounds})
+    if not queries:
+        return None
+    return queries[0] if len(queries) == 1 else {"$and": queries}
+
+
+def changed_ids(collection, watermark):
+    """
+    Returns the _id of the documents of collection updated (updated.time) since watermark.
+    """
+    return [reg["_id"] for reg in collection.find({"updated.time": {"$gte": watermark}}, {"_id": 1})]
+
+
+def incremental_queries(db, watermark, max_ids=100000):
+    """
+    Computes, for every collection of DENORMALIZATION_PIPELINES, the query of the documents to denormalize
+    again given the entities updated since watermark:
+    - works: updated works and works whose authors, authors affiliations, groups or source were updated.
+    - sources: updated sources and sources of the works to denormalize.
+    - person: updated person and person with an updated affiliation.
+    - affiliations: updated affiliations.
+
+    The changed _ids go in $in lists of the queries, if any list has more than max_ids elements
+    the query would be too big (16MB limit of a query document) or too slow, None is returned then
+    and everything must be denormalized.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database to denormalize.
+    watermark : int
+        Start time of the last successful denormalization.
+    max_ids : int, optional
+        Maximum number of _ids in a $in list. The default is 100000.
+
+    Returns
+    -------
+    dict | None
+        {collection_name: query}, None if there are too many changed entities.
+    """
+    person_ids = changed_ids(db["person"], watermark)
+    affiliation_ids = changed_ids(db["affiliations"], watermark)
+    source_ids = changed_ids(db["sources"], watermark)
+    if max(len(person_ids), len(affiliation_ids), len(source_ids)) > max_ids:
+        return None
+    works_query = {"$or": [
+        {"updated.time": {"$gte": watermark}},
+        {"authors.id": {"$in": person_ids}},
+        {"authors.affiliations.id": {"$in": affiliation_ids}},
+        {"groups.id": {"$in": affiliation_ids}},
+        {"source.id": {"$in": source_ids}},
+    ]}
+    # a cursor instead of distinct, the result of distinct is a single document
+    sources = set(source_ids)
+    for reg in db["works"].aggregate([{"$match": works_query}, {"$group": {"_id": "$source.id"}}], allowDiskUse=True):
+        if reg["_id"] is not None:
+            sources.add(reg["_id"])
+        if len(sources) > max_ids:
+            return None
+    return {
+        "works": works_query,
+        "sources": {"_id": {"$in": list(sources)}},
+        "person": {"$or": [{"_id": {"$in": person_ids}}, {"affiliations.id": {"$in": affiliation_ids}}]},
+        "affiliations": {"_id": {"$in": affiliation_ids}},
+    }
+
+
+def denormalize(db, fused=False, batch_size=1000, verbose=0, n_jobs=1, queries=None):
     """
     Denormalize the data in all configured collections
 
@@ -2377,11 +2547,43 @@ def denormalize(db):
     ----------
     db : pymongo.database.Database
         Database object to denormalize
+    fused : bool, optional
+        If True, the works are denormalized in a single pass with denormalize_works
+        instead of running the aggregations of DENORMALIZATION_PIPELINES["works"] one by one.
+    batch_size : int, optional
+        Number of works per bulk write of the fused denormalization.
+    verbose : int, optional
+        Verbosity level of the fused denormalization.
+    n_jobs : int, optional
+        Number of _id ranges every pipeline is split in, the ranges are run concurrently.
+        The pipelines in PARTITION_UNSAFE are always run over the whole collection.
+    queries : dict, optional
+        {collection_name: query} to denormalize only the matching documents (see incremental_queries),
+        the pipelines in PARTITION_UNSAFE are always run over the whole collection.
     """
+    queries = queries if queries else {}
     for collection_name, pipelines in DENORMALIZATION_PIPELINES.items():
         collection = db[collection_name]
+        restriction = queries.get(collection_name)
 
         print(f"INFO: Denormalizing data in {collection_name}")
 
+        if fused and collection_name == "works":
+            denormalize_works(db, batch_size=batch_size, verbose=verbose, query=restriction)
+            continue
+
+        partitions = id_partitions(collection, n_jobs)
         for pipeline_func in pipelines:
-            pipeline_func(collection)
+            start = time()
+            if pipeline_func in PARTITION_UNSAFE:
+                pipeline_func(collection)
+            elif len(partitions) == 1:
+                run_partition(pipeline_func, collection, restriction, 0)
+            else:
+                timings = Parallel(n_jobs=n_jobs, backend="threading")(
+                    delayed(run_partition)(pipeline_func, collection, combine_queries(restriction, bounds), i) for i, bounds in enumerate(partitions))
+                if verbose > 4:
+                    for i, elapsed in timings:
+                        print(f"INFO: {pipeline_func.__name__} partition {i} done in {elapsed:.1f}s")
+            if verbose > 0:
+                print(f"INFO: {pipeline_func.__name__} done in {time() - start:.1f}s")
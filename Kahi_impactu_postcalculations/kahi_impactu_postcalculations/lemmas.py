@@ -0,0 +1,161 @@
+def title_lemmas(doc, stopwords):
+    """
+    Returns the lemmas of a processed title used to count the top words:
+    not numeric, not stopwords and with at least 4 characters.
+
+    Parameters
+    ----------
+    doc : spacy.tokens.Doc
+        The processed title.
+    stopwords : set
+        The stopwords to ignore.
+
+    Returns
+    -------
+    list
+        The lemmas in the order of the title.
+    """
+    lemmas = []
+    for token in doc:
+        if token.lemma_.isnumeric():
+            continue
+        if token.lemma_ in stopwords:
+            continue
+        if len(token.lemma_) < 4:
+            continue
+        lemmas.append(token.lemma_)
+    return lemmas
+
+
+def lemmatize(model, titles, stopwords, batch_size=1000, n_process=1):
+    """
+    Lemmatizes the titles with nlp.pipe, the parser and ner pipes are disabled because the lemmas do not need them.
+
+    Parameters
+    ----------
+    model : spacy.language.Language
+        The spaCy model.
+    titles : list
+        The titles (lowercase).
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int, optional
+        Number of titles per batch of nlp.pipe. The default is 1000.
+    n_process : int, optional
+        Number of processes of nlp.pipe. The default is 1.
+
+    Returns
+    -------
+    list
+        The list of lemmas of every title.
+    """
+    disable = [pipe for pipe in ["parser", "ner"] if pipe in model.pipe_names]
+    return [title_lemmas(doc, stopwords)
+            for doc in model.pipe(titles, batch_size=batch_size, n_process=n_process, disable=disable)]
+
+
+def build_lemma_cache(db_in, db_out, es_model, en_model, stopwords, batch_size=1000, n_process=1, chunk_size=50000, verbose=0):
+    """
+    Lemmatizes the title of every work once and stores the lemmas in the works_lemmas collection of the
+    calculations database ({"_id": work _id, "lemmas": [...]}), the top words of person and affiliations are
+    counted from this collection instead of processing the titles of every entity.
+
+    The works are read in chunks of chunk_size, the repeated titles of a chunk are processed once.
+
+    Parameters
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the works are stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemmas will be stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int, optional
+        Number of titles per batch of nlp.pipe. The default is 1000.
+    n_process : int, optional
+        Number of processes of nlp.pipe. The default is 1.
+    chunk_size : int, optional
+        Number of works read per chunk. The default is 50000.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    int
+        Number of works lemmatized.
+    """
+    db_out["works_lemmas"].drop()
+    count = 0
+    chunk = []
+    for work in db_in["works"].find({"titles.title": {"$exists": 1}}, {"titles": 1}):
+        chunk.append(work)
+        if len(chunk) == chunk_size:
+            count += store_chunk_lemmas(db_out, chunk, es_model, en_model, stopwords, batch_size, n_process)
+            chunk = []
+            if verbose > 4:
+                print(f"INFO: {count} titles lemmatized")
+    if chunk:
+        count += store_chunk_lemmas(db_out, chunk, es_model, en_model, stopwords, batch_size, n_process)
+    if verbose > 0:
+        print(f"INFO: {count} titles lemmatized")
+    return count
+
+
+def store_chunk_lemmas(db_out, works, es_model, en_model, stopwords, batch_size=1000, n_process=1):
+    """
+    Lemmatizes the titles of a chunk of works grouped by language and stores them in the works_lemmas collection.
+
+    Returns
+    -------
+    int
+        Number of works stored.
+    """
+    titles = {"es": {}, "en": {}}
+    for work in works:
+        lang = "es" if work["titles"][0].get("lang") == "es" else "en"
+        titles[lang].setdefault(work["titles"][0]["title"].lower(), [])
+    lemmas = {}
+    for lang, model in [("es", es_model), ("en", en_model)]:
+        texts = list(titles[lang].keys())
+        if texts:
+            lemmas[lang] = dict(zip(texts, lemmatize(model, texts, stopwords, batch_size, n_process)))
+    docs = []
+    for work in works:
+        lang = "es" if work["titles"][0].get("lang") == "es" else "en"
+        docs.append({"_id": work["_id"], "lemmas": lemmas[lang][work["titles"][0]["title"].lower()]})
+    db_out["works_lemmas"].insert_many(docs)
+    return len(docs)
+
+
+def count_lemmas(db_out, work_ids):
+    """
+    Counts the cached lemmas of the given works, the works are counted in the given order.
+
+    Parameters
+    ----------
+    db_out : pymongo.database.Database (calculation database)
+        The database with the works_lemmas collection.
+    work_ids : list
+        The _id of the works.
+
+    Returns
+    -------
+    dict
+        {lemma: count}
+    """
+    cached = {}
+    for start in range(0, len(work_ids), 10000):
+        for reg in db_out["works_lemmas"].find({"_id": {"$in": work_ids[start:start + 10000]}}):
+            cached[reg["_id"]] = reg["lemmas"]
+    results = {}
+    for _id in work_ids:
+        for lemma in cached.get(_id, []):
+            if lemma in results.keys():
+                results[lemma] += 1
+            else:
+                results[lemma] = 1
+    return results
@@ -0,0 +1,280 @@
+from array import array
+from math import log, exp
+
+
+class CoauthorshipIndex:
+    """
+    In-memory co-authorship structure of the works collection for person or affiliations,
+    built reading the works collection once.
+
+    The works with at most author_count authors are stored in compressed sparse row arrays:
+    the entries (person or affiliations, with repetitions) of every work and the inverted index
+    with the works of every entity. The entities are mapped to consecutive integers.
+    """
+
+    def __init__(self, collection, net, author_count, verbose=0):
+        """
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            The works collection.
+        net : str
+            "person" or "affiliations".
+        author_count : int
+            The maximum number of authors in a work to consider.
+        verbose : int, optional
+            Verbosity level. The default is 0.
+        """
+        if net not in ["affiliations", "person"]:
+            raise ValueError("Invalid network type options are affiliations or person")
+        self.net = net
+        self.entity_index = {}  # entity id -> int
+        self.entity_ids = []  # int -> entity id
+        self.labels = []  # int -> label of the first entry found
+        self.with_works = set()  # entities with at least one work (of any number of authors)
+        self.work_offsets = array("q", [0])
+        self.work_entries = array("q")
+        self.build(collection, author_count, verbose)
+
+    def entity(self, _id, label):
+        """
+        Returns the integer of an entity, registering it if it is new.
+        """
+        i = self.entity_index.get(_id)
+        if i is None:
+            i = len(self.entity_ids)
+            self.entity_index[_id] = i
+            self.entity_ids.append(_id)
+            self.labels.append(label)
+        return i
+
+    def work_ids(self, work):
+        """
+        Returns the (id, label) of the entries of a work: authors for person,
+        affiliations of every author for affiliations.
+        """
+        entries = []
+        for author in work.get("authors") or []:
+            if self.net == "person":
+                entries.append((author.get("id"), author.get("full_name")))
+            else:
+                for aff in author.get("affiliations") or []:
+                    entries.append((aff.get("id"), aff.get("name")))
+        return entries
+
+    def build(self, collection, author_count, verbose=0):
+        """
+        Reads the works collection and builds the arrays.
+        """
+        projection = {"author_count": 1, "authors.id": 1, "authors.full_name": 1} if self.net == "person" else {
+            "author_count": 1, "authors.affiliations.id": 1, "authors.affiliations.name": 1}
+        for count, work in enumerate(collection.find({}, projection)):
+            entries = [(_id, label) for _id, label in self.work_ids(work) if _id]
+            self.with_works.update(_id for _id, label in entries)
+            if "author_count" in work and work["author_count"] <= author_count:
+                self.work_entries.extend(self.entity(_id, label) for _id, label in entries)
+                self.work_offsets.append(len(self.work_entries))
+            if verbose > 4 and count % 100000 == 0:
+                print(f"INFO: {count} works read for the {self.net} co-authorship index")
+        # inverted index, the works of every entity (once per work) in the order they were read
+        n_entities = len(self.entity_ids)
+        counts = array("q", [0]) * (n_entities + 1)
+        for w in range(len(self.work_offsets) - 1):
+            for e in set(self.entries(w)):
+                counts[e + 1] += 1
+        for e in range(n_entities):
+            counts[e + 1] += counts[e]
+        self.entity_offsets = array("q", counts)
+        self.entity_works = array("q", [0]) * counts[n_entities]
+        position = array("q", counts[:n_entities])
+        for w in range(len(self.work_offsets) - 1):
+            for e in set(self.entries(w)):
+                self.entity_works[position[e]] = w
+                position[e] += 1
+
+    def entries(self, w):
+        """
+        Returns the entities (integers, with repetitions) of the work w.
+        """
+        return self.work_entries[self.work_offsets[w]:self.work_offsets[w + 1]]
+
+    def works(self, e):
+        """
+        Returns the works (integers) of the entity e.
+        """
+        return self.entity_works[self.entity_offsets[e]:self.entity_offsets[e + 1]]
+
+    def has_works(self, _id):
+        """
+        Returns True if the entity has at least one work.
+        """
+        return _id in self.with_works
+
+    def ego_network(self, _id, label):
+        """
+        Computes the co-authorship network of an entity, with the same rules of network_creation_person and
+        network_creation_affiliations: the edges of the entity count the works in common, and the edges between
+        two coauthors count the entries of one in the works of the other without the entity, in both directions.
+
+        Parameters
+        ----------
+        _id : str | ObjectId
+            The person or affiliation identifier.
+        label : str
+            The label of the entity.
+
+        Returns
+        -------
+        tuple
+            (nodes, nodes_labels, edges) where edges is a list of (nodea, nodeb, coauthorships)
+        """
+        idx = self.entity_index.get(_id)
+        if idx is None:
+            return [_id], [label], []
+        nodes = {idx: label}
+        edges = {}
+        for w in self.works(idx):
+            seen = set()
+            for e in self.entries(w):
+                if e == idx or e in seen:
+                    continue
+                seen.add(e)
+                if e not in nodes:
+                    nodes[e] = self.labels[e]
+                edges[(idx, e)] = edges.get((idx, e), 0) + 1
+        # adding the connections between the coauthors
+        for node in list(nodes.keys()):
+            if node == idx:
+                continue
+            for w in self.works(node):
+                entries = self.entries(w)
+                if idx in entries:
+                    continue
+                for e in entries:
+                    if e not in nodes or e == node:
+                        continue
+                    if (node, e) in edges:
+                        edges[(node, e)] += 1
+                    elif (e, node) in edges:
+                        edges[(e, node)] += 1
+                    else:
+                        edges[(node, e)] = 1
+        ids = self.entity_ids
+        return ([ids[node] for node in nodes.keys()], list(nodes.values()),
+                [(ids[a], ids[b], coauthorships) for (a, b), coauthorships in edges.items()])
+
+
+def network_record(nodes, nodes_labels, edges):
+    """
+    Builds the nodes and edges of a co-authorship network in the format stored in the database,
+    with the degree and size of the nodes and the size of the edges.
+
+    Parameters
+    ----------
+    nodes : list
+        The identifiers of the nodes.
+    nodes_labels : list
+        The labels of the nodes.
+    edges : list
+        List of (nodea, nodeb, coauthorships)
+
+    Returns
+    -------
+    tuple
+        (nodes_db, edges_db)
+    """
+    degrees = {}
+    for nodea, nodeb, coauthorships in edges:
+        degrees[nodea] = degrees.get(nodea, 0) + 1
+        degrees[nodeb] = degrees.get(nodeb, 0) + 1
+    num_nodes = len(nodes)
+    nodes_db = []
+    for i, node in enumerate(nodes):
+        degree = degrees.get(node, 0)
+        size = 50 * log(1 + degree / (num_nodes - 1),
+                        2) if num_nodes > 1 else 1
+        nodes_db.append(
+            {
+                "id": str(node),
+                "label": nodes_labels[i],
+                "degree": degree,
+                "size": size
+            }
+        )
+    edges_db = []
+    for nodea, nodeb, coauthorships in edges:
+        edges_db.append({
+            "source": str(nodea),
+            "target": str(nodeb),
+            "coauthorships": coauthorships,
+            "size": coauthorships,
+        })
+    top = max([e["coauthorships"]
+              for e in edges_db]) if len(edges_db) > 0 else 1
+    bot = min([e["coauthorships"]
+              for e in edges_db]) if len(edges_db) > 0 else 1
+    for edge in edges_db:
+        if abs(top - edge["coauthorships"]) < 0.01:
+            edge["size"] = 10
+        elif abs(bot - edge["coauthorships"]) < 0.01:
+            edge["size"] = 1
+        else:
+            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
+            edge["size"] = size if size >= 1 else 1
+    return nodes_db, edges_db
+
+
+def save_network(db_out, net, idx, nodes_db, edges_db):
+    """
+    Saves a co-authorship network in the calculations database, the edges of the affiliations networks
+    are split in halves between the affiliations and affiliations_edges collections.
+    """
+    if net == "person":
+        db_out["person"].update_one({"_id": idx}, {"$set": {"coauthorship_network": {
+            "nodes": nodes_db, "edges": edges_db}}}, upsert=True)
+        return
+    nedges = int(len(edges_db) / 2)
+    try:
+        db_out["affiliations"].update_one(
+            {"_id": idx, }, {"$set": {"coauthorship_network": {"nodes": nodes_db, "edges": edges_db[0:nedges]}}}, upsert=True)
+        db_out["affiliations_edges"].update_one(
+            {"_id": idx, }, {"$set": {"coauthorship_network": {"edges": edges_db[nedges:]}}}, upsert=True)
+    except Exception as e:
+        print(f"too big network for id {idx}", e)
+
+
+def network_creation_from_index(db_in, db_out, index, idx):
+    """
+    Function to create the network of coauthorships for an affiliation or author from a CoauthorshipIndex,
+    no works are read from the database.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the information will be stored.
+    index : CoauthorshipIndex
+        The co-authorship index of the type of network (person or affiliations).
+    idx : str
+        The affiliation or author identifier.
+    """
+    already = db_out[index.net].find_one(
+        {"_id": idx, "coauthorship_network": {"$exists": True}}, {"_id": 1})
+    if already:
+        return None
+    if index.net == "person":
+        info = db_in["person"].find_one({"_id": idx}, {"full_name": 1})
+        name = info["full_name"]
+    else:
+        info = db_in["affiliations"].find_one({"_id": idx}, {"names": 1})
+        name = info["names"][0]["name"]
+        for n in info["names"]:
+            if n["lang"] == "es":
+                name = n["name"]
+                break
+            elif n["lang"] == "en":
+                name = n["name"]
+    nodes, nodes_labels, edges = index.ego_network(idx, name)
+    nodes_db, edges_db = network_record(nodes, nodes_labels, edges)
+    save_network(db_out, index.net, idx, nodes_db, edges_db)
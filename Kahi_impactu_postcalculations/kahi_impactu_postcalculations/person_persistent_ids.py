@@ -1,45 +1,66 @@
-import sys
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 
-def process_person_id(client, person_col, works_col, person, source):
+def person_pid(person, source):
     """
-    Process the person ID based on the source and update the MongoDB collection.
+    Computes the persistent ID of a person for the given source.
     Parameters:
     ---------
-    client: MongoDB client
-    person_col: MongoDB collection for person
-    works_col: MongoDB collection for works
     person: dict
-        The person document to process
+        The person document (with external_ids)
     source: str
         The source of the person ID (e.g., "mongodb_id", "scienti", etc.)
-    """
 
-    original_id = person["_id"]
+    Returns:
+    ---------
+    str
+        The persistent ID or None if the person has no ID for the source
+    """
     pid = None  # person id
 
     if source == "mongodb_id":
-        pid = str(original_id)
+        pid = str(person["_id"])
     else:
         for ext_id in person.get("external_ids", []):
             if ext_id.get("source") == source:
                 pid = ext_id.get("id", {})
                 break
+    if not pid:
+        return None
     if source == "scienti":
         # Si el source es 'scienti', buscar COD_RH en el campo 'id'
         pid = pid.get("COD_RH", None)
     else:
         pid = pid.split("/")[-1].replace("-", "").split("=")[-1]
+    return pid if pid else None
+
+
+def process_person_id(client, person_col, works_col, person, source):
+    """
+    Process the person ID based on the source and update the MongoDB collection.
+    Parameters:
+    ---------
+    client: MongoDB client
+    person_col: MongoDB collection for person
+    works_col: MongoDB collection for works
+    person: dict
+        The person document to process
+    source: str
+        The source of the person ID (e.g., "mongodb_id", "scienti", etc.)
+    """
+
+    original_id = person["_id"]
+    pid = person_pid(person, source)
 
     if not pid:
-        # Si no hay COD_RH, generar ID basado en ObjectId
         print(
             "ERROR: No hay id para el documento:",
             original_id,
             "source:",
             source,
         )
-        sys.exit(1)
+        return None
     opid = pid
 
     # Insertar con nuevo _id
@@ -63,3 +84,254 @@ def process_person_id(client, person_col, works_col, person, source):
         {"$set": {"authors.$[author].id": pid}},
         array_filters=[{"author.id": original_id}],
     )
+
+
+def person_id_mapping(person_col, sources, verbose=0):
+    """
+    Computes the persistent ID of every person not migrated yet, following the priority of the sources:
+    every person gets the ID of the first source where it has one that is not used by other person.
+
+    Parameters:
+    ---------
+    person_col: MongoDB collection for person
+    sources: list
+        The sources of the person ID in priority order (e.g., ["scienti", "orcid", ..., "mongodb_id"])
+    verbose: int
+        Verbosity level
+
+    Returns:
+    ---------
+    tuple
+        (mapping, errors) where mapping is {original _id: persistent ID} and errors is a list of
+        (original _id, source, reason) of the persons without ID or with an ID already used
+    """
+    taken = set(person["_id"] for person in person_col.find({}, {"_id": 1}))
+    mapping = {}
+    errors = []
+    for source in sources:
+        query = {"_id_old": {"$exists": False}}
+        if source != "mongodb_id":
+            query["external_ids.source"] = source
+        count = 0
+        for person in person_col.find(query, {"external_ids": 1}):
+            if person["_id"] in mapping:
+                continue
+            pid = person_pid(person, source)
+            if not pid:
+                errors.append((person["_id"], source, "no id"))
+                continue
+            if pid in taken:
+                errors.append((person["_id"], source, f"id {pid} already used"))
+                continue
+            mapping[person["_id"]] = pid
+            taken.add(pid)
+            count += 1
+        if verbose > 0:
+            print(f"INFO: {count} persistent ids from {source}")
+    return mapping, errors
+
+
+def supports_transactions(client):
+    """
+    Checks if the server supports transactions (replica set or sharded cluster), a standalone mongod rejects them.
+    Parameters:
+    ---------
+    client: MongoDB client
+
+    Returns:
+    ---------
+    bool
+        True if the server is a member of a replica set or a mongos
+    """
+    hello = client.admin.command("ismaster")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+def migrate_person_batch(client, person_col, batch, transactions=True):
+    """
+    Replaces the _id of a batch of persons, in a single transaction if transactions is True.
+    Without transactions (standalone server) the new documents are inserted first and only the
+    persons whose new document was inserted are deleted, a crash in between leaves both documents
+    and the old one is removed by remove_migrated_leftovers in the next run.
+    Parameters:
+    ---------
+    client: MongoDB client
+    person_col: MongoDB collection for person
+    batch: dict
+        {original _id: persistent ID}
+    transactions: bool
+        If True the batch is migrated in a transaction
+
+    Returns:
+    ---------
+    dict
+        {original _id: persistent ID} of the persons migrated
+    """
+    new_docs = []
+    for person in person_col.find({"_id": {"$in": list(batch.keys())}}):
+        new_doc = person.copy()
+        new_doc["_id"] = batch[person["_id"]]
+        new_doc["_id_old"] = person["_id"]
+        new_docs.append(new_doc)
+    if not new_docs:
+        return {}
+    if not transactions:
+        failed = set()
+        try:
+            person_col.insert_many(new_docs, ordered=False)
+        except BulkWriteError as e:
+            failed = set(error["index"] for error in e.details["writeErrors"])
+            print(f"Error insertando nuevos _id en person: {len(failed)} documentos")
+        inserted = {doc["_id_old"]: doc["_id"] for i, doc in enumerate(new_docs) if i not in failed}
+        person_col.delete_many({"_id": {"$in": list(inserted.keys())}})
+        return inserted
+    with client.start_session() as session:
+        try:
+            with session.start_transaction():  # atomic operation
+                person_col.insert_many(new_docs, session=session)
+                person_col.delete_many({"_id": {"$in": list(batch.keys())}}, session=session)
+        except Exception as e:
+            print(f"Error insertando nuevos _id en person: {e}")
+            return {}
+    return {doc["_id_old"]: doc["_id"] for doc in new_docs}
+
+
+def migrated_mapping(person_col):
+    """
+    Returns the mapping of all the persons already migrated, from the _id_old field.
+    Parameters:
+    ---------
+    person_col: MongoDB collection for person
+
+    Returns:
+    ---------
+    dict
+        {original _id: persistent ID}
+    """
+    return {person["_id_old"]: person["_id"] for person in person_col.find({"_id_old": {"$exists": True}}, {"_id_old": 1})}
+
+
+def remove_migrated_leftovers(person_col, mapping, batch_size=1000):
+    """
+    Deletes the old documents of persons already migrated (left by a crash of a migration without transactions).
+    Parameters:
+    ---------
+    person_col: MongoDB collection for person
+    mapping: dict
+        {original _id: persistent ID} of the migrated persons
+    batch_size: int
+        Number of _ids per delete
+
+    Returns:
+    ---------
+    int
+        Number of documents deleted
+    """
+    count = 0
+    old_ids = list(mapping.keys())
+    for start in range(0, len(old_ids), batch_size):
+        count += person_col.delete_many({"_id": {"$in": old_ids[start:start + batch_size]},
+                                         "_id_old": {"$exists": False}}).deleted_count
+    return count
+
+
+def rewrite_works_authors(works_col, mapping, batch_size=1000, verbose=0):
+    """
+    Replaces the old person IDs of works.authors.id with the persistent IDs in one pass over the works,
+    the works are updated with one bulk write every batch_size works.
+    Parameters:
+    ---------
+    works_col: MongoDB collection for works
+    mapping: dict
+        {original _id: persistent ID}
+    batch_size: int
+        Number of updates per bulk write
+    verbose: int
+        Verbosity level
+
+    Returns:
+    ---------
+    int
+        Number of works updated
+    """
+    count = 0
+    updates = []
+    for work in works_col.find({"authors.id": {"$exists": True}}, {"authors.id": 1}):
+        fields = {}
+        for i, author in enumerate(work["authors"]):
+            if author.get("id") in mapping:
+                fields[f"authors.{i}.id"] = mapping[author["id"]]
+        if fields:
+            updates.append(UpdateOne({"_id": work["_id"]}, {"$set": fields}))
+        if len(updates) == batch_size:
+            works_col.bulk_write(updates, ordered=False)
+            count += len(updates)
+            updates = []
+            if verbose > 4:
+                print(f"INFO: {count} works updated with persistent ids")
+    if updates:
+        works_col.bulk_write(updates, ordered=False)
+        count += len(updates)
+    return count
+
+
+def migrate_person_ids(client, person_col, works_col, sources, batch_size=1000, verbose=0):
+    """
+    Bulk migration of the person IDs to persistent IDs: computes the mapping of all the persons first,
+    replaces the persons in batched transactions (batched writes without transactions if the server is standalone)
+    and rewrites works.authors.id in a single pass.
+    The works are rewritten with the mapping of all the migrated persons (_id_old), including the ones of a
+    previous run that crashed before rewriting the works.
+    The persons without ID are reported at the end instead of stopping the migration.
+    Parameters:
+    ---------
+    client: MongoDB client
+    person_col: MongoDB collection for person
+    works_col: MongoDB collection for works
+    sources: list
+        The sources of the person ID in priority order
+    batch_size: int
+        Number of persons per transaction and works per bulk write
+    verbose: int
+        Verbosity level
+
+    Returns:
+    ---------
+    list
+        (original _id, source, reason) of the persons that could not be migrated
+    """
+    transactions = supports_transactions(client)
+    if not transactions:
+        print("WARNING: the server does not support transactions, the persons are migrated without them")
+    leftovers = remove_migrated_leftovers(person_col, migrated_mapping(person_col), batch_size)
+    if leftovers and verbose > 0:
+        print(f"INFO: {leftovers} persons of a previous migration removed")
+    mapping, errors = person_id_mapping(person_col, sources, verbose)
+    migrated = {}
+    items = list(mapping.items())
+    for start in range(0, len(items), batch_size):
+        batch = dict(items[start:start + batch_size])
+        done = migrate_person_batch(client, person_col, batch, transactions)
+        migrated.update(done)
+        if len(done) == len(batch):
+            continue
+        # one person at a time, to migrate the rest of the batch
+        for original_id, pid in batch.items():
+            if original_id in done:
+                continue
+            if migrate_person_batch(client, person_col, {original_id: pid}, transactions):
+                migrated[original_id] = pid
+            else:
+                errors.append((original_id, None, "migration failed"))
+    if verbose > 0:
+        print(f"INFO: {len(migrated)} persons migrated to persistent ids")
+    count = rewrite_works_authors(works_col, migrated_mapping(person_col), batch_size, verbose)
+    if verbose > 0:
+        print(f"INFO: {count} works updated with persistent ids")
+    # the persons migrated with a later source are not errors
+    errors = [error for error in errors if error[0] not in migrated]
+    if errors:
+        print(f"ERROR: {len(errors)} persons without persistent id")
+        for original_id, source, reason in errors:
+            print("ERROR: No hay id para el documento:", original_id, "source:", source, reason)
+    return errors
@@ -1,6 +1,7 @@
-from math import log, exp
 from pymongo import MongoClient
 from spacy import load
+from kahi_impactu_postcalculations.networks import network_record, save_network
+from kahi_impactu_postcalculations.lemmas import count_lemmas
 
 # for multiprocessing have to be loaded global
 en_model = None
@@ -172,68 +173,16 @@ def network_creation_affiliations(db_in, db_out, idx, author_count):
                         edges_coauthorships[str(node) + str(aff["id"])] = 1
                         edges.append((node, aff["id"]))
     # Constructing the actual format to insrt in db
-    num_nodes = len(nodes)
-    nodes_db = []
-    for i, node in enumerate(nodes):
-        degree = len([1 for i, j in edges if i == node or j == node])
-        size = 50 * log(1 + degree / (num_nodes - 1),
-                        2) if num_nodes > 1 else 1
-        nodes_db.append(
-            {
-                "id": str(node),
-                "label": nodes_labels[i],
-                "degree": degree,
-                "size": size
-            }
-        )
-    edges_db = []
+    edges_weights = []
     for nodea, nodeb in edges:
         coauthorships = 0
         if str(nodea) + str(nodeb) in edges_coauthorships.keys():
             coauthorships = edges_coauthorships[str(nodea) + str(nodeb)]
         elif str(nodeb) + str(nodea) in edges_coauthorships.keys():
             coauthorships = edges_coauthorships[str(nodeb) + str(nodea)]
-        edges_db.append({
-            "source": str(nodea),
-            "target": str(nodeb),
-            "coauthorships": coauthorships,
-            "size": coauthorships,
-        })
-    top = max([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    bot = min([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    for edge in edges_db:
-        if abs(top - edge["coauthorships"]) < 0.01:
-            edge["size"] = 10
-        elif abs(bot - edge["coauthorships"]) < 0.01:
-            edge["size"] = 1
-        else:
-            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
-            edge["size"] = size if size >= 1 else 1
-    record = {
-        "coauthorship_network": {
-            "nodes": nodes_db,
-            "edges": edges_db
-        }
-    }
-    try:
-        record_edges = {
-            "coauthorship_network": {
-                "edges": edges_db
-            }
-        }
-        nedges = int(len(record["coauthorship_network"]["edges"]) / 2)
-
-        record["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][0:nedges]
-
-        record_edges["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][nedges:]
-        db_out["affiliations"].update_one(
-            {"_id": idx, }, {"$set": record}, upsert=True)
-        db_out["affiliations_edges"].update_one(
-            {"_id": idx, }, {"$set": record_edges}, upsert=True)
-    except Exception as e:
-        print(f"too big network for id {record['_id']}", e)
+        edges_weights.append((nodea, nodeb, coauthorships))
+    nodes_db, edges_db = network_record(nodes, nodes_labels, edges_weights)
+    save_network(db_out, "affiliations", idx, nodes_db, edges_db)
 
 
 def network_creation_person(db_in, db_out, idx, author_count):
@@ -323,50 +272,19 @@ def network_creation_person(db_in, db_out, idx, author_count):
                     edges_coauthorships[str(node) + str(author["id"])] = 1
                     edges.append((node, author["id"]))
     # Constructing the actual format to insrt in db
-    num_nodes = len(nodes)
-    nodes_db = []
-    for i, node in enumerate(nodes):
-        degree = len([1 for i, j in edges if i == node or j == node])
-        size = 50 * log(1 + degree / (num_nodes - 1),
-                        2) if num_nodes > 1 else 1
-        nodes_db.append(
-            {
-                "id": str(node),
-                "label": nodes_labels[i],
-                "degree": degree,
-                "size": size
-            }
-        )
-    edges_db = []
+    edges_weights = []
     for nodea, nodeb in edges:
         coauthorships = 0
         if str(nodea) + str(nodeb) in edges_coauthorships.keys():
             coauthorships = edges_coauthorships[str(nodea) + str(nodeb)]
         elif str(nodeb) + str(nodea) in edges_coauthorships.keys():
             coauthorships = edges_coauthorships[str(nodeb) + str(nodea)]
-        edges_db.append({
-            "source": str(nodea),
-            "target": str(nodeb),
-            "coauthorships": coauthorships,
-            "size": coauthorships,
-        })
-    top = max([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    bot = min([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    for edge in edges_db:
-        if abs(top - edge["coauthorships"]) < 0.01:
-            edge["size"] = 10
-        elif abs(bot - edge["coauthorships"]) < 0.01:
-            edge["size"] = 1
-        else:
-            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
-            edge["size"] = size if size >= 1 else 1
-    db_out["person"].update_one({"_id": idx}, {"$set": {"coauthorship_network": {
-        "nodes": nodes_db, "edges": edges_db}}}, upsert=True)
+        edges_weights.append((nodea, nodeb, coauthorships))
+    nodes_db, edges_db = network_record(nodes, nodes_labels, edges_weights)
+    save_network(db_out, "person", idx, nodes_db, edges_db)
 
 
-def top_words_process_one(config, client, impactu_client, aff, stopwords, top_words, backend):
+def top_words_process_one(config, client, impactu_client, aff, stopwords, top_words, backend, lemmas_cache=False, members=None):
     """
     Function to create the network of coauthorships for an affiliation or author.
 
@@ -386,6 +304,10 @@ def top_words_process_one(config, client, impactu_client, aff, stopwords, top_wo
         The network type, either affiliations or authors.
     backend : str
         The backend to use for the parallel processing. "mutiprocessing" or "threading".
+    lemmas_cache : bool, optional
+        If True the lemmas are read from the works_lemmas collection (see lemmas.build_lemma_cache). The default is False.
+    members : list, optional
+        The person ids of the affiliation, used for "affiliations_others". The default is None.
     """
     global en_model
     global es_model
@@ -403,18 +325,19 @@ def top_words_process_one(config, client, impactu_client, aff, stopwords, top_wo
 
     if top_words == "affiliations":
         top_words_affiliations(
-            db_in, db_out, aff, es_model, en_model, stopwords)
+            db_in, db_out, aff, es_model, en_model, stopwords, lemmas_cache)
     if top_words == "affiliations_others":
         top_words_affiliations_others(
-            db_in, db_out, aff, es_model, en_model, stopwords)
+            db_in, db_out, aff, es_model, en_model, stopwords, lemmas_cache, members)
     if top_words == "person":
-        top_words_person(db_in, db_out, aff, es_model, en_model, stopwords)
+        top_words_person(db_in, db_out, aff, es_model,
+                         en_model, stopwords, lemmas_cache)
     if backend != "threading":
         client.close()
         impactu_client.close()
 
 
-def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
+def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords, lemmas_cache=False):
     """
     Function to get the top words for an affiliation.
 
@@ -434,13 +357,20 @@ def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    lemmas_cache : bool, optional
+        If True the lemmas of the titles are read from the works_lemmas collection. The default is False.
     """
     aff_db = db_out["affiliations"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
         return
     results = {}
-    for work in db_in["works"].find({"authors.affiliations.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
+    works = db_in["works"].find({"authors.affiliations.id": aff["_id"], "titles.title": {"$exists": 1}},
+                                {"_id": 1} if lemmas_cache else {"titles": 1})
+    if lemmas_cache:
+        results = count_lemmas(db_out, [work["_id"] for work in works])
+        works = []
+    for work in works:
         title = work["titles"][0]["title"].lower()
         lang = work["titles"][0]["lang"]
         if lang == "es":
@@ -472,11 +402,38 @@ def top_words_affiliations(db_in, db_out, aff, es_model, en_model, stopwords):
             {"_id": aff["_id"], "top_words": results})
 
 
-def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwords):
+def unit_members(db_in, unit_ids):
+    """
+    Function to get the authors of every faculty, department or group, reading the person collection once.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    unit_ids : list
+        The identifiers of the affiliations.
+
+    Returns:
+    -------
+    dict
+        {affiliation id: list of person ids}
+    """
+    units = set(unit_ids)
+    members = {}
+    for author in db_in["person"].find({"affiliations.id": {"$in": list(units)}}, {"affiliations.id": 1}):
+        for aff_id in set(aff.get("id") for aff in author.get("affiliations") or []):
+            if aff_id in units:
+                members.setdefault(aff_id, []).append(author["_id"])
+    return members
+
+
+def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwords, lemmas_cache=False, members=None):
     """
     Function to get the top words for an affiliation for other than institutions, such as group, department, faculty.
 
-    This algorithm gets the top words for an affiliation based on the titles of the works of the authors of the affiliation.
+    This algorithm gets the top words for an affiliation based on the titles of the works of the authors of the affiliation,
+    every work is counted once even if several authors of the affiliation are in it.
+    If the affiliation has no members (or their works give no words) the top words already stored are kept.
 
     Parameters:
     ----------
@@ -492,31 +449,46 @@ def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwo
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    lemmas_cache : bool, optional
+        If True the lemmas of the titles are read from the works_lemmas collection. The default is False.
+    members : list, optional
+        The person ids of the affiliation (see unit_members), if None they are read from the database.
     """
     aff_db = db_out["affiliations"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
+        if members is None:
+            members = [author["_id"] for author in db_in["person"].find({"affiliations.id": aff["_id"]}, {"_id": 1})]
+        if not members:
+            # units without members keep the top words computed from their own works
+            return
         results = {}
-        for author in db_in["person"].find({"affiliations.id": aff["_id"]}):
-            for work in db_in["works"].find({"authors.id": author["_id"], "titles.title": {"$exists": 1}}):
-                title = work["titles"][0]["title"].lower()
-                lang = work["titles"][0]["lang"]
-                if lang == "es":
-                    model = es_model
+        works = db_in["works"].find({"authors.id": {"$in": members}, "titles.title": {"$exists": 1}},
+                                    {"_id": 1} if lemmas_cache else {"titles": 1})
+        if lemmas_cache:
+            results = count_lemmas(db_out, [work["_id"] for work in works])
+            works = []
+        for work in works:
+            title = work["titles"][0]["title"].lower()
+            lang = work["titles"][0]["lang"]
+            if lang == "es":
+                model = es_model
+            else:
+                model = en_model
+            title = model(title)
+            for token in title:
+                if token.lemma_.isnumeric():
+                    continue
+                if token.lemma_ in stopwords:
+                    continue
+                if len(token.lemma_) < 4:
+                    continue
+                if token.lemma_ in results.keys():
+                    results[token.lemma_] += 1
                 else:
-                    model = en_model
-                title = model(title)
-                for token in title:
-                    if token.lemma_.isnumeric():
-                        continue
-                    if token.lemma_ in stopwords:
-                        continue
-                    if len(token.lemma_) < 4:
-                        continue
-                    if token.lemma_ in results.keys():
-                        results[token.lemma_] += 1
-                    else:
-                        results[token.lemma_] = 1
+                    results[token.lemma_] = 1
+        if not results:
+            return
         topN = sorted(results.items(), key=lambda x: x[1], reverse=True)[:20]
         results = []
         for top in topN:
@@ -525,7 +497,7 @@ def top_words_affiliations_others(db_in, db_out, aff, es_model, en_model, stopwo
             {"_id": aff["_id"]}, {"$set": {"top_words": results}})
 
 
-def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords):
+def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords, lemmas_cache=False):
     """
     Function to get the top words for an author.
 
@@ -545,13 +517,20 @@ def top_words_person(db_in, db_out, aff, es_model, en_model, stopwords):
         The English model for the NLP.
     stopwords : list
         The list of stopwords to ignore.
+    lemmas_cache : bool, optional
+        If True the lemmas of the titles are read from the works_lemmas collection. The default is False.
     """
     aff_db = db_out["person"].find_one(
         {"_id": aff["_id"], "top_words": {"$exists": 1}})
     if aff_db:
         return
     results = {}
-    for work in db_in["works"].find({"authors.id": aff["_id"], "titles.title": {"$exists": 1}}, {"titles": 1}):
+    works = db_in["works"].find({"authors.id": aff["_id"], "titles.title": {"$exists": 1}},
+                                {"_id": 1} if lemmas_cache else {"titles": 1})
+    if lemmas_cache:
+        results = count_lemmas(db_out, [work["_id"] for work in works])
+        works = []
+    for work in works:
         title = work["titles"][0]["title"].lower()
         lang = work["titles"][0]["lang"]
         if lang == "es":
@@ -0,0 +1,85 @@
+from time import time
+import traceback
+
+
+class StageRunner:
+    """
+    Runs the stages of the post calculations recording their metrics and progress.
+
+    Every stage saves a document in the metrics collection with the start, end, duration, status and
+    the counts returned by the stage. The completed stages of the current run are saved in the checkpoints
+    collection, if the run fails the next one resumes from the first stage not completed.
+    """
+
+    def __init__(self, log_db, key, run_id, resume=True, verbose=0):
+        """
+        Parameters
+        ----------
+        log_db : pymongo.database.Database
+            Database with the checkpoints and postcalculations_metrics collections.
+        key : str
+            Checkpoint key of the runs, ex: impactu_postcalculations/<database_name>/stages
+        run_id : int
+            Identifier of the run (start time), used if the previous run was completed.
+        resume : bool, optional
+            If True the stages completed by an unfinished previous run are skipped. The default is True.
+        verbose : int, optional
+            Verbosity level. The default is 0.
+        """
+        self.metrics = log_db["postcalculations_metrics"]
+        self.checkpoints = log_db["checkpoints"]
+        self.key = key
+        self.verbose = verbose
+        reg = self.checkpoints.find_one({"_id": key})
+        if resume and reg and not reg.get("done", True):
+            self.run_id = reg["run"]
+            self.completed = set(reg.get("completed", []))
+            print(f"INFO: Resuming the run {self.run_id}, completed stages {sorted(self.completed)}")
+        else:
+            self.run_id = run_id
+            self.completed = set()
+            self.checkpoints.update_one({"_id": key}, {"$set": {"run": run_id, "completed": [], "done": False}}, upsert=True)
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs a stage if it was not completed in the current run.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        func : callable
+            Function of the stage, it can return a dict with the counts of documents processed.
+
+        Returns
+        -------
+        dict
+            The counts returned by the stage, None if the stage was already completed.
+        """
+        if name in self.completed:
+            print(f"INFO: Stage {name} already completed in the run {self.run_id}, skipping")
+            return None
+        print(f"INFO: Running stage {name}")
+        start = time()
+        metrics = {"key": self.key, "run": self.run_id, "stage": name, "start": start}
+        try:
+            counts = func(*args, **kwargs)
+        except Exception as e:
+            metrics.update({"end": time(), "duration": time() - start, "status": "failed",
+                            "error": str(e), "traceback": traceback.format_exc()})
+            self.metrics.insert_one(metrics)
+            raise
+        end = time()
+        metrics.update({"end": end, "duration": end - start, "status": "completed", "counts": counts or {}})
+        self.metrics.insert_one(metrics)
+        self.completed.add(name)
+        self.checkpoints.update_one({"_id": self.key}, {"$addToSet": {"completed": name}})
+        if self.verbose > 0:
+            print(f"INFO: Stage {name} completed in {end - start:.2f} s {counts or ''}")
+        return counts
+
+    def finish(self):
+        """
+        Marks the run as done, the next run starts from the first stage.
+        """
+        self.checkpoints.update_one({"_id": self.key}, {"$set": {"done": True}})
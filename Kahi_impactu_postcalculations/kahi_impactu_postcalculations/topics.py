@@ -1,3 +1,7 @@
+from joblib import Parallel, delayed
+from pymongo import UpdateOne
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 
 type_url_base = "https://openalex.org/T"
@@ -37,7 +41,75 @@ def request_topic_inference(title, abstract={}, journal_name="", inference_endpo
     return req
 
 
-def get_openalex_topic(col_oa, topic_pred):
+def inference_session(pool_size=10, max_retries=3, backoff_factor=1):
+    """
+    Creates a requests session for the inference service, with a pool of keep-alive connections
+    and retries with exponential backoff for connection errors and 429/5xx responses.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Maximum number of connections kept in the pool, by default 10
+    max_retries : int, optional
+        Maximum number of retries of every request, by default 3
+    backoff_factor : float, optional
+        Backoff factor of the retries (backoff_factor * 2 ** retry seconds), by default 1
+
+    Returns
+    -------
+    requests.Session
+        Session for the inference requests
+    """
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def topic_payload(work):
+    """
+    Builds the inference payload of a work, the same sent by request_topic_inference
+
+    Parameters
+    ----------
+    work : dict
+        Work with titles, abstracts and source
+
+    Returns
+    -------
+    dict
+        Payload of the work, None if the work has no abstracts
+    """
+    if len(work["abstracts"]) == 0:
+        return None
+    return {"title": work["titles"][0]["title"],
+            "abstract_inverted_index": work["abstracts"][0]["abstract"],
+            "inverted": True,
+            "referenced_works": [],
+            "journal_display_name": work["source"]["name"] if work["source"] != {} else ""}
+
+
+def load_openalex_topics(col_oa):
+    """
+    Loads in memory the OpenAlex topics collection
+
+    Parameters
+    ----------
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+
+    Returns
+    -------
+    dict
+        Topics by id (URL of the topic)
+    """
+    return {topic["id"]: topic for topic in col_oa.find({}, {"id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1})}
+
+
+def get_openalex_topic(col_oa, topic_pred, topics=None):
     """
     Retrieve the topic from OpenAlex based on the prediction,
     and add the score of the prediction to the topic.
@@ -57,6 +129,8 @@ def get_openalex_topic(col_oa, topic_pred):
         Prediction of the topic, with the following fields:
         - topic_id: ID of the topic
         - topic_score: Score of the prediction
+    topics : dict, optional
+        Topics loaded with load_openalex_topics, if given the collection is not queried, by default None
 
     Returns
     -------
@@ -65,8 +139,11 @@ def get_openalex_topic(col_oa, topic_pred):
 
     """
     topic_url = type_url_base + str(topic_pred['topic_id'])
-    topic = col_oa.find_one({"id": topic_url}, {
-                            "id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1})
+    if topics is not None:
+        topic = dict(topics[topic_url]) if topic_url in topics else None
+    else:
+        topic = col_oa.find_one({"id": topic_url}, {
+                                "id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1})
     if topic is None:
         topic = {"id": topic_pred['topic_id'], "display_name": "Unknown",
                  "subfield": "Unknown", "field": "Unknown", "domain": "Unknown"}
@@ -113,3 +190,115 @@ def process_topic(col, col_oa, work, inference_endpoint="http://localhost:8080/i
     else:
         print(
             f"ERROR: request for inference fails status code {req.status_code}\n", work)
+
+
+def process_topics_batch(col, topics, works, session, inference_endpoint="http://localhost:8080/invocations", timeout=300):
+    """
+    Process the topic inference for a batch of works with a single request to the inference service,
+    the works are updated with one bulk write.
+
+    Parameters
+    ----------
+    col : pymongo.collection.Collection
+        Collection of the works (kahi database)
+    topics : dict
+        Topics loaded with load_openalex_topics
+    works : list
+        Works to process
+    session : requests.Session
+        Session created with inference_session
+    inference_endpoint : str, optional
+        Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    timeout : int, optional
+        Timeout of the request in seconds, by default 300
+    """
+    works = [work for work in works if len(work["abstracts"]) != 0]
+    if not works:
+        return
+    try:
+        req = session.post(inference_endpoint, json=[topic_payload(work) for work in works], timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"ERROR: request for inference fails {e}\n", [work["_id"] for work in works])
+        return
+    if req.status_code != 200:
+        print(
+            f"ERROR: request for inference fails status code {req.status_code}\n", [work["_id"] for work in works])
+        return
+    topics_ids_pred = req.json()
+    if len(topics_ids_pred) != len(works):
+        print(
+            f"ERROR: inference returned {len(topics_ids_pred)} predictions for {len(works)} works\n", [work["_id"] for work in works])
+        return
+    updates = []
+    for work, topics_pred in zip(works, topics_ids_pred):
+        for topic_pred in topics_pred:
+            topic = get_openalex_topic(None, topic_pred, topics)
+            if work["primary_topic"] == {}:
+                work["primary_topic"] = topic
+            work["topics"].append(topic)
+        updates.append(UpdateOne({"_id": work["_id"]}, {
+                       "$set": {"primary_topic": work["primary_topic"], "topics": work["topics"]}}))
+    col.bulk_write(updates, ordered=False)
+
+
+def batches(cursor, batch_size):
+    """
+    Yields lists of batch_size documents of the cursor
+    """
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_topics(col, col_oa, works, inference_endpoint="http://localhost:8080/invocations", batch_size=32, n_jobs=4,
+                   max_retries=3, backoff_factor=1, timeout=300, verbose=0):
+    """
+    Process the topic inference for the works in batches of batch_size works per request, at most n_jobs requests
+    are sent at the same time over a session of keep-alive connections. The OpenAlex topics are loaded once in memory.
+
+    Parameters
+    ----------
+    col : pymongo.collection.Collection
+        Collection of the works (kahi database)
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+    works : iterable
+        Works to process (cursor with titles, abstracts, source, primary_topic and topics)
+    inference_endpoint : str, optional
+        Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    batch_size : int, optional
+        Number of works per request, by default 32
+    n_jobs : int, optional
+        Maximum number of concurrent requests, by default 4
+    max_retries : int, optional
+        Maximum number of retries of every request, by default 3
+    backoff_factor : float, optional
+        Backoff factor of the retries, by default 1
+    timeout : int, optional
+        Timeout of every request in seconds, by default 300
+    verbose : int, optional
+        Verbosity level of joblib, by default 0
+    """
+    topics = load_openalex_topics(col_oa)
+    session = inference_session(n_jobs, max_retries, backoff_factor)
+    Parallel(
+        n_jobs=n_jobs,
+        verbose=verbose,
+        backend="threading",
+    )(
+        delayed(process_topics_batch)(
+            col,
+            topics,
+            batch,
+            session,
+            inference_endpoint,
+            timeout,
+        )
+        for batch in batches(works, batch_size)
+    )
+    session.close()
@@ -1,4 +1,7 @@
 
+from pymongo import UpdateOne
+
+
 def get_scienti_string(work):
     """
     Get the scienti string of the work types
@@ -27,8 +30,8 @@ def process_scienti(work, types, verbose=False):
     ----------
     work: dict
         The work from kahi
-    types: pandas.DataFrame
-        The types dataframe
+    types: dict
+        The impactu types of the source (see build_type_lookups)
     verbose: bool
         If True, print warnings
 
@@ -38,7 +41,7 @@ def process_scienti(work, types, verbose=False):
         The impactu type or an empty dictionary if type is not found
     """
     t = get_scienti_string(work)
-    impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+    impactu_type = types.get(t, [])
     if len(impactu_type) > 1 and verbose:
         print(f"WARNING: more than one type found for {t} = {impactu_type}")
     if len(impactu_type) == 1:
@@ -54,8 +57,8 @@ def process_minciencias(work, types):
     ----------
     work: dict
         The work from kahi
-    types: pandas.DataFrame
-        The impactu types
+    types: dict
+        The impactu types of the source (see build_type_lookups)
 
     Returns:
     -------
@@ -63,7 +66,7 @@ def process_minciencias(work, types):
         The impactu type or an empty dictionary if type is not found
     """
     t = work["types"][0]["type"] + ": " + work["types"][1]["type"]
-    impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+    impactu_type = types.get(t, [])
     if len(impactu_type) > 1:
         print(f"WARNING: more than one type found for {t} = {impactu_type}")
     if len(impactu_type) == 1:
@@ -93,8 +96,8 @@ def process_others(source):
         ----------
         work: dict
             The work from kahi
-        types: pandas.DataFrame
-            The impactu types
+        types: dict
+            The impactu types of the source (see build_type_lookups)
 
         Returns:
         -------
@@ -102,7 +105,7 @@ def process_others(source):
             The impactu type or an empty dictionary if type is not found
         """
         t = work["types"][0]["type"]
-        impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+        impactu_type = types.get(t, [])
         if len(impactu_type) > 1:
             print(
                 f"WARNING: more than one type found for {t} = {impactu_type}")
@@ -123,32 +126,123 @@ functors["openalex"] = process_others("openalex")
 functors["scholar"] = process_others("scholar")
 
 
-def process_type(db, work, source, types, verbose=True):
+def build_type_lookups(types, sources):
     """
-    Process one work to get the impactu type
+    Compiles the types dataframe into one lookup per source, with the impactu types of every type
+    of the rows whose "Fuente" contains the source (case insensitive).
+
+    Parameters:
+    ----------
+    types: pandas.DataFrame
+        The impactu types, with the columns "Fuente", "Tipo" and "Tipo ImpactU"
+    sources: list
+        The sources of the types ex: minciencias, scienti, ciarp, openalex, scholar
+
+    Returns:
+    -------
+    dict
+        {source: {type: list of impactu types}}
+    """
+    lookups = {}
+    for source in sources:
+        df_filtered = types[types["Fuente"].str.contains(
+            source, case=False, na=False)]
+        lookup = {}
+        for t, impactu_type in zip(df_filtered["Tipo"], df_filtered["Tipo ImpactU"]):
+            lookup.setdefault(t, []).append(impactu_type)
+        lookups[source] = lookup
+    return lookups
+
+
+def get_impactu_type(work, source, lookups, verbose=True):
+    """
+    Get the impactu type of one work
 
     Parameters:
     ----------
-    db: pymongo.database.Database
-        The database
     work: dict
         The work from kahi
     source: str
         The source of the types ex: minciencias, scienti, ciarp, openalex, scholar
-    types: pandas.DataFrame
-        The impactu types
+    lookups: dict
+        The impactu types by source (see build_type_lookups)
     verbose: bool
         If True, print warnings
 
+    Returns:
+    -------
+    dict
+        The impactu type or an empty dictionary if type is not found
     """
-    df_filtered = types[types["Fuente"].str.contains(
-        source, case=False, na=False)]
     if len(work["types"]) > 1 and (source != "minciencias" or source != "scienti") and verbose:
         print(f"WARNING: more than one type found for {source} = {work}")
 
-    impactu_type = functors[source](work, df_filtered)
+    impactu_type = functors[source](work, lookups[source])
+    if not impactu_type and verbose:
+        print(f"WARNING: impactu type not found for {work}")
+    return impactu_type
+
+
+def process_type(db, work, source, lookups, verbose=True):
+    """
+    Process one work to get the impactu type
+
+    Parameters:
+    ----------
+    db: pymongo.database.Database
+        The database
+    work: dict
+        The work from kahi
+    source: str
+        The source of the types ex: minciencias, scienti, ciarp, openalex, scholar
+    lookups: dict
+        The impactu types by source (see build_type_lookups)
+    verbose: bool
+        If True, print warnings
+
+    """
+    impactu_type = get_impactu_type(work, source, lookups, verbose)
     if impactu_type:
         db["works"].update_one({"_id": work["_id"]},
                                {"$push": {"types": impactu_type}})
-    elif verbose:
-        print(f"WARNING: impactu type not found for {work}")
+
+
+def process_types_source(db, works, source, lookups, batch_size=1000, verbose=True):
+    """
+    Process the works of one source to get the impactu types, the types are pushed with one bulk write
+    every batch_size works.
+
+    Parameters:
+    ----------
+    db: pymongo.database.Database
+        The database
+    works: iterable
+        The works from kahi with the types of the source
+    source: str
+        The source of the types ex: minciencias, scienti, ciarp, openalex, scholar
+    lookups: dict
+        The impactu types by source (see build_type_lookups)
+    batch_size: int
+        Number of updates per bulk write
+    verbose: bool
+        If True, print warnings
+
+    Returns:
+    -------
+    int
+        Number of works with impactu type
+    """
+    count = 0
+    updates = []
+    for work in works:
+        impactu_type = get_impactu_type(work, source, lookups, verbose)
+        if impactu_type:
+            updates.append(UpdateOne({"_id": work["_id"]}, {"$push": {"types": impactu_type}}))
+        if len(updates) == batch_size:
+            db["works"].bulk_write(updates, ordered=False)
+            count += len(updates)
+            updates = []
+    if updates:
+        db["works"].bulk_write(updates, ordered=False)
+        count += len(updates)
+    return count
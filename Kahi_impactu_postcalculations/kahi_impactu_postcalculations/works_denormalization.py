@@ -0,0 +1,223 @@
+from pymongo import UpdateOne
+
+# fields of the works read and rewritten by the fused denormalization
+works_projection = {"authors": 1, "groups": 1,
+                    "source": 1, "citations_count": 1}
+
+
+def first_rank(ranking, source="minciencias"):
+    """
+    Returns the rank of the first entry of ranking with the given source, or None.
+    """
+    for rank in ranking or []:
+        if isinstance(rank, dict) and rank.get("source") == source:
+            return rank.get("rank")
+    return None
+
+
+def load_works_lookups(db):
+    """
+    Loads in memory the data of affiliations, person and sources used to denormalize the works,
+    every collection is read once with the fields needed by the works denormalization steps.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database with the affiliations, person and sources collections.
+
+    Returns
+    -------
+    dict
+        {"affiliations": {_id: doc}, "person": {_id: doc}, "sources": {_id: doc}}
+    """
+    affiliations = {}
+    for aff in db["affiliations"].find({}, {"ranking": 1, "external_ids": 1, "addresses": 1, "types.type": 1, "citations_count": 1}):
+        data = {"ranking": aff.get("ranking"),
+                "is_group": any(isinstance(t, dict) and t.get("type") == "group" for t in aff.get("types") or [])}
+        if "external_ids" in aff:
+            data["external_ids"] = aff["external_ids"]
+        if "citations_count" in aff:
+            data["citations_count"] = aff["citations_count"]
+        data["addresses"] = []
+        data["country"] = None
+        data["country_code"] = None
+        country_found = country_code_found = False
+        for addr in aff.get("addresses") or []:
+            address = {}
+            for key, field in [("latitude", "lat"), ("longitude", "lng"), ("city", "city"),
+                               ("country", "country"), ("country_code", "country_code")]:
+                if field in addr:
+                    address[key] = addr[field]
+            data["addresses"].append(address)
+            if not country_found and "country" in addr:
+                data["country"] = addr["country"]
+                country_found = True
+            if not country_code_found and "country_code" in addr:
+                data["country_code"] = addr["country_code"]
+                country_code_found = True
+        affiliations[aff["_id"]] = data
+
+    person = {}
+    for author in db["person"].find({}, {"sex": 1, "full_name": 1, "first_names": 1, "last_names": 1, "ranking": 1, "external_ids": 1,
+                                         "affiliations.id": 1, "affiliations.start_date": 1, "affiliations.end_date": 1}):
+        data = {"id": author["_id"]}
+        for field in ["sex", "full_name", "first_names", "last_names", "ranking", "external_ids"]:
+            if field in author:
+                data[field] = author[field]
+        person[author["_id"]] = {"data": data, "affiliations": author.get("affiliations") or []}
+
+    sources = {}
+    for source in db["sources"].find({}, {"_id": 1, "names": 1, "types": 1, "external_ids": 1, "updated": 1,
+                                          "publisher": 1, "ranking": 1, "apc": 1, "external_urls": 1}):
+        sources[source.pop("_id")] = source
+
+    return {"affiliations": affiliations, "person": person, "sources": sources}
+
+
+def denormalize_authors(authors, lookups):
+    """
+    Applies to the authors of a work, in the same order, the steps of the works aggregations:
+    affiliations country and country code, minciencias ranking, person full data, affiliations dates,
+    affiliations external data, removal of the country fields and null ranking as empty list.
+    """
+    if authors is None:
+        return None
+    affiliations = lookups["affiliations"]
+    person = lookups["person"]
+    for author in authors:
+        author_data = person.get(author.get("id"))
+        # set_works_authors_affiliations_country(_code)
+        author_affiliations = author.get("affiliations")
+        if author_affiliations is not None:
+            for aff in author_affiliations:
+                aff_data = affiliations.get(aff.get("id"))
+                aff["country"] = aff_data["country"] if aff_data else None
+                aff["country_code"] = aff_data["country_code"] if aff_data else None
+        else:
+            author["affiliations"] = None
+        # set_works_authors_ranking
+        author["ranking"] = first_rank(author_data["data"].get("ranking")) if author_data else None
+        # set_works_authors_full_data
+        if author_data:
+            author.update(author_data["data"])
+        # set_works_authors_affiliations_dates
+        person_affiliations = author_data["affiliations"] if author_data else []
+        author["affiliations"] = author["affiliations"] or []
+        for aff in author["affiliations"]:
+            match = None
+            for person_aff in person_affiliations:
+                if person_aff.get("id") == aff.get("id"):
+                    match = person_aff
+                    break
+            for field in ["start_date", "end_date"]:
+                if match and match.get(field) is not None:
+                    aff[field] = match[field]
+        # set_works_authors_affiliations_external_data
+        for aff in author["affiliations"]:
+            aff_data = affiliations.get(aff.get("id"))
+            if aff_data and aff_data.get("external_ids") is not None:
+                aff["external_ids"] = aff_data["external_ids"]
+            if aff_data:
+                aff["addresses"] = aff_data["addresses"]
+        # clean_works_authors_affiliations_country_fields
+        author["affiliations"] = [{key: value for key, value in aff.items() if key not in ["country", "country_code"]}
+                                  for aff in author["affiliations"]]
+        # normalize_works_authors_ranking_empty_list
+        if author["ranking"] is None:
+            author["ranking"] = []
+    return authors
+
+
+def denormalize_groups(groups, lookups):
+    """
+    Applies to the groups of a work, in the same order, the steps of the works aggregations:
+    minciencias ranking, citations count and full ranking.
+    """
+    if groups is None:
+        return None
+    affiliations = lookups["affiliations"]
+    for group in groups:
+        aff_data = affiliations.get(group.get("id"))
+        # set_works_groups_ranking
+        group["ranking"] = first_rank(aff_data["ranking"]) if aff_data else None
+        # set_works_groups_citations_count
+        if aff_data and aff_data["is_group"] and "citations_count" in aff_data:
+            group["citations_count"] = aff_data["citations_count"]
+        else:
+            group.pop("citations_count", None)
+        # set_works_groups_ranking_to_works_collection
+        group["ranking"] = aff_data["ranking"] if aff_data and aff_data["ranking"] is not None else []
+    return groups
+
+
+def denormalize_work(work, lookups):
+    """
+    Computes the denormalized fields of a work, the result is the same as running the aggregations of
+    DENORMALIZATION_PIPELINES["works"] in denormalization.py over the work.
+
+    Parameters
+    ----------
+    work : dict
+        Work with the fields of works_projection.
+    lookups : dict
+        Output of load_works_lookups.
+
+    Returns
+    -------
+    dict
+        Fields to set in the work.
+    """
+    fields = {}
+    fields["authors"] = denormalize_authors(work.get("authors"), lookups)
+    fields["groups"] = denormalize_groups(work.get("groups"), lookups)
+    # set_works_citations_count_openalex
+    count = 0
+    for citations in work.get("citations_count") or []:
+        if citations.get("source") == "openalex":
+            count = citations.get("count")
+            break
+    fields["citations_count_openalex"] = count if count is not None else 0
+    # set_works_source_full_data
+    source = work.get("source")
+    if isinstance(source, dict) and source.get("id") in lookups["sources"]:
+        source.update(lookups["sources"][source["id"]])
+        fields["source"] = source
+    return fields
+
+
+def denormalize_works(db, batch_size=1000, verbose=0, query=None):
+    """
+    Fused denormalization of the works collection: loads the lookup tables once and applies all the works
+    denormalization steps to every work in a single pass sorted by _id, writing every batch_size works with one bulk_write.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database to denormalize.
+    batch_size : int, optional
+        Number of works read and written per batch. The default is 1000.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    query : dict, optional
+        Filter of the works to denormalize. The default is None (all the works).
+    """
+    lookups = load_works_lookups(db)
+    if verbose > 0:
+        print(f"INFO: lookups loaded, {len(lookups['affiliations'])} affiliations, {len(lookups['person'])} person, {len(lookups['sources'])} sources")
+    collection = db["works"]
+    last_id = None
+    count = 0
+    while True:
+        page_query = query if query else {}
+        if last_id is not None:
+            page_query = {"$and": [page_query, {"_id": {"$gt": last_id}}]} if query else {"_id": {"$gt": last_id}}
+        page = list(collection.find(page_query, works_projection).sort("_id", 1).limit(batch_size))
+        if not page:
+            break
+        last_id = page[-1]["_id"]
+        collection.bulk_write(
+            [UpdateOne({"_id": work["_id"]}, {"$set": denormalize_work(work, lookups)}) for work in page],
+            ordered=False)
+        count += len(page)
+        if verbose > 4:
+            print(f"INFO: {count} works denormalized")
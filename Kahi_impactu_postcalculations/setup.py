@@ -86,6 +86,7 @@ def main():
             'joblib',
             'datetime',
             'openpyxl',
+            'requests',
         ],
     )
 
@@ -1,6 +1,7 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from time import time
+from itertools import islice
 from re import search, sub
 from joblib import Parallel, delayed
 from kahi_impactu_utils.Utils import get_id_from_url, get_id_type_from_url, parse_sex, check_date_format, split_names, doi_processor
@@ -70,34 +71,68 @@ def extract_valid_dois(html: str) -> list[str]:
     return list(valid)
 
 
-def get_works_by_id(author_id, cvlac_html_dois) -> list[dict]:
+def extract_cvlac_dois(cvlac_html_profiles, n_jobs=1, batch_size=1000, verbose=0) -> dict:
     """
-    Depending on stored HTML profiles, extract DOIs for an author.
+    Extracts the valid DOIs of all the stored cvlac HTML profiles once, so the HTML is not kept in memory.
+    The profiles are read in batches and the DOIs of every batch are extracted in parallel.
+
+    Parameters
+    ----------
+    cvlac_html_profiles : pymongo.collection.Collection
+        Collection of the stored profiles (each document contains '_id' and 'html').
+    n_jobs : int, optional
+        Number of processes used to extract the DOIs. The default is 1.
+    batch_size : int, optional
+        Number of profiles read from the collection per batch. The default is 1000.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    dict
+        Map of the author id to the list of DOI URLs found in its profile, only profiles with DOIs are included.
+    """
+    cvlac_dois = {}
+    count = 0
+    with Parallel(n_jobs=n_jobs) as parallel:
+        cursor = cvlac_html_profiles.find({}, {"html": 1})
+        while True:
+            batch = list(islice(cursor, batch_size))
+            if not batch:
+                break
+            count += len(batch)
+            batch = [reg for reg in batch if reg.get("html")]
+            results = parallel(delayed(extract_valid_dois)(reg["html"]) for reg in batch)
+            for reg, dois in zip(batch, results):
+                if dois:
+                    cvlac_dois[reg["_id"]] = sorted(dois)
+        cursor.close()
+    if verbose > 4:
+        print("Extracted DOIs of {} out of {} cvlac html profiles.".format(
+            len(cvlac_dois), count))
+    return cvlac_dois
+
+
+def get_works_by_id(author_id, cvlac_dois) -> list[dict]:
+    """
+    Depending on the DOIs extracted from the stored HTML profiles, returns the works of an author.
 
     Parameters
     ----------
     author_id : str
-        The identifier of the author whose profile should be inspected in cvlac_html_dois.
-    cvlac_html_dois : list of dict
-        A list of documents (each must contain '_id' and 'html') representing stored profiles.
+        The identifier of the author whose DOIs should be looked up in cvlac_dois.
+    cvlac_dois : dict
+        Map of the author id to the DOIs of its profile, as returned by extract_cvlac_dois.
 
     Returns
     -------
     list of dict
         Each dict has keys {'provenance', 'source', 'id'} corresponding to a detected valid DOI.
     """
-    for author_reg in cvlac_html_dois:
-        if author_reg["_id"] == author_id:
-            doc = author_reg
-            break
-    if not doc or 'html' not in doc:
-        return []
-    html = doc['html']
-    dois = extract_valid_dois(html)
-    return [{'provenance': 'minciencias', 'source': 'doi', 'id': doi} for doi in dois]
+    return [{'provenance': 'minciencias', 'source': 'doi', 'id': doi} for doi in cvlac_dois.get(author_id, [])]
 
 
-def process_info_from_works(db, author, entry, groups_production_list, cvlac_html_dois):
+def process_info_from_works(db, author, entry, groups_production_list, cvlac_dois):
     # Works
     papers = []
     for prod in groups_production_list:
@@ -230,12 +265,12 @@ def process_info_from_works(db, author, entry, groups_production_list, cvlac_htm
 
     # Extract realted works from cvlac_html_profiles
     cvlac_works_with_dois = get_works_by_id(
-        author["id_persona_pr"], cvlac_html_dois)
+        author["id_persona_pr"], cvlac_dois)
     if cvlac_works_with_dois:
         entry["related_works"].extend(cvlac_works_with_dois)
 
 
-def process_one(author_entry, db, collection, empty_person, cvlac_profile, groups_production_list, privates, cvlac_html_dois, verbose):
+def process_one(author_entry, db, collection, empty_person, cvlac_profile, groups_production_list, privates, cvlac_dois, verbose):
 
     if not author_entry or not cvlac_profile:
         return
@@ -322,7 +357,7 @@ def process_one(author_entry, db, collection, empty_person, cvlac_profile, group
 
             # Affiliations and related_works
             process_info_from_works(
-                db, author, reg_db, groups_production_list, cvlac_html_dois)
+                db, author, reg_db, groups_production_list, cvlac_dois)
             # Update the record
             collection.update_one(
                 {"_id": reg_db["_id"]},
@@ -449,7 +484,7 @@ def process_one(author_entry, db, collection, empty_person, cvlac_profile, group
 
         # affiliations and related works
         process_info_from_works(
-            db, author, entry, groups_production_list, cvlac_html_dois)
+            db, author, entry, groups_production_list, cvlac_dois)
 
         # Ranking
         if "nme_clasificacion_pr" in author.keys():
@@ -575,8 +610,12 @@ class Kahi_minciencias_opendata_person(KahiBase):
         production_not_cvlac_cursor = self.groups_production.aggregate(
             pipeline, allowDiskUse=True)
 
-        # send all profiles with the cvlac html
-        cvlac_html_dois = list(self.cvlac_html_profiles.find())
+        # DOIs of the cvlac html profiles, extracted once for all the authors
+        if self.verbose > 4:
+            print("Extracting the DOIs of {} cvlac html profiles.".format(
+                self.cvlac_html_profiles.estimated_document_count()))
+        cvlac_dois = extract_cvlac_dois(
+            self.cvlac_html_profiles, self.n_jobs, verbose=self.verbose)
 
         with MongoClient(self.mongodb_url) as client:
             db = client[self.config["database_name"]]
@@ -599,7 +638,7 @@ class Kahi_minciencias_opendata_person(KahiBase):
                         {"id_persona_pr": author["_id"]}),
                     groups_production_list,
                     False,  # author is list of author documents
-                    cvlac_html_dois,
+                    cvlac_dois,
                     self.verbose
                 ) for author in cvlac_authors_list  # Iterate over the cvlac_authors_list
             )
@@ -621,7 +660,7 @@ class Kahi_minciencias_opendata_person(KahiBase):
                         {"id_persona_pr": author}),
                     groups_production_list,
                     True,  # author is an author id
-                    cvlac_html_dois,
+                    cvlac_dois,
                     self.verbose
                     # Iterate over the authors_private_profile_list
                 ) for author in authors_private_profile_list
@@ -649,7 +688,7 @@ class Kahi_minciencias_opendata_person(KahiBase):
                             {"id_persona_pr": author}),
                         groups_production_not_cvlac_list,
                         True,  # author is an author id
-                        cvlac_html_dois,
+                        cvlac_dois,
                         self.verbose
                         # Iterate over the ids of the authors not in cvlac.
                     ) for author in list(authors_not_cvlac_ids)
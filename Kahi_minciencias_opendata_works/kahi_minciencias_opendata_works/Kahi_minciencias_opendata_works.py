@@ -2,8 +2,10 @@ from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from pymongo.errors import ConnectionFailure
 from joblib import Parallel, delayed
-from kahi_minciencias_opendata_works.process_one import process_one
+from kahi_minciencias_opendata_works.process_one import process_one, process_block
+from kahi_similarity_utils.pending import PendingInserts
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
 
 
 class Kahi_minciencias_opendata_works(KahiBase):
@@ -32,6 +34,9 @@ class Kahi_minciencias_opendata_works(KahiBase):
                 - es_url: the URL for the Elasticsearch server
                 - es_user: the username for the Elasticsearch server
                 - es_password: the password for the Elasticsearch server
+                - es_batch_size: number of records per _msearch request of the similarity searches, default 1 (disabled)
+                - pending_size: number of inserted works kept in the registry of pending inserts, 0 disables it
+                - page_size: number of records processed before the registry of pending inserts is flushed, default 1000
         """
         self.config = config
 
@@ -47,7 +52,11 @@ class Kahi_minciencias_opendata_works(KahiBase):
         self.collection.create_index([("titles.title", TEXT)])
         self.collection.create_index("external_ids.id")
 
-        if "es_index" in config["minciencias_opendata_works"].keys() and "es_url" in config["minciencias_opendata_works"].keys() and "es_user" in config["minciencias_opendata_works"].keys() and "es_password" in config["minciencias_opendata_works"].keys():  # noqa: E501
+        if "local_index" in config["minciencias_opendata_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["minciencias_opendata_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif "es_index" in config["minciencias_opendata_works"].keys() and "es_url" in config["minciencias_opendata_works"].keys() and "es_user" in config["minciencias_opendata_works"].keys() and "es_password" in config["minciencias_opendata_works"].keys():  # noqa: E501
             es_index = config["minciencias_opendata_works"]["es_index"]
             es_url = config["minciencias_opendata_works"]["es_url"]
             if config["minciencias_opendata_works"]["es_user"] and config["minciencias_opendata_works"]["es_password"]:
@@ -72,6 +81,14 @@ class Kahi_minciencias_opendata_works(KahiBase):
         ) else 1
         self.verbose = config["minciencias_opendata_works"]["verbose"] if "verbose" in config["minciencias_opendata_works"].keys(
         ) else 0
+        self.es_batch_size = config["minciencias_opendata_works"]["es_batch_size"] if "es_batch_size" in config["minciencias_opendata_works"].keys(
+        ) else 1
+        # works inserted by the workers not visible yet in the index, 0 disables the registry
+        self.pending_size = config["minciencias_opendata_works"]["pending_size"] if "pending_size" in config["minciencias_opendata_works"].keys(
+        ) else 10000
+        self.pending = PendingInserts(self.pending_size) if self.pending_size > 0 else None
+        self.page_size = config["minciencias_opendata_works"]["page_size"] if "page_size" in config["minciencias_opendata_works"].keys(
+        ) else 1000
 
         # checking if the databases and collections are available
         self.check_databases_and_collections()
@@ -130,21 +147,45 @@ class Kahi_minciencias_opendata_works(KahiBase):
         paper_list = list(opendata.aggregate(pipeline, allowDiskUse=True))
         print(
             f"INFO: Processing  production {len(paper_list)} other than catgories {exclude}")
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=self.verbose,
-            backend="threading")(
-            delayed(process_one)(
-                work,
-                self.db,
-                self.collection,
-                self.empty_work(),
-                self.es_handler,
-                insert_all=self.insert_all,
-                thresholds=self.thresholds,
-                verbose=self.verbose
-            ) for work in paper_list
-        )
+        # the records are processed in pages, the keys of the pending inserts are dropped after every page
+        # (the works inserted are in the index then)
+        with Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading") as parallel:
+            for start in range(0, len(paper_list), self.page_size):
+                page = paper_list[start:start + self.page_size]
+                if self.es_handler and self.es_batch_size > 1:
+                    # the similarity searches of every block are sent in a single _msearch request
+                    parallel(
+                        delayed(process_block)(
+                            page[i:i + self.es_batch_size],
+                            self.db,
+                            self.collection,
+                            self.empty_work(),
+                            self.es_handler,
+                            insert_all=self.insert_all,
+                            thresholds=self.thresholds,
+                            verbose=self.verbose,
+                            pending=self.pending
+                        ) for i in range(0, len(page), self.es_batch_size)
+                    )
+                else:
+                    parallel(
+                        delayed(process_one)(
+                            work,
+                            self.db,
+                            self.collection,
+                            self.empty_work(),
+                            self.es_handler,
+                            insert_all=self.insert_all,
+                            thresholds=self.thresholds,
+                            verbose=self.verbose,
+                            pending=self.pending
+                        ) for work in page
+                    )
+                if self.pending:
+                    self.pending.flush()
         client.close()
 
     def run(self):
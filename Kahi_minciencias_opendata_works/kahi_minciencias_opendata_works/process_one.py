@@ -1,9 +1,10 @@
 from kahi_minciencias_opendata_works.parser import parse_minciencias_opendata
 from kahi_impactu_utils.Utils import compare_author
-from thefuzz import process, fuzz
-from unidecode import unidecode
+from thefuzz import process
+from kahi_similarity_utils.scoring import best_match
 from time import time
-from bson import ObjectId
+from kahi_similarity_utils.es_batch import BatchSearch, find_work
+from copy import deepcopy
 from re import search, sub
 
 
@@ -401,39 +402,160 @@ def process_one_insert(openadata_reg, db, collection, empty_work, es_handler, ve
     else:
         if verbose > 4:
             print("No elasticsearch index provided")
+    return response.inserted_id
 
 
-def str_normilize(word):
-    return unidecode(word).lower().strip().replace(".", "")
+def similarity_query(openadata_reg, db):
+    """
+    Function to build the elasticsearch similarity search (Similarity.search_work) of a register,
+    with the title and the author (searched by COD_RH in the person collection) if available.
 
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for the author.
 
-def check_work(title_work, authors, response, thresholds):
-    author_found = False
-    if authors:
-        if authors[0] != "":
-            _authors = []
-            for author in response["_source"]["authors"]:
-                _authors.append(str_normilize(author))
-            scores = process.extract(str_normilize(
-                authors[0]), _authors, scorer=fuzz.partial_ratio)
-            for score in scores:
-                if score[1] >= thresholds["author_thd"]:
-                    author_found = True
-                    break
-    es_title = response["_source"]["title"]
-    if es_title:
-        score = fuzz.ratio(str_normilize(title_work),
-                           str_normilize(es_title))
-        if author_found:
-            if score >= thresholds["paper_thd_low"]:
-                return True
-        else:
-            if score >= thresholds["paper_thd_high"]:
-                return True
-    return False
+    Returns
+    -------
+    tuple
+        (title_work, authors, query) where query are the arguments of search_work,
+        query is None if the register has no title.
+    """
+    authors = []
+    title_work = ""
+    if 'nme_producto_pd' in openadata_reg.keys():
+        if openadata_reg["nme_producto_pd"]:
+            title_work = openadata_reg["nme_producto_pd"]
+
+    if 'id_persona_pd' in openadata_reg.keys():
+        if openadata_reg["id_persona_pd"]:
+            author_db = db["person"].find_one(
+                {"external_ids.id.COD_RH": openadata_reg["id_persona_pd"]}, {"_id": 1, "full_name": 1})
+            if author_db:
+                authors.append(author_db["full_name"])
+
+    query = None
+    if authors and title_work != "":
+        query = {
+            "title": title_work,
+            "source": "",
+            "year": "0",
+            "authors": authors,
+            "volume": "",
+            "issue": "",
+            "page_start": "",
+            "page_end": "",
+            "use_es_thold": True,
+            "es_thold": 0,
+            "hits": 20
+        }
+    elif title_work:
+        # No authors
+        title = sub('[_|,\\\\]', '', title_work).lower()
+        query = {
+            "title": title,
+            "source": "",
+            "year": "0",
+            "authors": [],
+            "volume": "",
+            "issue": "",
+            "page_start": "",
+            "page_end": "",
+            "use_es_thold": True,
+            "es_thold": 0,
+            "hits": 20
+        }
+    return title_work, authors, query
+
+
+def process_similar(openadata_reg, title_work, authors, query, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+    """
+    Function to search a register in elasticsearch and update the similar work,
+    or insert the register as a new work if insert_all is True.
+
+    Parameters
+    ----------
+    openadata_reg : dict
+        Register from the minciencias opendata database
+    title_work : str
+        Title of the register.
+    authors : list
+        Name of the author of the register (empty if not found).
+    query : dict
+        Arguments of search_work, see similarity_query.
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    insert_all : bool
+        Flag to insert all the registers in the minciencias opendata database.
+    thresholds : dict
+        Thresholds for the similarity functions (author_thd, paper_thd_low, paper_thd_high).
+    verbose : int, optional
+        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    ObjectId | None
+        The _id of the work inserted, None if a work was updated or nothing was inserted.
+    """
+    if authors and title_work != "":
+        responses = es_handler.search_work(**query)
+        if responses:
+            # all the hits are scored in a single call, the first similar one is updated
+            response, title_score, author_score = best_match(title_work, authors, responses, thresholds)
+            if response:
+                if verbose > 4:
+                    print(f"INFO: similar work {response['_id']} title score {title_score} author score {author_score}")
+                colav_reg = find_work(collection, es_handler, response["_id"])
+                if colav_reg:
+                    process_one_update(
+                        openadata_reg, colav_reg, db, collection, empty_work, verbose)
+                    return None
+                else:
+                    if verbose > 4:
+                        print("Register with {} not found in mongodb".format(
+                            response["_id"]))
+                    return None
+            # Work not found
+            if insert_all:
+                return process_one_insert(
+                    openadata_reg, db, collection, empty_work, es_handler, verbose)
 
+    elif title_work:
+        # No authors
+        es_results = es_handler.search_work(**query)
+        if es_results:
+            for es_work in es_results:
+                colav_reg = find_work(collection, es_handler, es_work["_id"])
+                if colav_reg:
+                    titles = [titles.get('title')
+                              for titles in colav_reg["titles"]]
+                    display_name, score = process.extractOne(
+                        title_work, titles)
+                    if score > thresholds["paper_thd_high"]:
+                        process_one_update(
+                            openadata_reg, colav_reg, db, collection, empty_work, verbose)
+                        return None
+                else:
+                    if verbose > 4:
+                        print("Register with {} not found in mongodb".format(
+                            es_work["_id"]))
+                    return None
+
+        if insert_all:
+            return process_one_insert(
+                openadata_reg, db, collection, empty_work, es_handler, verbose)
+    return None
 
-def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0):
+
+def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0, similarity=None, pending=None):
     """
     Function to process a single register from the minciencias opendata database.
     This function is used to insert or update a register in the colav(kahi works) database.
@@ -456,6 +578,10 @@ def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_al
         List with the thresholds for the similarity functions.
     verbose : int, optional
         Verbosity level. The default is 0.
+    similarity : tuple, optional
+        Output of similarity_query for the register, if None it is computed.
+    pending : PendingInserts, optional
+        Registry of the works inserted by the other workers, checked before the elasticsearch search.
     """
     # type id verification
     if "id_producto_pd" in openadata_reg.keys():
@@ -488,93 +614,64 @@ def process_one(openadata_reg, db, collection, empty_work, es_handler, insert_al
             thresholds = {"author_thd": 65,
                           "paper_thd_low": 90, "paper_thd_high": 95}
 
-        authors = []
-        title_work = ""
-        if 'nme_producto_pd' in openadata_reg.keys():
-            if openadata_reg["nme_producto_pd"]:
-                title_work = openadata_reg["nme_producto_pd"]
-
-        if 'id_persona_pd' in openadata_reg.keys():
-            if openadata_reg["id_persona_pd"]:
-                author_db = db["person"].find_one(
-                    {"external_ids.id.COD_RH": openadata_reg["id_persona_pd"]}, {"_id": 1, "full_name": 1})
-                if author_db:
-                    authors.append(author_db["full_name"])
-
-        if authors and title_work != "":
-            responses = es_handler.search_work(
-                title=title_work,
-                source="",
-                year="0",
-                authors=authors,
-                volume="",
-                issue="",
-                page_start="",
-                page_end="",
-                use_es_thold=True,
-                es_thold=0,
-                hits=20
-            )
-            if responses:
-                for response in responses:
-                    out = check_work(title_work, authors, response, thresholds)
-                    if out:
-                        colav_reg = collection.find_one(
-                            {"_id": ObjectId(response["_id"])})
-                        if colav_reg:
-                            process_one_update(
-                                openadata_reg, colav_reg, db, collection, empty_work, verbose)
-                            return
-                        else:
-                            if verbose > 4:
-                                print("Register with {} not found in mongodb".format(
-                                    response["_id"]))
-                            return
-                # Work not found
-                if insert_all:
-                    process_one_insert(
-                        openadata_reg, db, collection, empty_work, es_handler, verbose)
-
-        elif title_work:
-            # No authors
-            title = sub('[_|,\\\\]', '', title_work).lower()
-            es_results = es_handler.search_work(
-                title=title,
-                source="",
-                year="0",
-                authors=[],
-                volume="",
-                issue="",
-                page_start="",
-                page_end="",
-                use_es_thold=True,
-                es_thold=0,
-                hits=20
-            )
-            if es_results:
-                for es_work in es_results:
-                    colav_reg = collection.find_one(
-                        {"_id": ObjectId(es_work["_id"])})
-                    if colav_reg:
-                        titles = [titles.get('title')
-                                  for titles in colav_reg["titles"]]
-                        display_name, score = process.extractOne(
-                            title_work, titles)
-                        if score > thresholds["paper_thd_high"]:
-                            process_one_update(
-                                openadata_reg, colav_reg, db, collection, empty_work, verbose)
-                            return
-                    else:
-                        if verbose > 4:
-                            print("Register with {} not found in mongodb".format(
-                                response["_id"]))
-                        return
-
-            if insert_all:
-                process_one_insert(
-                    openadata_reg, db, collection, empty_work, es_handler, verbose)
+        if similarity is None:
+            similarity = similarity_query(openadata_reg, db)
+        title_work, authors, query = similarity
+
+        if query is None:
+            return
+        claimed, pending_id = pending.claim(title_work, query["year"]) if pending else (True, None)
+        if not claimed:
+            # the same work was inserted by other worker
+            colav_reg = collection.find_one({"_id": pending_id})
+            if colav_reg:
+                process_one_update(
+                    openadata_reg, colav_reg, db, collection, empty_work, verbose)
+            return
+        inserted_id = None
+        try:
+            inserted_id = process_similar(openadata_reg, title_work, authors, query, db, collection,
+                                          empty_work, es_handler, insert_all, thresholds, verbose)
+        finally:
+            if pending:
+                pending.done(title_work, query["year"], inserted_id)
     else:
         process_one_insert(
             openadata_reg, db, collection, empty_work, es_handler, verbose)
         if verbose > 4:
             print("No elasticsearch index provided")
+
+
+def process_block(openadata_regs, db, collection, empty_work, es_handler, insert_all, thresholds, verbose=0, pending=None):
+    """
+    Function to process a block of registers from the minciencias opendata database one by one with process_one,
+    the similarity queries of the block are sent in a single _msearch request and the works of the hits are read
+    with a single query (see kahi_similarity_utils.es_batch.BatchSearch).
+
+    Parameters
+    ----------
+    openadata_regs : list
+        Registers from the minciencias opendata database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database, copied for every register.
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    insert_all : bool
+        Flag to insert all the registers in the minciencias opendata database.
+    thresholds : list
+        List with the thresholds for the similarity functions.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    pending : PendingInserts, optional
+        Registry of the works inserted by the other workers, checked before the elasticsearch search.
+    """
+    queries = [similarity_query(openadata_reg, db) for openadata_reg in openadata_regs]
+    handler = BatchSearch(es_handler, collection)
+    handler.prefetch([query[2] for query in queries])
+    for openadata_reg, similarity in zip(openadata_regs, queries):
+        process_one(openadata_reg, db, collection, deepcopy(empty_work), handler,
+                    insert_all, thresholds, verbose, similarity=similarity, pending=pending)
@@ -84,7 +84,8 @@ def main():
             'pymongo',
             'joblib',
             'kahi_impactu_utils',
-            'mohan'],
+            'mohan',
+            'Kahi_similarity_utils'],
     )
 
 
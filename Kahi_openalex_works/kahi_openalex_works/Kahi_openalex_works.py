@@ -1,8 +1,36 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
-from kahi_openalex_works.process_one import process_one
+from kahi_openalex_works.process_one import process_one, process_chunk, process_block
+from kahi_openalex_works.resolver import EntityResolver
+from kahi_similarity_utils.checkpoint import Checkpoint, paginate, parse_id
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
+
+# fields of the openalex works read by parse_openalex and the similarity search
+openalex_projection = {
+    "id": 1, "ids": 1, "doi": 1, "title": 1, "type": 1, "type_crossref": 1,
+    "publication_year": 1, "publication_date": 1, "primary_location": 1,
+    "biblio": 1, "open_access": 1, "apc_paid": 1, "apc_list": 1,
+    "cited_by_count": 1, "counts_by_year": 1, "abstract_inverted_index": 1,
+    "authorships.author": 1, "authorships.institutions": 1,
+    "concepts.id": 1, "concepts.display_name": 1, "concepts.level": 1,
+    "primary_topic": 1, "topics": 1
+}
+
+
+def chunked(cursor, size):
+    """
+    Generator that groups the records of a cursor (or any iterable) in lists of the given size.
+    """
+    chunk = []
+    for reg in cursor:
+        chunk.append(reg)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class Kahi_openalex_works(KahiBase):
@@ -31,6 +59,17 @@ class Kahi_openalex_works(KahiBase):
                 - es_url: The url of the elasticsearch server.
                 - es_user: The user for the elasticsearch server.
                 - es_password: The password for the elasticsearch server.
+                - cache_size: Maximum number of person, affiliations, sources and subjects kept in
+                  the in-memory resolver cache (per collection, threading backend only). Default 100000.
+                - chunk_size: If set, every job processes chunks of this number of records, written with
+                  one bulk_write to mongodb and one insert_bulk to elasticsearch. Default 0 (one record per job).
+                - es_batch_size: Without chunk_size, the records without DOI are processed in blocks of this number of
+                  records, with the similarity queries of every block sent in a single _msearch request. Default 1 (disabled).
+                - page_size: Number of openalex records read from mongodb per query. Default 1000.
+                - checkpoint: If True, the last processed openalex _id is saved after every page in the
+                  checkpoints collection of the log database and a new run resumes from it. Default False.
+                - start_id: Optional first openalex _id to process (inclusive).
+                - end_id: Optional last openalex _id to process (inclusive).
         """
         self.config = config
 
@@ -58,7 +97,11 @@ class Kahi_openalex_works(KahiBase):
                 f'''Collection {config["openalex_works"]["collection_name"]} was not found on database {config["openalex_works"]["database_name"]}''')
         self.openalex_collection = self.openalex_db[config["openalex_works"]
                                                     ["collection_name"]]
-        if "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
+        if "local_index" in config["openalex_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["openalex_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
             es_index = config["openalex_works"]["es_index"]
             es_url = config["openalex_works"]["es_url"]
             if config["openalex_works"]["es_user"] and config["openalex_works"]["es_password"]:
@@ -81,36 +124,115 @@ class Kahi_openalex_works(KahiBase):
         self.backend = "threading" if "backend" not in config[
             "openalex_works"].keys() else config["openalex_works"]["backend"]
 
+        self.cache_size = config["openalex_works"]["cache_size"] if "cache_size" in config["openalex_works"].keys(
+        ) else 100000
+        self.resolver = EntityResolver(self.db, max_size=self.cache_size)
+
+        self.chunk_size = config["openalex_works"]["chunk_size"] if "chunk_size" in config["openalex_works"].keys(
+        ) else 0
+        self.page_size = config["openalex_works"]["page_size"] if "page_size" in config["openalex_works"].keys(
+        ) else 1000
+        self.es_batch_size = config["openalex_works"]["es_batch_size"] if "es_batch_size" in config["openalex_works"].keys(
+        ) else 1
+
+        self.checkpoint = config["openalex_works"]["checkpoint"] if "checkpoint" in config["openalex_works"].keys(
+        ) else False
+        self.checkpoint_db = self.client[config["log_database"]] if "log_database" in config.keys() else self.db
+        self.start_id = parse_id(config["openalex_works"]["start_id"]) if "start_id" in config["openalex_works"].keys(
+        ) else None
+        self.end_id = parse_id(config["openalex_works"]["end_id"]) if "end_id" in config["openalex_works"].keys(
+        ) else None
+
+    def process_papers(self, parallel, papers):
+        """
+        Method to process openalex records in parallel, one record, one chunk or one block (similarity) per job.
+
+        Parameters
+        ----------
+        parallel : joblib.Parallel
+            Parallel instance to run the jobs.
+        papers : iterable
+            openalex records.
+        """
+        if self.chunk_size:
+            parallel(
+                delayed(process_chunk)(
+                    chunk,
+                    self.config,
+                    self.empty_work(),
+                    self.client if self.backend == "threading" else None,
+                    self.es_handler if self.backend == "threading" else None,
+                    self.backend,
+                    resolver=self.resolver if self.backend == "threading" else None,
+                    verbose=self.verbose
+                ) for chunk in chunked(papers, self.chunk_size)
+            )
+        elif self.task != "doi" and self.es_handler and self.es_batch_size > 1:
+            parallel(
+                delayed(process_block)(
+                    block,
+                    self.config,
+                    self.empty_work(),
+                    self.client if self.backend == "threading" else None,
+                    self.es_handler if self.backend == "threading" else None,
+                    self.backend,
+                    resolver=self.resolver if self.backend == "threading" else None,
+                    verbose=self.verbose
+                ) for block in chunked(papers, self.es_batch_size)
+            )
+        else:
+            parallel(
+                delayed(process_one)(
+                    paper,
+                    self.config,
+                    self.empty_work(),
+                    self.client if self.backend == "threading" else None,
+                    self.es_handler if self.backend == "threading" else None,
+                    self.backend,
+                    resolver=self.resolver if self.backend == "threading" else None,
+                    verbose=self.verbose
+                ) for paper in papers
+            )
+
     def process_openalex(self):
         # selects papers with doi according to task variable
         if self.task == "doi":
-            paper_cursor = self.openalex_collection.find(
-                {"doi": {"$ne": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}})
-            count = self.openalex_collection.count_documents(
-                {"doi": {"$ne": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}})
+            query = {"doi": {"$ne": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}}
+            count = self.openalex_collection.count_documents(query)
             print(f"INFO: proccesing {count} works with DOI")
         else:
-            paper_cursor = list(self.openalex_collection.find(
-                {"doi": {"$eq": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}}))
-            count = self.openalex_collection.count_documents(
-                {"doi": {"$eq": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}})
+            query = {"doi": {"$eq": None}, "title": {"$ne": None}, "type": {"$ne": "grant"}}
+            count = self.openalex_collection.count_documents(query)
             print(f"INFO: proccesing {count} works without DOI")
 
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=self.verbose,
-            backend=self.backend,
-            batch_size=10)(
-            delayed(process_one)(
-                paper,
-                self.config,
-                self.empty_work(),
-                self.client if self.backend == "threading" else None,
-                self.es_handler if self.backend == "threading" else None,
-                self.backend,
-                verbose=self.verbose
-            ) for paper in paper_cursor
-        )
+        checkpoint = None
+        last_id = None
+        if self.checkpoint:
+            checkpoint = Checkpoint(
+                self.checkpoint_db,
+                f'openalex_works/{self.openalex_db.name}.{self.openalex_collection.name}/{self.task if self.task else "similarity"}',
+                start_id=self.start_id, end_id=self.end_id)
+            last_id = checkpoint.load()
+            if last_id is not None:
+                print(f"INFO: resuming after openalex _id {last_id}")
+        pages = paginate(self.openalex_collection, query, openalex_projection, self.page_size,
+                         last_id=last_id, start_id=self.start_id, end_id=self.end_id)
+
+        with Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend=self.backend,
+                batch_size=1 if self.chunk_size or (self.task != "doi" and self.es_batch_size > 1) else 10) as parallel:
+            if checkpoint:
+                # one page at a time, the marker is saved only when all the records of the page are done
+                for page in pages:
+                    self.process_papers(parallel, page)
+                    checkpoint.save(page[-1]["_id"], len(page))
+                checkpoint.clear()
+            else:
+                self.process_papers(parallel, (paper for page in pages for paper in page))
+        if self.backend == "threading":
+            self.resolver.report()
 
     def run(self):
         self.process_openalex()
@@ -1,12 +1,16 @@
 
 from kahi_openalex_works.parser import parse_openalex
 from time import time
+from copy import deepcopy
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
+from kahi_openalex_works.resolver import EntityResolver
+from kahi_similarity_utils.es_batch import BatchSearch, find_work
 
 
-def get_units_affiations(db, author_db, affiliations):
+def get_units_affiations(db, author_db, affiliations, resolver):
     """
     Method to get the units of an author in a register. ex: faculty, department and group.
 
@@ -18,6 +22,8 @@ def get_units_affiations(db, author_db, affiliations):
         record from person
     affiliations : list
         list of affiliations from the parse_openalex method
+    resolver : EntityResolver
+        Cache to resolve the external ids of the affiliations.
 
     Returns:
     -------
@@ -30,8 +36,7 @@ def get_units_affiations(db, author_db, affiliations):
         aff_db = None
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
+                aff_db = resolver.affiliation(ext["id"])
                 if aff_db:
                     types = [i["type"] for i in aff_db["types"]]
                     if "group" in types or "department" in types or "faculty" in types:
@@ -40,28 +45,24 @@ def get_units_affiations(db, author_db, affiliations):
                     else:
                         break
         if aff_db:
-            count = db["person"].count_documents(
-                {"_id": author_db["_id"], "affiliations.id": aff_db["_id"]})
-            if count > 0:
+            if aff_db["_id"] in [a["id"] for a in author_db["affiliations"]]:
                 institution_id = aff_db["_id"]
                 break
     units = []
     for aff in author_db["affiliations"]:
         if aff["id"] == institution_id:
             continue
-        count = db["affiliations"].count_documents(
-            {"_id": aff["id"], "relations.id": institution_id})
-        if count > 0:
+        if resolver.related(aff["id"], institution_id):
             types = [i["type"] for i in aff["types"]]
             if "department" in types or "faculty" in types:
-                units.append(aff)
+                units.append(dict(aff))  # author_db is shared by the resolver cache
     return units
 
 
-def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0):
+def build_update(oa_reg, colav_reg, db, empty_work, resolver, verbose=0):
     """
-    Method to update a register in the database if it is found in the openalex database.
-    This means that the register is already on the database and it is being updated with new information.
+    Method to compute the update of a register that is already on the database with the openalex information.
+    colav_reg is modified in place.
 
     Parameters
     ----------
@@ -71,12 +72,17 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
         Register from the colav database (kahi database for impactu)
     db : pymongo.database.Database
         Database connection to colav database.
-    collection : pymongo.collection.Collection
-        Collection to insert the register. Colav database collection for works.
     empty_work : dict
         A template for a work entry, with empty fields.
+    resolver : EntityResolver
+        Cache to resolve the external ids of person, affiliations and subjects.
     verbose : int, optional
         Verbosity level. The default is 0.
+
+    Returns
+    -------
+    dict | None
+        The fields to $set in the register, None if the register was already updated with openalex.
     """
     # updated
     for upd in colav_reg["updated"]:
@@ -121,19 +127,11 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
     for subjects in entry["subjects"]:
         for i, subj in enumerate(subjects["subjects"]):
             for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
+                sub_db = resolver.subject(ext["id"])
                 if sub_db:
-                    name = sub_db["names"][0]["name"]
-                    for n in sub_db["names"]:
-                        if n["lang"] == "en":
-                            name = n["name"]
-                            break
-                        elif n["lang"] == "es":
-                            name = n["name"]
                     subject_list.append({
                         "id": sub_db["_id"],
-                        "name": name,
+                        "name": sub_db["name"],
                         "level": sub_db["level"]
                     })
                     break
@@ -144,59 +142,79 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
     for i, author in enumerate(entry["authors"]):
         author_db = None
         for ext in author["external_ids"]:
-            author_db = db["person"].find_one(
-                {"external_ids.id": ext["id"]})
+            author_db = resolver.person(ext["id"])
             if author_db:
                 break
         if author_db:
             aff_units = get_units_affiations(
-                db, author_db, author["affiliations"])
+                db, author_db, author["affiliations"], resolver)
             for aff_unit in aff_units:
                 if aff_unit not in author["affiliations"]:
                     colav_reg["authors"][i]["affiliations"].append(aff_unit)
-    collection.update_one(
-        {"_id": colav_reg["_id"]},
-        {"$set": {
-            "updated": colav_reg["updated"],
-            "titles": colav_reg["titles"],
-            "external_ids": colav_reg["external_ids"],
-            "types": colav_reg["types"],
-            "bibliographic_info": colav_reg["bibliographic_info"],
-            "external_urls": colav_reg["external_urls"],
-            "subjects": colav_reg["subjects"],
-            "citations_count": colav_reg["citations_count"],
-            "citations_by_year": colav_reg["citations_by_year"],
-            "authors": colav_reg["authors"]
-        }}
-    )
-
-
-def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0):
+    return {
+        "updated": colav_reg["updated"],
+        "titles": colav_reg["titles"],
+        "external_ids": colav_reg["external_ids"],
+        "types": colav_reg["types"],
+        "bibliographic_info": colav_reg["bibliographic_info"],
+        "external_urls": colav_reg["external_urls"],
+        "subjects": colav_reg["subjects"],
+        "citations_count": colav_reg["citations_count"],
+        "citations_by_year": colav_reg["citations_by_year"],
+        "authors": colav_reg["authors"]
+    }
+
+
+def process_one_update(oa_reg, colav_reg, db, collection, empty_work, resolver, verbose=0):
     """
-    ""
-    Function to insert a new register in the database if it is not found in the colav(kahi works) database.
-    This means that the register is not on the database and it is being inserted.
+    Method to update a register in the database if it is found in the openalex database.
+    This means that the register is already on the database and it is being updated with new information.
 
-    For similarity purposes, the register is also inserted in the elasticsearch index,
-    all the elastic search fields are filled with the information from the register and it is
-    handled by Mohan's Similarity class.
+    Parameters
+    ----------
+    oa_reg : dict
+        A record from openalex
+    colav_reg : dict
+        Register from the colav database (kahi database for impactu)
+    db : pymongo.database.Database
+        Database connection to colav database.
+    collection : pymongo.collection.Collection
+        Collection to insert the register. Colav database collection for works.
+    empty_work : dict
+        A template for a work entry, with empty fields.
+    resolver : EntityResolver
+        Cache to resolve the external ids of person, affiliations and subjects.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    update = build_update(oa_reg, colav_reg, db, empty_work, resolver, verbose=verbose)
+    if update:
+        collection.update_one({"_id": colav_reg["_id"]}, {"$set": update})
 
-    The register is also linked to the source of the register, and the authors and affiliations are searched in the database.
+
+def build_insert(oa_reg, db, empty_work, resolver, verbose=0):
+    """
+    Function to build a new register for the colav(kahi works) database from an openalex record.
+
+    The register is linked to the source of the register, and the authors and affiliations are searched in the database.
 
     Parameters
     ----------
-    scholar_reg : dict
+    oa_reg : dict
         Register from the openalex database
     db : pymongo.database.Database
         Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
     empty_work : dict
         Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    resolver : EntityResolver
+        Cache to resolve the external ids of person, affiliations, sources and subjects.
     verbose : int, optional
         Verbosity level. The default is 0
+
+    Returns
+    -------
+    dict
+        The register ready to be inserted in the works collection.
     """
 
     # parse
@@ -206,21 +224,13 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     if entry["source"]:
         if "external_ids" in entry["source"].keys():
             for ext in entry["source"]["external_ids"]:
-                source_db = db["sources"].find_one(
-                    {"external_ids.id": ext["id"]})
+                source_db = resolver.source(ext["id"])
                 if source_db:
                     break
     if source_db:
-        name = source_db["names"][0]["name"]
-        for n in source_db["names"]:
-            if n["lang"] == "es":
-                name = n["name"]
-                break
-            if n["lang"] == "en":
-                name = n["name"]
         entry["source"] = {
             "id": source_db["_id"],
-            "name": name
+            "name": source_db["name"]
         }
     else:
         if entry["source"]:
@@ -237,19 +247,11 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     for subjects in entry["subjects"]:
         for i, subj in enumerate(subjects["subjects"]):
             for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
+                sub_db = resolver.subject(ext["id"])
                 if sub_db:
-                    name = sub_db["names"][0]["name"]
-                    for n in sub_db["names"]:
-                        if n["lang"] == "en":
-                            name = n["name"]
-                            break
-                        elif n["lang"] == "es":
-                            name = n["name"]
                     entry["subjects"][0]["subjects"][i] = {
                         "id": sub_db["_id"],
-                        "name": name,
+                        "name": sub_db["name"],
                         "level": sub_db["level"]
                     }
                     break
@@ -258,38 +260,27 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     for i, author in enumerate(entry["authors"]):
         author_db = None
         for ext in author["external_ids"]:  # given priority to scienti person
-            author_db = db["person"].find_one(
-                {"external_ids.id": ext["id"], "updated.source": "scienti"})
+            author_db = resolver.person(ext["id"], "scienti")
             if author_db:
                 break
         if not author_db:  # if not found ids with scienti, let search it with openalex
             for ext in author["external_ids"]:
-                author_db = db["person"].find_one(
-                    {"external_ids.id": ext["id"], "updated.source": "openalex"})
+                author_db = resolver.person(ext["id"], "openalex")
                 if author_db:
                     break
         if not author_db:  # if not found ids with scienti/openalex, let search it with other sources
             for ext in author["external_ids"]:
-                author_db = db["person"].find_one(
-                    {"external_ids.id": ext["id"]})
+                author_db = resolver.person(ext["id"])
                 if author_db:
                     break
         if author_db:
-            sources = [ext["source"]
-                       for ext in author_db["external_ids"]]
-            ids = [ext["id"] for ext in author_db["external_ids"]]
-            for ext in author["external_ids"]:
-                if ext["id"] not in ids:
-                    author_db["external_ids"].append(ext)
-                    sources.append(ext["source"])
-                    ids.append(ext["id"])
             entry["authors"][i] = {
                 "id": author_db["_id"],
                 "full_name": author_db["full_name"],
                 "affiliations": author["affiliations"]
             }
             aff_units = get_units_affiations(
-                db, author_db, author["affiliations"])
+                db, author_db, author["affiliations"], resolver)
             for aff_unit in aff_units:
                 if aff_unit not in author["affiliations"]:
                     author["affiliations"].append(aff_unit)
@@ -301,23 +292,15 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                 print(
                     f"WARNING: author not found in db {author} maybe deleted author in openalex, trying to find by name")
             author_db = db["person"].find_one(
-                {"full_name": author["full_name"]})
+                {"full_name": author["full_name"]}, {"_id": 1, "full_name": 1, "affiliations": 1})
             if author_db:
-                sources = [ext["source"]
-                           for ext in author_db["external_ids"]]
-                ids = [ext["id"] for ext in author_db["external_ids"]]
-                for ext in author["external_ids"]:
-                    if ext["id"] not in ids:
-                        author_db["external_ids"].append(ext)
-                        sources.append(ext["source"])
-                        ids.append(ext["id"])
                 entry["authors"][i] = {
                     "id": author_db["_id"],
                     "full_name": author_db["full_name"],
                     "affiliations": author["affiliations"]
                 }
                 aff_units = get_units_affiations(
-                    db, author_db, author["affiliations"])
+                    db, author_db, author["affiliations"], resolver)
                 for aff_unit in aff_units:
                     if aff_unit not in author["affiliations"]:
                         author["affiliations"].append(aff_unit)
@@ -336,23 +319,13 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                     continue
             if "external_ids" in aff.keys():
                 for ext in aff["external_ids"]:
-                    aff_db = db["affiliations"].find_one(
-                        {"external_ids.id": ext["id"]})
+                    aff_db = resolver.affiliation(ext["id"])
                     if aff_db:
                         break
             if aff_db:
-                name = aff_db["names"][0]["name"]
-                for n in aff_db["names"]:
-                    if n["source"] == "ror":
-                        name = n["name"]
-                        break
-                    if n["lang"] == "en":
-                        name = n["name"]
-                    if n["lang"] == "es":
-                        name = n["name"]
                 entry["authors"][i]["affiliations"][j] = {
                     "id": aff_db["_id"],
-                    "name": name,
+                    "name": aff_db["name"],
                     "types": aff_db["types"]
                 }
             else:
@@ -381,31 +354,177 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                     }
 
     entry["author_count"] = len(entry["authors"])
+    return entry
+
+
+def get_es_work(entry):
+    """
+    Function to build the elasticsearch document used by Mohan's Similarity class from a colav register.
+
+    Parameters
+    ----------
+    entry : dict
+        Register of the works collection.
+
+    Returns
+    -------
+    dict
+        work with the fields title, source, year, volume, issue, first_page, last_page, authors and provenance.
+    """
+    work = {}
+    work["title"] = entry["titles"][0]["title"]
+    work["source"] = entry["source"]["name"] if "name" in entry["source"].keys() else ""
+    work["year"] = entry["year_published"]
+    work["volume"] = entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else ""
+    work["issue"] = entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else ""
+    work["first_page"] = entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else ""
+    work["last_page"] = entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
+    authors = []
+    for author in entry['authors']:
+        if len(authors) >= 5:
+            break
+        if "full_name" in author.keys():
+            authors.append(author["full_name"])
+    work["authors"] = authors
+    work["provenance"] = "openalex"
+    return work
+
+
+def process_one_insert(oa_reg, db, collection, empty_work, es_handler, resolver, verbose=0):
+    """
+    ""
+    Function to insert a new register in the database if it is not found in the colav(kahi works) database.
+    This means that the register is not on the database and it is being inserted.
+
+    For similarity purposes, the register is also inserted in the elasticsearch index,
+    all the elastic search fields are filled with the information from the register and it is
+    handled by Mohan's Similarity class.
+
+    The register is also linked to the source of the register, and the authors and affiliations are searched in the database.
+
+    Parameters
+    ----------
+    scholar_reg : dict
+        Register from the openalex database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    resolver : EntityResolver
+        Cache to resolve the external ids of person, affiliations, sources and subjects.
+    verbose : int, optional
+        Verbosity level. The default is 0
+    """
+    entry = build_insert(oa_reg, db, empty_work, resolver, verbose=verbose)
     # insert in mongo
     response = collection.insert_one(entry)
     # insert in elasticsearch
     if es_handler:
-        work = {}
-        work["title"] = entry["titles"][0]["title"]
-        work["source"] = entry["source"]["name"] if "name" in entry["source"].keys() else ""
-        work["year"] = entry["year_published"]
-        work["volume"] = entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else ""
-        work["issue"] = entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else ""
-        work["first_page"] = entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else ""
-        work["last_page"] = entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
-        authors = []
-        for author in entry['authors']:
-            if len(authors) >= 5:
-                break
-            if "full_name" in author.keys():
-                authors.append(author["full_name"])
-        work["authors"] = authors
-        work["provenance"] = "openalex"
+        es_handler.insert_work(_id=str(response.inserted_id), work=get_es_work(entry))
 
-        es_handler.insert_work(_id=str(response.inserted_id), work=work)
 
+def get_handlers(config, client, es_handler, backend):
+    """
+    Function to get the mongodb client and the elasticsearch handler for a worker.
+    With the threading backend the handlers of the plugin are shared, otherwise new ones are created.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary of the plugin.
+    client : pymongo.MongoClient
+        Client of the plugin, used with the threading backend.
+    es_handler : Similarity
+        Elasticsearch handler of the plugin, used with the threading backend.
+    backend : str
+        joblib backend.
+
+    Returns
+    -------
+    tuple
+        (client, es_handler)
+    """
+    if backend == "threading":
+        return client, es_handler
+    client = MongoClient(config["database_url"])
+    es_handler = None
+    if "local_index" in config["openalex_works"].keys():
+        es_handler = LocalSimilarity(config["openalex_works"]["local_index"])
+    elif "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
+        es_index = config["openalex_works"]["es_index"]
+        es_url = config["openalex_works"]["es_url"]
+        if config["openalex_works"]["es_user"] and config["openalex_works"]["es_password"]:
+            es_auth = (config["openalex_works"]["es_user"],
+                       config["openalex_works"]["es_password"])
+        else:
+            es_auth = None
+        es_handler = Similarity(
+            es_index, es_uri=es_url, es_auth=es_auth, es_req_timeout=300, es_max_retries=5, es_retry_on_timeout=True)
+    else:
+        print("WARNING: No elasticsearch configuration provided")
+    return client, es_handler
+
+
+def similar_query(oa_reg):
+    """
+    Function to build the arguments of the elasticsearch similarity search (Similarity.search_work) of a openalex record.
+
+    Parameters
+    ----------
+    oa_reg : dict
+        Register from the openalex database
+
+    Returns
+    -------
+    dict
+        Arguments of search_work
+    """
+    authors = []
+    for author in oa_reg['authorships']:
+        if "display_name" in author["author"].keys():
+            authors.append(author["author"]["display_name"])
+    source = ""
+    if oa_reg["primary_location"]:
+        if "source" in oa_reg["primary_location"].keys():
+            if oa_reg["primary_location"]["source"]:
+                if "display_name" in oa_reg["primary_location"]["source"].keys():
+                    source = oa_reg["primary_location"]["source"]["display_name"]
+    return {
+        "title": oa_reg["title"],
+        "source": source,
+        "year": str(oa_reg["publication_year"]),
+        "authors": authors,
+        "volume": oa_reg["biblio"]["volume"],
+        "issue": oa_reg["biblio"]["issue"],
+        "page_start": oa_reg["biblio"]["first_page"],
+        "page_end": oa_reg["biblio"]["last_page"],
+    }
+
+
+def search_similar(oa_reg, es_handler):
+    """
+    Function to search a openalex record without doi in the elasticsearch index.
 
-def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose=0):
+    Parameters
+    ----------
+    oa_reg : dict
+        Register from the openalex database
+    es_handler : Similarity | BatchSearch
+        Elasticsearch handler, Mohan's Similarity class.
+
+    Returns
+    -------
+    dict | None
+        The elasticsearch hit of the similar work or None if not found.
+    """
+    return es_handler.search_work(**similar_query(oa_reg))
+
+
+def process_one(oa_reg, config, empty_work, client, es_handler, backend, resolver=None, verbose=0):
     """
     Function to process a single register from the scholar database.
     This function is used to insert or update a register in the colav(kahi works) database.
@@ -422,29 +541,17 @@ def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose
         Empty dictionary with the structure of a register in the database
     es_handler : Similarity
         Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    resolver : EntityResolver, optional
+        Shared cache to resolve person, affiliations, sources and subjects (threading backend only),
+        if not provided a new one is created for this register.
     verbose : int, optional
         Verbosity level. The default is 0.
     """
-    if backend != "threading":
-        client = MongoClient(config["database_url"])
+    client, es_handler = get_handlers(config, client, es_handler, backend)
     db = client[config["database_name"]]
     collection = db["works"]
-
-    if backend != "threading":
-        es_handler = None
-        if "es_index" in config["openalex_works"].keys() and "es_url" in config["openalex_works"].keys() and "es_user" in config["openalex_works"].keys() and "es_password" in config["openalex_works"].keys():
-            es_index = config["openalex_works"]["es_index"]
-            es_url = config["openalex_works"]["es_url"]
-            if config["openalex_works"]["es_user"] and config["openalex_works"]["es_password"]:
-                es_auth = (config["openalex_works"]["es_user"],
-                           config["openalex_works"]["es_password"])
-            else:
-                es_auth = None
-            es_handler = Similarity(
-                es_index, es_uri=es_url, es_auth=es_auth, es_req_timeout=300, es_max_retries=5, es_retry_on_timeout=True)
-        else:
-            es_handler = None
-            print("WARNING: No elasticsearch configuration provided")
+    if backend != "threading" or resolver is None:
+        resolver = EntityResolver(db)
 
     doi = oa_reg["doi"]
 
@@ -453,34 +560,15 @@ def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose
         colav_reg = collection.find_one({"external_ids.id": doi})
         if colav_reg:  # update the register
             process_one_update(
-                oa_reg, colav_reg, db, collection, empty_work, verbose=verbose)
+                oa_reg, colav_reg, db, collection, empty_work, resolver, verbose=verbose)
         else:  # insert a new register
             process_one_insert(
-                oa_reg, db, collection, empty_work, es_handler, verbose=verbose)
+                oa_reg, db, collection, empty_work, es_handler, resolver, verbose=verbose)
     else:  # does not have a doi identifier
         # elasticsearch section
         if es_handler:
             # Search in elasticsearch
-            authors = []
-            for author in oa_reg['authorships']:
-                if "display_name" in author["author"].keys():
-                    authors.append(author["author"]["display_name"])
-            source = ""
-            if oa_reg["primary_location"]:
-                if "source" in oa_reg["primary_location"].keys():
-                    if oa_reg["primary_location"]["source"]:
-                        if "display_name" in oa_reg["primary_location"]["source"].keys():
-                            source = oa_reg["primary_location"]["source"]["display_name"]
-            response = es_handler.search_work(
-                title=oa_reg["title"],
-                source=source,
-                year=str(oa_reg["publication_year"]),
-                authors=authors,
-                volume=oa_reg["biblio"]["volume"],
-                issue=oa_reg["biblio"]["issue"],
-                page_start=oa_reg["biblio"]["first_page"],
-                page_end=oa_reg["biblio"]["last_page"],
-            )
+            response = search_similar(oa_reg, es_handler)
 
             if response:  # register already on db... update accordingly
                 found = collection.count_documents(
@@ -488,11 +576,10 @@ def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose
                     # to avoid things like https://github.com/colav/impactu/issues/181
                     {"exteral_ids.id": oa_reg["id"]})
                 if found:
-                    colav_reg = collection.find_one(
-                        {"_id": ObjectId(response["_id"])})
+                    colav_reg = find_work(collection, es_handler, response["_id"])
                     if colav_reg:
                         process_one_update(oa_reg, colav_reg, db,
-                                           collection, empty_work, verbose=verbose)
+                                           collection, empty_work, resolver, verbose=verbose)
                     else:
                         if verbose > 4:
                             print("Register with {} not found in mongodb".format(
@@ -500,16 +587,169 @@ def process_one(oa_reg, config, empty_work, client, es_handler, backend, verbose
                             print(response)
                 else:
                     process_one_insert(oa_reg, db, collection,
-                                       empty_work, es_handler, verbose=0)
+                                       empty_work, es_handler, resolver, verbose=0)
 
             else:  # insert new register
                 if verbose > 4:
                     print("INFO: found no register in elasticsearch")
                 process_one_insert(oa_reg, db, collection,
-                                   empty_work, es_handler, verbose=0)
+                                   empty_work, es_handler, resolver, verbose=0)
+        else:
+            if verbose > 4:
+                print("No elasticsearch index provided")
+    if backend != "threading":
+        client.close()
+        if es_handler:
+            es_handler.close()
+
+
+def process_chunk(oa_regs, config, empty_work, client, es_handler, backend, resolver=None, verbose=0):
+    """
+    Function to process a chunk of registers from the openalex database.
+    The registers are resolved in memory and written with one unordered bulk_write to mongodb
+    and one insert_bulk to the elasticsearch index.
+
+    Works with doi are looked up in the colav database with a single query for the whole chunk,
+    the similarity queries of the works without doi are sent in a single _msearch request (see kahi_similarity_utils.es_batch.BatchSearch).
+    Duplicated records (same doi) inside the chunk are only processed once.
+
+    Parameters
+    ----------
+    oa_regs : list
+        Registers from the openalex database
+    config : dict
+        The configuration dictionary of the plugin.
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database, copied for every register.
+    client : pymongo.MongoClient
+        Client of the plugin, used with the threading backend.
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    backend : str
+        joblib backend.
+    resolver : EntityResolver, optional
+        Shared cache to resolve person, affiliations, sources and subjects (threading backend only),
+        if not provided a new one is created for this chunk.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    client, es_handler = get_handlers(config, client, es_handler, backend)
+    db = client[config["database_name"]]
+    collection = db["works"]
+    if backend != "threading" or resolver is None:
+        resolver = EntityResolver(db)
+    if es_handler:
+        # similarity queries of the records without doi in a single request
+        es_handler = BatchSearch(es_handler, collection)
+        es_handler.prefetch([similar_query(oa_reg) for oa_reg in oa_regs if not oa_reg["doi"]])
+
+    dois = [oa_reg["doi"] for oa_reg in oa_regs if oa_reg["doi"]]
+    colav_regs = {}
+    if dois:
+        for colav_reg in collection.find({"external_ids.id": {"$in": dois}}):
+            for ext in colav_reg["external_ids"]:
+                colav_regs.setdefault(ext["id"], colav_reg)
+
+    operations = []
+    es_entries = []
+    seen = set()
+    for oa_reg in oa_regs:
+        doi = oa_reg["doi"]
+        colav_reg = None
+        if doi:
+            if doi in seen:
+                continue
+            seen.add(doi)
+            colav_reg = colav_regs.get(doi)
+        elif es_handler:
+            response = search_similar(oa_reg, es_handler)
+            if response:
+                found = collection.count_documents(
+                    # we are assuming here, all works of apenalex are unique.
+                    # to avoid things like https://github.com/colav/impactu/issues/181
+                    {"exteral_ids.id": oa_reg["id"]})
+                if found:
+                    colav_reg = find_work(collection, es_handler, response["_id"])
+                    if not colav_reg:
+                        if verbose > 4:
+                            print("Register with {} not found in mongodb".format(
+                                response["_id"]))
+                            print(response)
+                        continue
         else:
             if verbose > 4:
                 print("No elasticsearch index provided")
+            continue
+
+        if colav_reg:
+            update = build_update(oa_reg, colav_reg, db, deepcopy(empty_work), resolver, verbose=verbose)
+            if update:
+                operations.append(UpdateOne({"_id": colav_reg["_id"]}, {"$set": update}))
+        else:
+            entry = build_insert(oa_reg, db, deepcopy(empty_work), resolver, verbose=verbose if doi else 0)
+            entry["_id"] = ObjectId()
+            operations.append(InsertOne(entry))
+            if es_handler:
+                work = get_es_work(entry)
+                # same normalization applied by Similarity.insert_work
+                for key in work.keys():
+                    if key == "authors":
+                        work[key] = [es_handler.str_normilize(author) for author in work[key]]
+                    else:
+                        work[key] = es_handler.str_normilize(str(work[key]))
+                es_entries.append({
+                    "_index": es_handler.es_index,
+                    "_id": str(entry["_id"]),
+                    "_source": work
+                })
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    if es_entries:
+        es_handler.insert_bulk(es_entries)
+
+    if backend != "threading":
+        client.close()
+        if es_handler:
+            es_handler.close()
+
+
+def process_block(oa_regs, config, empty_work, client, es_handler, backend, resolver=None, verbose=0):
+    """
+    Function to process a block of registers from the openalex database one by one with process_one,
+    the similarity queries of the registers without doi are sent in a single _msearch request and the works
+    of the hits are read with a single query (see kahi_similarity_utils.es_batch.BatchSearch).
+
+    Parameters
+    ----------
+    oa_regs : list
+        Registers from the openalex database
+    config : dict
+        The configuration dictionary of the plugin.
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database, copied for every register.
+    client : pymongo.MongoClient
+        Client of the plugin, used with the threading backend.
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    backend : str
+        joblib backend.
+    resolver : EntityResolver, optional
+        Shared cache to resolve person, affiliations, sources and subjects (threading backend only),
+        if not provided a new one is created for this block.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    """
+    client, es_handler = get_handlers(config, client, es_handler, backend)
+    if backend != "threading" or resolver is None:
+        resolver = EntityResolver(client[config["database_name"]])
+    handler = es_handler
+    if es_handler:
+        handler = BatchSearch(es_handler, client[config["database_name"]]["works"])
+        handler.prefetch([similar_query(oa_reg) for oa_reg in oa_regs if not oa_reg["doi"]])
+    for oa_reg in oa_regs:
+        # the handlers of the block are shared by its records
+        process_one(oa_reg, config, deepcopy(empty_work), client, handler, "threading", resolver=resolver, verbose=verbose)
     if backend != "threading":
         client.close()
         if es_handler:
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class EntityResolver:
+    """
+    In-memory cache to resolve external ids (external_ids.id) of person, affiliations, sources and subjects
+    into compact records from the colav database, and the relations between affiliations.
+
+    The cache is lazily populated and bounded with a LRU policy per collection, misses are cached as well
+    (entities are not created by the works plugin, so a missing id stays missing during the run).
+    All the operations are protected with a lock, so a single instance can be shared between the workers
+    of the threading joblib backend.
+
+    The returned records are shared between threads, they must be treated as read-only.
+    """
+
+    collections = ["person", "affiliations", "sources", "subjects", "relations"]
+
+    def __init__(self, db, max_size=100000):
+        """
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            Database connection to colav database.
+        max_size : int, optional
+            Maximum number of entries per collection kept in memory. The default is 100000.
+        """
+        self.db = db
+        self.max_size = max_size
+        self.lock = Lock()
+        self.cache = {name: OrderedDict() for name in self.collections}
+        self.hits = {name: 0 for name in self.collections}
+        self.misses = {name: 0 for name in self.collections}
+
+    def _get(self, name, key, loader):
+        """
+        Returns the cached value for key in the cache of the collection name,
+        calling loader on a miss and storing its result.
+        """
+        cache = self.cache[name]
+        with self.lock:
+            if key in cache:
+                cache.move_to_end(key)
+                self.hits[name] += 1
+                return cache[key]
+            self.misses[name] += 1
+        value = loader()
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_size:
+                cache.popitem(last=False)
+        return value
+
+    def person(self, ext_id, source=None):
+        """
+        Finds a person by external id, optionally restricted to persons updated by the given source.
+
+        Returns
+        -------
+        dict | None
+            {"_id", "full_name", "affiliations"} or None if not found.
+        """
+        def loader():
+            query = {"external_ids.id": ext_id}
+            if source:
+                query["updated.source"] = source
+            return self.db["person"].find_one(
+                query, {"_id": 1, "full_name": 1, "affiliations": 1})
+        return self._get("person", (ext_id, source), loader)
+
+    def affiliation(self, ext_id):
+        """
+        Finds an affiliation by external id.
+        The name is selected giving priority to ror, then spanish and then english names.
+
+        Returns
+        -------
+        dict | None
+            {"_id", "name", "types"} or None if not found.
+        """
+        def loader():
+            aff_db = self.db["affiliations"].find_one(
+                {"external_ids.id": ext_id}, {"_id": 1, "names": 1, "types": 1})
+            if not aff_db:
+                return None
+            name = aff_db["names"][0]["name"]
+            for n in aff_db["names"]:
+                if n["source"] == "ror":
+                    name = n["name"]
+                    break
+                if n["lang"] == "en":
+                    name = n["name"]
+                if n["lang"] == "es":
+                    name = n["name"]
+            return {"_id": aff_db["_id"], "name": name, "types": aff_db["types"]}
+        return self._get("affiliations", ext_id, loader)
+
+    def source(self, ext_id):
+        """
+        Finds a source by external id.
+        The name is selected giving priority to spanish and then english names.
+
+        Returns
+        -------
+        dict | None
+            {"_id", "name"} or None if not found.
+        """
+        def loader():
+            source_db = self.db["sources"].find_one(
+                {"external_ids.id": ext_id}, {"_id": 1, "names": 1})
+            if not source_db:
+                return None
+            name = source_db["names"][0]["name"]
+            for n in source_db["names"]:
+                if n["lang"] == "es":
+                    name = n["name"]
+                    break
+                if n["lang"] == "en":
+                    name = n["name"]
+            return {"_id": source_db["_id"], "name": name}
+        return self._get("sources", ext_id, loader)
+
+    def subject(self, ext_id):
+        """
+        Finds a subject by external id.
+        The name is selected giving priority to english and then spanish names.
+
+        Returns
+        -------
+        dict | None
+            {"_id", "name", "level"} or None if not found.
+        """
+        def loader():
+            sub_db = self.db["subjects"].find_one(
+                {"external_ids.id": ext_id}, {"_id": 1, "names": 1, "level": 1})
+            if not sub_db:
+                return None
+            name = sub_db["names"][0]["name"]
+            for n in sub_db["names"]:
+                if n["lang"] == "en":
+                    name = n["name"]
+                    break
+                elif n["lang"] == "es":
+                    name = n["name"]
+            return {"_id": sub_db["_id"], "name": name, "level": sub_db["level"]}
+        return self._get("subjects", ext_id, loader)
+
+    def related(self, aff_id, institution_id):
+        """
+        Checks if an affiliation has a relation with an institution (ex: a faculty of a university).
+
+        Returns
+        -------
+        bool
+            True if the institution is in the relations of the affiliation.
+        """
+        def loader():
+            return self.db["affiliations"].count_documents(
+                {"_id": aff_id, "relations.id": institution_id}) > 0
+        return self._get("relations", (aff_id, institution_id), loader)
+
+    def stats(self):
+        """
+        Returns the hits, misses and size of the cache per collection.
+
+        Returns
+        -------
+        dict
+            {collection: {"hits": int, "misses": int, "size": int}}
+        """
+        with self.lock:
+            return {name: {"hits": self.hits[name],
+                           "misses": self.misses[name],
+                           "size": len(self.cache[name])}
+                    for name in self.collections}
+
+    def report(self):
+        """
+        Prints the hits and misses of the cache per collection, useful to size max_size.
+        """
+        for name, stat in self.stats().items():
+            total = stat["hits"] + stat["misses"]
+            ratio = stat["hits"] / total if total else 0
+            print(
+                f"INFO: entity cache {name}: hits={stat['hits']} misses={stat['misses']} size={stat['size']} hit_ratio={ratio:.2f}")
@@ -85,7 +85,8 @@ def main():
             'joblib',
             'kahi_impactu_utils>=0.0.10',
             'mohan',
-            'thefuzz'
+            'thefuzz',
+            'Kahi_similarity_utils'
         ],
     )
 
@@ -3,6 +3,7 @@ from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
 
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
 from kahi_scholar_works.process_one import process_one
 
 
@@ -61,7 +62,11 @@ class Kahi_scholar_works(KahiBase):
         self.scholar_collection = self.scholar_db[config["scholar_works"]
                                                   ["collection_name"]]
 
-        if "es_index" in config["scholar_works"].keys() and "es_url" in config["scholar_works"].keys() and "es_user" in config["scholar_works"].keys() and "es_password" in config["scholar_works"].keys():
+        if "local_index" in config["scholar_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["scholar_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif "es_index" in config["scholar_works"].keys() and "es_url" in config["scholar_works"].keys() and "es_user" in config["scholar_works"].keys() and "es_password" in config["scholar_works"].keys():
             es_index = config["scholar_works"]["es_index"]
             es_url = config["scholar_works"]["es_url"]
             if config["scholar_works"]["es_user"] and config["scholar_works"]["es_password"]:
@@ -1,12 +1,29 @@
 from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
-from kahi_scienti_works.process_one import process_one
+from kahi_scienti_works.process_one import process_one, process_block
+from kahi_similarity_utils.checkpoint import Checkpoint, paginate, parse_id
+from kahi_similarity_utils.pending import PendingInserts
 from mohan.Similarity import Similarity
+from kahi_similarity_utils.local_similarity import LocalSimilarity
 from kahi_impactu_utils.Utils import doi_processor
 import re
 
 
+def chunked(cursor, size):
+    """
+    Generator that groups the records of a cursor (or any iterable) in lists of the given size.
+    """
+    chunk = []
+    for reg in cursor:
+        chunk.append(reg)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class Kahi_scienti_works(KahiBase):
 
     config = {}
@@ -26,10 +43,15 @@ class Kahi_scienti_works(KahiBase):
                 - task: the task to be performed. It can be "doi" or "all"
                 - num_jobs: the number of jobs to be used in parallel processing
                 - verbose: the verbosity level
+                - checkpoint: if True, the last processed _id is saved in the checkpoints collection of the
+                  log database and a new run resumes from it (default False)
+                - page_size: the number of records processed between checkpoints (default 1000)
                 - databases: a list of dictionaries with the following keys:
                     - database_url: the URL for the MongoDB database
                     - database_name: the name of the database
                     - collection_name: the name of the collection
+                    - start_id: optional first _id to process (inclusive)
+                    - end_id: optional last _id to process (inclusive)
                     - es_index: the name of the Elasticsearch index
                     - es_url: the URL for the Elasticsearch server
                     - es_user: the username for the Elasticsearch server
@@ -49,7 +71,11 @@ class Kahi_scienti_works(KahiBase):
         self.collection.create_index("authors.id")
         self.collection.create_index([("titles.title", TEXT)])
         self.collection.create_index("external_ids.id")
-        if "es_index" in config["scienti_works"].keys() and "es_url" in config["scienti_works"].keys() and "es_user" in config["scienti_works"].keys() and "es_password" in config["scienti_works"].keys():  # noqa: E501
+        if "local_index" in config["scienti_works"].keys():
+            # embedded similarity index (sqlite), alternative to elasticsearch
+            self.es_handler = LocalSimilarity(config["scienti_works"]["local_index"])
+            print("INFO: Local similarity index opened successfully")
+        elif "es_index" in config["scienti_works"].keys() and "es_url" in config["scienti_works"].keys() and "es_user" in config["scienti_works"].keys() and "es_password" in config["scienti_works"].keys():  # noqa: E501
             es_index = config["scienti_works"]["es_index"]
             es_url = config["scienti_works"]["es_url"]
             if config["scienti_works"]["es_user"] and config["scienti_works"]["es_password"]:
@@ -70,6 +96,17 @@ class Kahi_scienti_works(KahiBase):
         ) else 1
         self.verbose = config["scienti_works"]["verbose"] if "verbose" in config["scienti_works"].keys(
         ) else 0
+        self.checkpoint = config["scienti_works"]["checkpoint"] if "checkpoint" in config["scienti_works"].keys(
+        ) else False
+        self.checkpoint_db = self.client[config["log_database"]] if "log_database" in config.keys() else self.db
+        self.page_size = config["scienti_works"]["page_size"] if "page_size" in config["scienti_works"].keys(
+        ) else 1000
+        self.es_batch_size = config["scienti_works"]["es_batch_size"] if "es_batch_size" in config["scienti_works"].keys(
+        ) else 1
+        # works inserted by the workers not visible yet in the index, 0 disables the registry
+        self.pending_size = config["scienti_works"]["pending_size"] if "pending_size" in config["scienti_works"].keys(
+        ) else 10000
+        self.pending = PendingInserts(self.pending_size) if self.pending_size > 0 else None
 
         # checking if the databases and collections are available
         self.check_databases_and_collections()
@@ -119,6 +156,94 @@ class Kahi_scienti_works(KahiBase):
             process_one(reg, db, collection, empty_work,
                         es_handler, similarity, verbose)
 
+    def get_checkpoint(self, config, task):
+        """
+        Method to get the checkpoint of a task for a scienti collection and the last _id processed.
+
+        Parameters
+        ----------
+        config : dict
+            A dictionary with the configuration for the scienti database, its start_id and end_id are part of the key.
+        task : str
+            Name of the task, ex: doi, bad_doi, no_doi.
+
+        Returns
+        -------
+        tuple
+            (Checkpoint, last_id), (None, None) if checkpoints are disabled.
+        """
+        if not self.checkpoint:
+            return None, None
+        checkpoint = Checkpoint(
+            self.checkpoint_db, f'scienti_works/{config["database_name"]}.{config["collection_name"]}/{task}',
+            start_id=parse_id(config["start_id"]) if "start_id" in config.keys() else None,
+            end_id=parse_id(config["end_id"]) if "end_id" in config.keys() else None)
+        last_id = checkpoint.load()
+        if last_id is not None:
+            print(f"INFO: resuming {task} after _id {last_id}")
+        return checkpoint, last_id
+
+    def run_pages(self, pages, job, checkpoint, block_size=None):
+        """
+        Method to run job over every item of the pages in parallel, the pages are processed one at a time.
+        When a page is done the keys of the pending inserts are dropped (the works inserted are in the index then)
+        and, if a checkpoint is given, the _id of the last item is saved, the checkpoint is cleared at the end.
+
+        Parameters
+        ----------
+        pages : iterable
+            Iterable of lists of documents with _id.
+        job : callable
+            Function to call with every document.
+        checkpoint : Checkpoint
+            Progress marker or None.
+        block_size : int, optional
+            If given, the items of every page are grouped in lists of block_size and job is called with every list.
+        """
+        def items(page):
+            return chunked(page, block_size) if block_size else page
+
+        with Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading") as parallel:
+            for page in pages:
+                parallel(delayed(job)(item) for item in items(page))
+                if checkpoint:
+                    checkpoint.save(page[-1]["_id"], len(page))
+                if self.pending:
+                    # the works inserted by the page are in the index now
+                    self.pending.flush()
+            if checkpoint:
+                checkpoint.clear()
+
+    def similarity_job(self, db, collection):
+        """
+        Returns the job and the block size to process the registers without doi: with es_batch_size > 1
+        the similarity queries of every block of registers are sent together (see process_block).
+        """
+        if self.es_batch_size > 1 and self.es_handler:
+            return (lambda works: process_block(
+                works,
+                db,
+                collection,
+                self.empty_work(),
+                self.es_handler,
+                similarity=True,
+                verbose=self.verbose,
+                pending=self.pending
+            ), self.es_batch_size)
+        return (lambda work: process_one(
+            work,
+            db,
+            collection,
+            self.empty_work(),
+            self.es_handler,
+            similarity=True,
+            verbose=self.verbose,
+            pending=self.pending
+        ), None)
+
     def process_scienti(self, db, collection, config):
         """
         Method to process the scienti database.
@@ -139,7 +264,11 @@ class Kahi_scienti_works(KahiBase):
             - es_url: the URL for the Elasticsearch server
             - es_user: the username for the Elasticsearch server
             - es_password: the password for the Elasticsearch server
+            - start_id: optional first _id to process (inclusive)
+            - end_id: optional last _id to process (inclusive)
         """
+        start_id = parse_id(config["start_id"]) if "start_id" in config.keys() else None
+        end_id = parse_id(config["end_id"]) if "end_id" in config.keys() else None
         client = MongoClient(config["database_url"])
         scienti = client[config["database_name"]][config["collection_name"]]
         types_level0 = ['111', '112', '113', '114',  # articulos
@@ -164,13 +293,24 @@ class Kahi_scienti_works(KahiBase):
                 {"$project": {"doi": {"$toLower": "$doi"}}},
                 {"$group": {"_id": "$doi", "ids": {"$push": "$_id"}}}
             ]
+            if start_id is not None or end_id is not None:
+                bounds = {}
+                if start_id is not None:
+                    bounds["$gte"] = start_id
+                if end_id is not None:
+                    bounds["$lte"] = end_id
+                pipeline.insert(0, {"$match": {"_id": bounds}})
+            checkpoint, last_doi = self.get_checkpoint(config, "doi")
+            if checkpoint:
+                # the groups are keyed by doi, the marker is the last doi processed
+                pipeline.append({"$sort": {"_id": 1}})
+                if last_doi is not None:
+                    pipeline.append({"$match": {"_id": {"$gt": last_doi}}})
             paper_group_doi_cursor = scienti.aggregate(
-                pipeline)  # update for doi and not doi
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(self.process_doi_group)(
+                pipeline, allowDiskUse=True)  # update for doi and not doi
+            self.run_pages(
+                chunked(paper_group_doi_cursor, self.page_size),
+                lambda doi_group: self.process_doi_group(
                     doi_group,
                     db,
                     collection,
@@ -179,7 +319,8 @@ class Kahi_scienti_works(KahiBase):
                     self.es_handler,
                     similarity=False,
                     verbose=self.verbose
-                ) for doi_group in paper_group_doi_cursor
+                ),
+                checkpoint
             )
         else:
             # correr doi processor para TXT_DOI y TXT_WEBSITE*
@@ -220,42 +361,38 @@ class Kahi_scienti_works(KahiBase):
                 if not doi:
                     works_nodoi.extend(scienti_reg["ids"])
             print(f"INFO: processing {len(works_nodoi)} records with bad dois")
-            paper_cursor = scienti.find(
-                {"_id": {"$in": works_nodoi}, "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    work,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    self.es_handler,
-                    similarity=True,
-                    verbose=self.verbose
-                ) for work in paper_cursor
+            checkpoint, last_id = self.get_checkpoint(config, "bad_doi")
+            works_nodoi = sorted(works_nodoi)
+            if last_id is not None:
+                works_nodoi = [i for i in works_nodoi if i > last_id]
+            elif start_id is not None:
+                works_nodoi = [i for i in works_nodoi if i >= start_id]
+            if end_id is not None:
+                works_nodoi = [i for i in works_nodoi if i <= end_id]
+            pages = (
+                list(scienti.find(
+                    {"_id": {"$in": ids}, "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}).sort("_id", 1))
+                for ids in chunked(works_nodoi, self.page_size)
+            )
+            job, block_size = self.similarity_job(db, collection)
+            self.run_pages(
+                (page for page in pages if page),
+                job,
+                checkpoint,
+                block_size
             )
 
-            paper_cursor = scienti.find(
-                {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
-            paper_cursor_count = scienti.count_documents(
-                {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}})
+            query = {"$or": [{"doi": {"$eq": ""}}, {"doi": {"$eq": None}}], "TXT_NME_PROD_FILTRO": {"$ne": None}, "TXT_NME_PROD": {"$ne": ' '}, "product_type.COD_TIPO_PRODUCTO": {"$in": types_level0}}
+            paper_cursor_count = scienti.count_documents(query)
             print(f"INFO: processing {paper_cursor_count} records without doi")
 
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    work,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    self.es_handler,
-                    similarity=True,
-                    verbose=self.verbose
-                ) for work in paper_cursor
+            checkpoint, last_id = self.get_checkpoint(config, "no_doi")
+            self.run_pages(
+                paginate(scienti, query, page_size=self.page_size,
+                         last_id=last_id, start_id=start_id, end_id=end_id),
+                job,
+                checkpoint,
+                block_size
             )
         client.close()
 
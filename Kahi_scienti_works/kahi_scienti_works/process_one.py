@@ -1,8 +1,9 @@
 from kahi_scienti_works.parser import parse_scienti
 from kahi_impactu_utils.Utils import lang_poll, doi_processor, compare_author, split_names, split_names_fix, check_date_format
 import re
+from kahi_similarity_utils.es_batch import BatchSearch, find_work
+from copy import deepcopy
 from time import time
-from bson import ObjectId
 
 
 def cod_product_mismatch(list1, list2):
@@ -759,27 +760,22 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
     else:
         if verbose > 4:
             print("No elasticsearch index provided")
+    return response.inserted_id
 
 
-def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity, verbose=0):
+def scienti_doi(scienti_reg):
     """
-    Function to process a single register from the scienti database.
-    This function is used to insert or update a register in the colav(kahi works) database.
+    Function to get the doi of a register of the scienti database, from TXT_DOI or TXT_WEB_PRODUCTO.
 
     Parameters
     ----------
     scienti_reg : dict
         Register from the scienti database
-    db : pymongo.database.Database
-        Database where the colav collections are stored, used to search for authors and affiliations.
-    collection : pymongo.collection.Collection
-        Collection in the database where the register is stored (Collection of works)
-    empty_work : dict
-        Empty dictionary with the structure of a register in the database
-    es_handler : Similarity
-        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
-    verbose : int, optional
-        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    str
+        The doi or None (or False) if the register has no valid doi.
     """
     doi = None
     # register has doi
@@ -797,6 +793,134 @@ def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity,
                     for keyword in ['abstract', 'homepage', 'tpmd200765', 'event_abstract']:
                         doi = doi.split(
                             f'/{keyword}')[0] if keyword in doi else doi
+    return doi
+
+
+def similarity_query(entry):
+    """
+    Function to build the arguments of the elasticsearch similarity search (Similarity.search_work) of a parsed register.
+
+    Parameters
+    ----------
+    entry : dict
+        Register parsed with parse_scienti
+
+    Returns
+    -------
+    dict
+        Arguments of search_work
+    """
+    work = {}
+    work["title"] = entry["titles"][0]["title"]
+    work["source"] = entry["source"]["name"] if "name" in entry["source"].keys(
+    ) else ""
+    work["year"] = entry["year_published"] if entry["year_published"] else "0"
+    work["volume"] = entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else ""
+    work["issue"] = entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else ""
+    work["first_page"] = entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else ""
+    work["last_page"] = entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
+    authors = []
+    for author in entry['authors']:
+        if len(authors) >= 5:
+            break
+        if "full_name" in author.keys():
+            authors.append(author["full_name"])
+    return {
+        "title": work["title"],
+        "source": work["source"],
+        "year": str(work["year"]),
+        "authors": authors,
+        "volume": work["volume"],
+        "issue": work["issue"],
+        "page_start": work["first_page"],
+        "page_end": work["last_page"]
+    }
+
+
+def process_similar(scienti_reg, entry, response, db, collection, empty_work, es_handler, verbose=0):
+    """
+    Function to update the similar work of a register without doi or to insert it as a new work.
+
+    Parameters
+    ----------
+    scienti_reg : dict
+        Register from the scienti database
+    entry : dict
+        Register parsed with parse_scienti
+    response : dict | None
+        Elasticsearch hit of the similar work, None if not found.
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+
+    Returns
+    -------
+    ObjectId | None
+        The _id of the work inserted, None if a work was updated.
+    """
+    if response:  # register already on db... update accordingly
+        colav_reg = find_work(collection, es_handler, response["_id"])
+        if colav_reg:
+            # TODO: add author check here before to do the update
+            if has_scienti_source(entry["external_ids"]) and has_scienti_source(colav_reg["external_ids"]):
+                if cod_product_mismatch(entry["external_ids"], colav_reg["external_ids"]):
+                    # if they have the same COD_RH  but different COD_PRODUCTO
+                    # then insert the new register
+                    return process_one_insert(scienti_reg, db, collection,
+                                              empty_work, es_handler, doi=None, verbose=verbose)
+            if has_scienti_source(entry["types"]) and has_scienti_source(colav_reg["types"]):
+                # if type is equal, then update the register
+                if check_first_level_type(entry["types"], colav_reg["types"]):
+                    process_one_update(scienti_reg, colav_reg, db,
+                                       collection, empty_work, verbose)
+                else:
+                    return process_one_insert(scienti_reg, db, collection,
+                                              empty_work, es_handler, doi=None, verbose=verbose)
+            else:  # there is not scienti types to compare, then update them
+                process_one_update(scienti_reg, colav_reg, db,
+                                   collection, empty_work, verbose)
+
+        else:
+            if verbose > 4:
+                print("Register with {} not found in mongodb".format(
+                    response["_id"]))
+                print(response)
+    else:  # insert new register
+        return process_one_insert(scienti_reg, db, collection,
+                                  empty_work, es_handler, doi=None, verbose=verbose)
+    return None
+
+
+def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity, verbose=0, pending=None):
+    """
+    Function to process a single register from the scienti database.
+    This function is used to insert or update a register in the colav(kahi works) database.
+
+    Parameters
+    ----------
+    scienti_reg : dict
+        Register from the scienti database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    pending : PendingInserts, optional
+        Registry of the works inserted by the other workers, checked before the elasticsearch search.
+    """
+    doi = scienti_doi(scienti_reg)
     if doi:
         # is the doi in colavdb?
         colav_reg = collection.find_one({"external_ids.id": doi})
@@ -813,66 +937,59 @@ def process_one(scienti_reg, db, collection, empty_work, es_handler, similarity,
             # Search in elasticsearch
             entry = parse_scienti(
                 scienti_reg, empty_work.copy(), verbose=verbose)
-            work = {}
-            work["title"] = entry["titles"][0]["title"]
-            work["source"] = entry["source"]["name"] if "name" in entry["source"].keys(
-            ) else ""
-            work["year"] = entry["year_published"] if entry["year_published"] else "0"
-            work["volume"] = entry["bibliographic_info"]["volume"] if "volume" in entry["bibliographic_info"].keys() else ""
-            work["issue"] = entry["bibliographic_info"]["issue"] if "issue" in entry["bibliographic_info"].keys() else ""
-            work["first_page"] = entry["bibliographic_info"]["first_page"] if "first_page" in entry["bibliographic_info"].keys() else ""
-            work["last_page"] = entry["bibliographic_info"]["last_page"] if "last_page" in entry["bibliographic_info"].keys() else ""
-            authors = []
-            for author in entry['authors']:
-                if len(authors) >= 5:
-                    break
-                if "full_name" in author.keys():
-                    authors.append(author["full_name"])
-            work["authors"] = authors
-            work["provenance"] = "scienti"
-            response = es_handler.search_work(
-                title=work["title"],
-                source=work["source"],
-                year=str(work["year"]),
-                authors=authors,
-                volume=work["volume"],
-                issue=work["issue"],
-                page_start=work["first_page"],
-                page_end=work["last_page"]
-            )
-
-            if response:  # register already on db... update accordingly
-                colav_reg = collection.find_one(
-                    {"_id": ObjectId(response["_id"])})
-                if colav_reg:
-                    # TODO: add author check here before to do the update
-                    if has_scienti_source(entry["external_ids"]) and has_scienti_source(colav_reg["external_ids"]):
-                        if cod_product_mismatch(entry["external_ids"], colav_reg["external_ids"]):
-                            # if they have the same COD_RH  but different COD_PRODUCTO
-                            # then insert the new register
-                            process_one_insert(scienti_reg, db, collection,
-                                               empty_work, es_handler, doi=None, verbose=verbose)
-                            return
-                    if has_scienti_source(entry["types"]) and has_scienti_source(colav_reg["types"]):
-                        # if type is equal, then update the register
-                        if check_first_level_type(entry["types"], colav_reg["types"]):
-                            process_one_update(scienti_reg, colav_reg, db,
-                                               collection, empty_work, verbose)
-                        else:
-                            process_one_insert(scienti_reg, db, collection,
-                                               empty_work, es_handler, doi=None, verbose=verbose)
-                    else:  # there is not scienti types to compare, then update them
-                        process_one_update(scienti_reg, colav_reg, db,
-                                           collection, empty_work, verbose)
-
-                else:
-                    if verbose > 4:
-                        print("Register with {} not found in mongodb".format(
-                            response["_id"]))
-                        print(response)
-            else:  # insert new register
-                process_one_insert(scienti_reg, db, collection,
-                                   empty_work, es_handler, doi=None, verbose=verbose)
+            query = similarity_query(entry)
+            claimed, pending_id = pending.claim(query["title"], query["year"]) if pending else (True, None)
+            inserted_id = None
+            try:
+                if claimed:
+                    response = es_handler.search_work(**query)
+                else:  # the same work was inserted by other worker
+                    response = {"_id": str(pending_id)}
+                inserted_id = process_similar(scienti_reg, entry, response, db, collection,
+                                              empty_work, es_handler, verbose)
+            finally:
+                if claimed and pending:
+                    pending.done(query["title"], query["year"], inserted_id)
         else:
             if verbose > 4:
                 print("No elasticsearch index provided")
+
+
+def process_block(scienti_regs, db, collection, empty_work, es_handler, similarity, verbose=0, pending=None):
+    """
+    Function to process a block of registers from the scienti database.
+    The elasticsearch similarity queries of the registers without doi are sent in a single _msearch request
+    and the works of the hits are read with a single query (see kahi_similarity_utils.es_batch.BatchSearch), then every register
+    is processed with process_one.
+
+    Parameters
+    ----------
+    scienti_regs : list
+        Registers from the scienti database
+    db : pymongo.database.Database
+        Database where the colav collections are stored, used to search for authors and affiliations.
+    collection : pymongo.collection.Collection
+        Collection in the database where the register is stored (Collection of works)
+    empty_work : dict
+        Empty dictionary with the structure of a register in the database, copied for every register.
+    es_handler : Similarity
+        Elasticsearch handler to insert the register in the elasticsearch index, Mohan's Similarity class.
+    similarity : bool
+        Flag to search the registers without doi in elasticsearch.
+    verbose : int, optional
+        Verbosity level. The default is 0.
+    pending : PendingInserts, optional
+        Registry of the works inserted by the other workers, checked before the elasticsearch search.
+    """
+    if similarity and es_handler:
+        queries = []
+        for scienti_reg in scienti_regs:
+            if not scienti_doi(scienti_reg):
+                entry = parse_scienti(
+                    scienti_reg, deepcopy(empty_work), verbose=verbose)
+                queries.append(similarity_query(entry))
+        es_handler = BatchSearch(es_handler, collection)
+        es_handler.prefetch(queries)
+    for scienti_reg in scienti_regs:
+        process_one(scienti_reg, db, collection, deepcopy(empty_work),
+                    es_handler, similarity, verbose, pending)
@@ -0,0 +1,111 @@
+from bson import ObjectId
+from time import time
+
+
+def parse_id(value):
+    """
+    Converts an _id given in the configuration file to a mongodb _id,
+    strings with 24 hexadecimal characters are taken as ObjectId.
+
+    Parameters
+    ----------
+    value : str | int | ObjectId | None
+        _id from the configuration.
+
+    Returns
+    -------
+    ObjectId | str | int | None
+        The _id ready to be used in a query.
+    """
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
+
+class Checkpoint:
+    """
+    Persisted progress marker of a plugin: the last _id processed of a source collection for a given task.
+    The markers are stored in the checkpoints collection, one document per key.
+    """
+
+    def __init__(self, db, key, start_id=None, end_id=None):
+        """
+        Parameters
+        ----------
+        db : pymongo.database.Database
+            Database where the checkpoints collection is stored (usually the kahi log database).
+        key : str
+            Identifier of the marker, ex: openalex_works/openalex.works/doi or wos_works/wos.works/all
+        start_id : optional
+            First _id of the range processed, part of the key so a marker is only resumed by a run over the same range.
+        end_id : optional
+            Last _id of the range processed, part of the key as start_id.
+        """
+        self.collection = db["checkpoints"]
+        if start_id is not None or end_id is not None:
+            key = f"{key}/{'' if start_id is None else start_id}-{'' if end_id is None else end_id}"
+        self.key = key
+
+    def load(self):
+        """
+        Returns the last _id processed or None if there is no marker.
+        """
+        reg = self.collection.find_one({"_id": self.key})
+        return reg["last_id"] if reg else None
+
+    def save(self, last_id, count=0):
+        """
+        Saves last_id as the last _id processed, count is added to the number of processed records.
+        """
+        self.collection.update_one(
+            {"_id": self.key},
+            {"$set": {"last_id": last_id, "time": int(time())}, "$inc": {"count": count}},
+            upsert=True)
+
+    def clear(self):
+        """
+        Removes the marker, the next run starts from the beginning.
+        """
+        self.collection.delete_one({"_id": self.key})
+
+
+def paginate(collection, query, projection=None, page_size=1000, last_id=None, start_id=None, end_id=None):
+    """
+    Generator over pages (lists) of the documents matching query, sorted by _id.
+
+    Every page is a new short query starting after the last _id of the previous one,
+    so no server cursor is kept open while the page is processed.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection to read.
+    query : dict
+        Filter for the collection.
+    projection : dict, optional
+        Fields to fetch.
+    page_size : int, optional
+        Number of documents per page. The default is 1000.
+    last_id : optional
+        Start after this _id (exclusive), used to resume from a checkpoint.
+    start_id : optional
+        Start from this _id (inclusive), ignored if last_id is given.
+    end_id : optional
+        Stop at this _id (inclusive).
+    """
+    while True:
+        bounds = {}
+        if last_id is not None:
+            bounds["$gt"] = last_id
+        elif start_id is not None:
+            bounds["$gte"] = start_id
+        if end_id is not None:
+            bounds["$lte"] = end_id
+        page_query = query
+        if bounds:
+            page_query = {"$and": [query, {"_id": bounds}]} if "_id" in query.keys() else dict(query, _id=bounds)
+        page = list(collection.find(page_query, projection).sort("_id", 1).limit(page_size))
+        if not page:
+            break
+        yield page
+        last_id = page[-1]["_id"]
@@ -0,0 +1,187 @@
+from hunahpu.Similarity import ColavSimilarity, parse_string
+from bson import ObjectId
+import json
+
+
+def search_body(es_handler, title, source, year, authors, volume, issue, page_start, page_end, parse_title=True, **kwargs):
+    """
+    Builds the elasticsearch query of Similarity.search_work (mohan) for a work.
+
+    Returns
+    -------
+    tuple
+        (body, paper) where paper has the normalized title, journal and year used to check the hits,
+        or None if the query can not be built (authors is not a list).
+    """
+    if not isinstance(title, str):
+        title = ""
+    title = es_handler.str_normilize(title)
+    if not isinstance(source, str):
+        source = ""
+    if isinstance(year, int):
+        year = str(year)
+    if not isinstance(authors, list):
+        return None
+    authors_list = [{"match": {"authors": {"query": es_handler.str_normilize(author), "operator": "AND"}}}
+                    for author in authors]
+    values = []
+    for value in [volume, issue, page_start, page_end]:
+        if isinstance(value, int):
+            value = str(value)
+        if not isinstance(value, str):
+            value = ""
+        values.append(value)
+    volume, issue, page_start, page_end = values
+    if parse_title:
+        title = parse_string(title)
+    body = {
+        "query": {
+            "bool": {
+                "should": [
+                    {"match": {"title": {"query": title, "operator": "OR"}}},
+                    {"match": {"source": {"query": source, "operator": "AND"}}},
+                    {"term": {"year": year}},
+                    {"term": {"volume": volume}},
+                    {"term": {"issue": issue}},
+                    {"term": {"page_start": page_start}},
+                    {"term": {"page_end": page_end}},
+                ],
+            }
+        },
+        "size": 20,
+    }
+    body["query"]["bool"]["should"].extend(authors_list)
+    return body, {"title": title, "journal": source, "year": year}
+
+
+def select_hits(res, paper, use_es_thold=False, es_thold=130, ratio_thold=90, partial_thold=92, low_thold=81, hits=1, **kwargs):
+    """
+    Selects the hits of an elasticsearch response as Similarity.search_work (mohan) does.
+
+    Returns
+    -------
+    dict | list | None
+        The similar hit, the list of hits over es_thold if use_es_thold is True, or None.
+    """
+    if res["hits"]["total"]["value"] == 0:
+        return None
+    if use_es_thold:
+        return [hit for hit in res["hits"]["hits"][0:hits] if hit["_score"] >= es_thold]
+    for hit in res["hits"]["hits"]:
+        paper2 = {"title": hit["_source"]["title"],
+                  "journal": hit["_source"]["source"] if "source" in hit["_source"].keys() else "",
+                  "year": hit["_source"]["year"] if "year" in hit["_source"].keys() else ""}
+        if "year" not in hit["_source"].keys():
+            print(hit)
+        if "source" not in hit["_source"].keys():
+            print(hit)
+        if ColavSimilarity(paper, paper2, ratio_thold=ratio_thold, partial_thold=partial_thold, low_thold=low_thold):
+            return hit
+    return None
+
+
+def query_key(query):
+    """
+    Returns a hashable key of the arguments of a search_work call.
+    """
+    return json.dumps(query, sort_keys=True, default=str)
+
+
+class BatchSearch:
+    """
+    Wrapper of the elasticsearch handler (mohan Similarity) that sends the similarity queries of a block of records
+    in a single _msearch request and resolves all the candidate works with a single $in query.
+
+    prefetch receives the arguments of the search_work calls of the block, after that search_work returns the
+    prefetched results and find_work the prefetched works (every work is returned once, later lookups of the
+    same _id read the collection because the work could have been updated). The queries not prefetched and the
+    other methods go to the wrapped handler.
+    """
+
+    def __init__(self, es_handler, collection):
+        """
+        Parameters
+        ----------
+        es_handler : Similarity
+            Elasticsearch handler, Mohan's Similarity class.
+        collection : pymongo.collection.Collection
+            Collection of works.
+        """
+        self.es_handler = es_handler
+        self.collection = collection
+        self.results = {}
+        self.works = {}
+
+    def __getattr__(self, name):
+        return getattr(self.es_handler, name)
+
+    def prefetch(self, queries):
+        """
+        Runs the queries (arguments of search_work, None values are ignored) with one _msearch request
+        and loads the works of all the hits with one query.
+
+        Parameters
+        ----------
+        queries : list
+            Arguments of the search_work calls.
+        """
+        if not hasattr(self.es_handler, "es"):
+            # local similarity index (LocalSimilarity), the queries are searched one by one
+            return
+        keys = []
+        papers = []
+        searches = []
+        for query in queries:
+            if not query:
+                continue
+            key = query_key(query)
+            if key in self.results or key in keys:
+                continue
+            built = search_body(self.es_handler, **query)
+            if built is None:
+                continue
+            keys.append(key)
+            papers.append((query, built[1]))
+            searches.extend([{"index": self.es_handler.es_index}, built[0]])
+        if not searches:
+            return
+        responses = self.es_handler.es.msearch(body=searches)["responses"]
+        ids = set()
+        for key, (query, paper), res in zip(keys, papers, responses):
+            if "error" in res:
+                # search_work will send this query alone
+                continue
+            result = select_hits(res, paper, **query)
+            self.results[key] = result
+            hits = result if isinstance(result, list) else [result] if result else []
+            ids.update(hit["_id"] for hit in hits if ObjectId.is_valid(hit["_id"]))
+        if ids:
+            for work in self.collection.find({"_id": {"$in": [ObjectId(_id) for _id in ids]}}):
+                self.works[str(work["_id"])] = work
+
+    def search_work(self, **kwargs):
+        """
+        Returns the prefetched result of the query or sends it to elasticsearch.
+        """
+        key = query_key(kwargs)
+        if key in self.results:
+            return self.results[key]
+        return self.es_handler.search_work(**kwargs)
+
+    def find_work(self, _id):
+        """
+        Returns the work with the given _id (hit _id), prefetched or read from the collection.
+        """
+        work = self.works.pop(str(_id), None)
+        if work is not None:
+            return work
+        return self.collection.find_one({"_id": ObjectId(_id)})
+
+
+def find_work(collection, es_handler, _id):
+    """
+    Returns the work of an elasticsearch hit, from the prefetched works if es_handler is a BatchSearch.
+    """
+    if isinstance(es_handler, BatchSearch):
+        return es_handler.find_work(_id)
+    return collection.find_one({"_id": ObjectId(_id)})
@@ -0,0 +1,402 @@
+from hunahpu.Similarity import ColavSimilarity, parse_string
+from unidecode import unidecode
+from threading import RLock, local
+from math import log
+import sqlite3
+import json
+import sys
+import re
+
+# BM25 parameters of the title, the same defaults of elasticsearch
+BM25_K1 = 1.2
+BM25_B = 0.75
+# score added for every field (source, year, volume, issue, page_start, page_end) equal to the query
+FIELD_BOOST = 2.0
+# score added for every author of the query found in the authors of the work
+AUTHOR_BOOST = 4.0
+
+
+def tokenize(text):
+    """
+    Splits a normalized string in word tokens (lowercase ascii letters and digits).
+    """
+    return re.findall(r"[a-z0-9]+", unidecode(str(text)).lower())
+
+
+def surnames(authors):
+    """
+    Returns the tokens of the author names with at least 3 characters, used to block the candidates.
+    """
+    tokens = set()
+    for author in authors:
+        tokens.update(token for token in tokenize(author) if len(token) > 2)
+    return tokens
+
+
+class LocalSimilarity:
+    """
+    In-process alternative to mohan's Similarity (elasticsearch) with the same insert_work, insert_bulk and
+    search_work methods, backed by an on-disk (sqlite) inverted index of the normalized title tokens.
+
+    search_work reads the candidates that share the rarest tokens of the title, blocked by year (year_window years
+    around the year of the query) or by the author surnames, scores them with BM25 over the title plus a fixed boost
+    for every other field equal to the query and selects the hits as mohan does. The results are deterministic
+    (ties are sorted by _id), but the scores are not the elasticsearch scores, es_thold must be calibrated for it.
+
+    The database is in WAL mode: the writes go through a single connection protected by a lock, the searches use
+    one read-only connection per thread, so the threads of the workers search concurrently (also while a write
+    is in progress), every search reads a consistent snapshot of the index.
+    """
+
+    def __init__(self, path, es_index="local", max_tokens=8, max_candidates=1000, year_window=1):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the sqlite file of the index, it is created if it does not exist.
+        es_index : str, optional
+            Name of the index, used in the _index of the bulk entries. The default is "local".
+        max_tokens : int, optional
+            Number of the rarest title tokens used to find the candidates. The default is 8.
+        max_candidates : int, optional
+            Maximum number of candidates scored by search. The default is 1000.
+        year_window : int, optional
+            Years around the year of the query accepted by the blocking. The default is 1.
+        """
+        self.path = path
+        self.es_index = es_index
+        self.max_tokens = max_tokens
+        self.max_candidates = max_candidates
+        self.year_window = year_window
+        self.lock = RLock()
+        self.conn = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_index()
+        # read connections, one per thread
+        self.local = local()
+        self.readers = []
+
+    def reader(self):
+        """
+        Returns the read connection of the current thread, it is created on the first call of every thread.
+        The connection is in autocommit mode, the searches open their own read transactions.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=300, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+    def str_normilize(self, word):
+        """
+        Normalize a string to lowercase and remove accents.
+
+        Parameters
+        ----------
+        word : str
+            string to be normalized.
+
+        Returns
+        -------
+        str
+            normalized string.
+        """
+        return unidecode(word).lower().strip().replace(".", "")
+
+    def ensure_index(self, recreate=False):
+        """
+        Creates the tables of the index.
+
+        Parameters
+        ----------
+        recreate : bool, optional
+            If True the index is emptied. The default is False.
+        """
+        with self.lock:
+            if recreate:
+                for table in ["works", "title_tokens", "author_tokens", "tokens", "meta"]:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS works (_id TEXT PRIMARY KEY, year INTEGER, length INTEGER, doc TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS title_tokens (token TEXT, _id TEXT, tf INTEGER, PRIMARY KEY (token, _id)) WITHOUT ROWID")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS author_tokens (token TEXT, _id TEXT, PRIMARY KEY (token, _id)) WITHOUT ROWID")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS title_tokens_id ON title_tokens (_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS author_tokens_id ON author_tokens (_id)")
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('count', 0), ('length', 0)")
+            self.conn.commit()
+
+    def delete_index(self, index_name=None):
+        """
+        Empties the index.
+        """
+        self.ensure_index(recreate=True)
+
+    def refresh_index(self):
+        """
+        Commits the pending changes, the index is always searchable after an insert.
+        """
+        with self.lock:
+            self.conn.commit()
+
+    def count(self):
+        """
+        Returns the number of works in the index.
+        """
+        return self.reader().execute("SELECT value FROM meta WHERE key='count'").fetchone()[0]
+
+    def ids(self):
+        """
+        Returns the _id of all the works in the index.
+        """
+        return [row[0] for row in self.reader().execute("SELECT _id FROM works")]
+
+    def _remove(self, _id):
+        """
+        Removes a work from the index tables, without commit.
+        """
+        row = self.conn.execute("SELECT length FROM works WHERE _id=?", (_id,)).fetchone()
+        if row is None:
+            return False
+        tokens = [token for token, in self.conn.execute("SELECT token FROM title_tokens WHERE _id=?", (_id,))]
+        self.conn.executemany("UPDATE tokens SET df=df-1 WHERE token=?", [(token,) for token in tokens])
+        self.conn.execute("DELETE FROM title_tokens WHERE _id=?", (_id,))
+        self.conn.execute("DELETE FROM author_tokens WHERE _id=?", (_id,))
+        self.conn.execute("DELETE FROM works WHERE _id=?", (_id,))
+        self.conn.execute("UPDATE meta SET value=value-1 WHERE key='count'")
+        self.conn.execute("UPDATE meta SET value=value-? WHERE key='length'", (row[0],))
+        return True
+
+    def _add(self, _id, work):
+        """
+        Adds (or replaces) a normalized work in the index tables, without commit.
+        """
+        _id = str(_id)
+        self._remove(_id)
+        tokens = tokenize(work.get("title", ""))
+        tf = {}
+        for token in tokens:
+            tf[token] = tf.get(token, 0) + 1
+        year = str(work.get("year", ""))
+        year = int(year) if year.isdigit() and year != "0" else None
+        self.conn.execute("INSERT INTO works VALUES (?, ?, ?, ?)",
+                          (_id, year, len(tokens), json.dumps(work, default=str)))
+        self.conn.executemany("INSERT INTO title_tokens VALUES (?, ?, ?)",
+                              [(token, _id, count) for token, count in tf.items()])
+        self.conn.executemany("INSERT INTO tokens VALUES (?, 1) ON CONFLICT (token) DO UPDATE SET df=df+1",
+                              [(token,) for token in tf])
+        authors = work.get("authors", [])
+        self.conn.executemany("INSERT OR IGNORE INTO author_tokens VALUES (?, ?)",
+                              [(token, _id) for token in surnames(authors if isinstance(authors, list) else [])])
+        self.conn.execute("UPDATE meta SET value=value+1 WHERE key='count'")
+        self.conn.execute("UPDATE meta SET value=value+? WHERE key='length'", (len(tokens),))
+
+    def delete_ids(self, ids):
+        """
+        Removes the works with the given _id from the index.
+
+        Returns
+        -------
+        int
+            Number of works removed.
+        """
+        with self.lock:
+            removed = sum(1 for _id in ids if self._remove(str(_id)))
+            self.conn.commit()
+        return removed
+
+    def insert_work(self, _id, work):
+        """
+        Insert a work into the index, with the same structure and normalization of Similarity.insert_work (mohan).
+
+        Parameters
+        ----------
+        _id : str
+            id of the work (ex: mongodb id as string)
+        work : dict
+            work to be inserted
+        """
+        for i in work.keys():
+            if i != "authors":
+                work[i] = self.str_normilize(str(work[i]))
+            else:
+                for i in range(len(work["authors"])):
+                    work["authors"][i] = self.str_normilize(work["authors"][i])
+        with self.lock:
+            self._add(_id, work)
+            self.conn.commit()
+        return {"_id": str(_id), "result": "created"}
+
+    def insert_bulk(self, entries, refresh=True):
+        """
+        Insert a bulk of works ({"_id", "_source"} entries) into the index in a single transaction,
+        with the normalization of Similarity.insert_bulk (mohan).
+
+        Parameters
+        ----------
+        entries : list
+            list of works to be inserted
+        """
+        for entry in entries:
+            for i in entry["_source"].keys():
+                if i == "authors":
+                    for j in range(len(entry["_source"][i])):
+                        entry["_source"]["authors"][j] = self.str_normilize(
+                            entry["_source"]["authors"][j])
+                if i in ["title", "source"]:
+                    entry["_source"][i] = self.str_normilize(
+                        entry["_source"][i])
+        with self.lock:
+            for entry in entries:
+                self._add(entry["_id"], entry["_source"])
+            self.conn.commit()
+        return len(entries), []
+
+    def candidates(self, conn, tokens, year, authors):
+        """
+        Returns the _id of the works that share the rarest tokens of the title, sorted by the number of tokens shared,
+        blocked by year (or without year) or by the author surnames when the query has them.
+        """
+        marks = ",".join("?" * len(tokens))
+        rare = [token for token, df in conn.execute(
+            f"SELECT token, df FROM tokens WHERE token IN ({marks}) AND df > 0 ORDER BY df, token", tokens)]
+        rare = rare[:self.max_tokens]
+        if not rare:
+            return []
+        query = f"SELECT t._id, COUNT(*) AS c FROM title_tokens t JOIN works w ON w._id = t._id WHERE t.token IN ({','.join('?' * len(rare))})"
+        params = list(rare)
+        blocks = []
+        if year is not None:
+            blocks.append("w.year IS NULL OR w.year BETWEEN ? AND ?")
+            params.extend([year - self.year_window, year + self.year_window])
+        names = sorted(surnames(authors))
+        if names:
+            blocks.append(f"t._id IN (SELECT _id FROM author_tokens WHERE token IN ({','.join('?' * len(names))}))")
+            params.extend(names)
+        if blocks:
+            query += " AND (" + " OR ".join(f"({block})" for block in blocks) + ")"
+        query += " GROUP BY t._id ORDER BY c DESC, t._id LIMIT ?"
+        params.append(self.max_candidates)
+        return [row[0] for row in conn.execute(query, params)]
+
+    def search(self, title, source, year, authors, volume, issue, page_start, page_end, size=20):
+        """
+        Returns the best size hits ({"_id", "_score", "_source"}) of a normalized query.
+        """
+        tokens = sorted(set(tokenize(title)))
+        if not tokens:
+            return []
+        year_value = int(year) if year.isdigit() and year != "0" else None
+        conn = self.reader()
+        # a read transaction, all the queries of the search see the same snapshot of the index
+        conn.execute("BEGIN")
+        try:
+            ids = self.candidates(conn, tokens, year_value, authors)
+            if not ids:
+                return []
+            count, length = [row[0] for row in conn.execute("SELECT value FROM meta ORDER BY key")]
+            marks = ",".join("?" * len(tokens))
+            df = dict(conn.execute(f"SELECT token, df FROM tokens WHERE token IN ({marks})", tokens))
+            tf = {}
+            docs = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                id_marks = ",".join("?" * len(chunk))
+                for token, _id, freq in conn.execute(
+                        f"SELECT token, _id, tf FROM title_tokens WHERE token IN ({marks}) AND _id IN ({id_marks})",
+                        tokens + chunk):
+                    tf.setdefault(_id, {})[token] = freq
+                for _id, doc_length, doc in conn.execute(
+                        f"SELECT _id, length, doc FROM works WHERE _id IN ({id_marks})", chunk):
+                    docs[_id] = (doc_length, json.loads(doc))
+        finally:
+            conn.execute("COMMIT")
+        avgdl = length / count if count else 1
+        query_fields = {"source": source, "year": year, "volume": volume, "issue": issue,
+                        "page_start": page_start, "page_end": page_end}
+        hits = []
+        for _id in ids:
+            doc_length, doc = docs[_id]
+            score = 0.0
+            for token, freq in tf.get(_id, {}).items():
+                idf = log(1 + (count - df[token] + 0.5) / (df[token] + 0.5))
+                score += idf * freq * (BM25_K1 + 1) / (freq + BM25_K1 * (1 - BM25_B + BM25_B * doc_length / avgdl))
+            for field, value in query_fields.items():
+                if value and str(doc.get(field, "")) == value:
+                    score += FIELD_BOOST
+            doc_authors = set(tokenize(" ".join(doc.get("authors", []))))
+            for author in authors:
+                author_tokens = tokenize(author)
+                if author_tokens and all(token in doc_authors for token in author_tokens):
+                    score += AUTHOR_BOOST
+            hits.append({"_index": self.es_index, "_id": _id, "_score": score, "_source": doc})
+        hits.sort(key=lambda hit: (-hit["_score"], hit["_id"]))
+        return hits[:size]
+
+    def search_work(self, title, source, year, authors, volume, issue, page_start, page_end,
+                    use_es_thold=False, es_thold=130, ratio_thold=90, partial_thold=92, low_thold=81, parse_title=True, hits=1):
+        """
+        Search the similar works of a paper, with the arguments and the results of Similarity.search_work (mohan).
+
+        Returns
+        -------
+        dict | list | None
+            The similar hit, the list of hits with score over es_thold if use_es_thold is True, or None.
+        """
+        if not isinstance(title, str):
+            title = ""
+        title = self.str_normilize(title)
+        if not isinstance(source, str):
+            source = ""
+        source = self.str_normilize(source)
+        if isinstance(year, int):
+            year = str(year)
+        if not isinstance(year, str):
+            year = ""
+        if not isinstance(authors, list):
+            print(
+                "Error, Authors should be list, if you dont have authors, please use []")
+            sys.exit(1)
+        authors = [self.str_normilize(author) for author in authors]
+        values = []
+        for value in [volume, issue, page_start, page_end]:
+            if isinstance(value, int):
+                value = str(value)
+            if not isinstance(value, str):
+                value = ""
+            values.append(value)
+        volume, issue, page_start, page_end = values
+        if parse_title:
+            title = parse_string(title)
+        found = self.search(title, source, year, authors, volume, issue, page_start, page_end)
+        if not found:
+            return None
+        if use_es_thold:
+            return [hit for hit in found[0:hits] if hit["_score"] >= es_thold]
+        paper1 = {"title": title, "journal": source, "year": year}
+        for hit in found:
+            paper2 = {"title": hit["_source"].get("title", ""),
+                      "journal": hit["_source"].get("source", ""),
+                      "year": hit["_source"].get("year", "")}
+            if ColavSimilarity(paper1, paper2, ratio_thold=ratio_thold, partial_thold=partial_thold, low_thold=low_thold):
+                return hit
+        return None
+
+    def close(self):
+        """
+        Closes the sqlite connections.
+        """
+        with self.lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+            self.conn.close()
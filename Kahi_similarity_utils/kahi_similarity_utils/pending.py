@@ -0,0 +1,104 @@
+from threading import Lock, Event
+from collections import OrderedDict
+from unidecode import unidecode
+import re
+
+
+class PendingInserts:
+    """
+    Registry of the works inserted by the worker threads of a run, keyed by normalized title and year.
+
+    A worker claims the key of a record before searching it in elasticsearch. If other worker holds the key,
+    it waits until that worker finishes: if it inserted a work the _id is returned (the records are the same work),
+    otherwise the key is claimed again. This catches the duplicates that elasticsearch can not see yet
+    (the other record is being inserted, or the hits were prefetched for a block of records).
+
+    The keys of the inserted works are kept until flush is called (when the inserts are visible in the index),
+    at most max_size of them, the oldest are dropped first.
+
+    The key is exact (normalized words of the title and the year), near-duplicates with slightly different
+    titles or years get different keys and are left to the similarity search.
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximum number of inserted works kept before flush. The default is 10000.
+        """
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = {}
+        # keys of the inserted works, oldest first
+        self.inserted = OrderedDict()
+
+    @staticmethod
+    def key(title, year):
+        """
+        Returns the key of a work: the words of the title (lowercase, without accents) and the year,
+        None if the title has no words.
+        """
+        words = re.findall(r"[a-z0-9]+", unidecode(str(title or "")).lower())
+        if not words:
+            return None
+        return " ".join(words) + "|" + str(year or "")
+
+    def claim(self, title, year):
+        """
+        Claims the key of a work, waiting while other worker holds it.
+
+        Returns
+        -------
+        tuple
+            (True, None) if the key was claimed, done must be called after processing the record.
+            (False, _id) if other worker inserted the work with the same key.
+        """
+        key = self.key(title, year)
+        if key is None:
+            return True, None
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.entries[key] = {"event": Event(), "_id": None}
+                    return True, None
+            entry["event"].wait()
+            if entry["_id"] is not None:
+                return False, entry["_id"]
+
+    def done(self, title, year, _id=None):
+        """
+        Releases a claimed key, with the _id of the work if it was inserted.
+        """
+        key = self.key(title, year)
+        if key is None:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            if _id is None:
+                del self.entries[key]
+            else:
+                entry["_id"] = _id
+                self.inserted[key] = None
+                while len(self.inserted) > self.max_size:
+                    del self.entries[self.inserted.popitem(last=False)[0]]
+            entry["event"].set()
+
+    def flush(self):
+        """
+        Drops the keys of the inserted works, the claims in progress are kept.
+
+        Returns
+        -------
+        int
+            Number of keys dropped.
+        """
+        with self.lock:
+            count = len(self.inserted)
+            for key in self.inserted:
+                del self.entries[key]
+            self.inserted.clear()
+        return count
@@ -0,0 +1,138 @@
+from rapidfuzz import fuzz
+from rapidfuzz.process import cdist
+from rapidfuzz.utils import default_process
+from unidecode import unidecode
+import numpy as np
+
+
+def str_normilize(word):
+    """
+    Normalize a string to lowercase and remove accents.
+
+    Parameters
+    ----------
+    word : str
+        string to be normalized.
+
+    Returns
+    -------
+    str
+        normalized string.
+    """
+    return unidecode(word).lower().strip().replace(".", "")
+
+
+def score_matrix(queries, choices, scorer=fuzz.ratio, processor=None):
+    """
+    Scores every query against every choice in a single call, rounded to integers as thefuzz does.
+
+    Parameters
+    ----------
+    queries : list
+        strings to compare.
+    choices : list
+        strings to compare with.
+    scorer : callable, optional
+        rapidfuzz scorer. The default is fuzz.ratio.
+    processor : callable, optional
+        function applied to the queries and choices before scoring. The default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        int matrix of shape (len(queries), len(choices)).
+    """
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)), dtype=int)
+    scores = cdist(queries, choices, scorer=scorer, processor=processor, dtype=np.float64)
+    return np.rint(scores).astype(int)
+
+
+def score_hits(title_work, authors, hits):
+    """
+    Scores the elasticsearch hits of a work: fuzz.ratio of the normalized titles and the best
+    fuzz.partial_ratio of the first author against the authors of every hit (the scores of
+    thefuzz's fuzz.ratio and process.extract). Every string is normalized once.
+
+    Parameters
+    ----------
+    title_work : str
+        title of the work.
+    authors : list
+        authors of the work, only the first one is compared.
+    hits : list
+        elasticsearch hits with title and authors in _source.
+
+    Returns
+    -------
+    tuple
+        (title_scores, author_scores) int arrays with the scores of every hit,
+        -1 if the hit has no title or there is no author to compare.
+    """
+    title_scores = np.full(len(hits), -1)
+    author_scores = np.full(len(hits), -1)
+    with_title = [i for i, hit in enumerate(hits) if hit["_source"]["title"]]
+    if with_title:
+        title_scores[with_title] = score_matrix(
+            [str_normilize(title_work)], [str_normilize(hits[i]["_source"]["title"]) for i in with_title])[0]
+    if authors and authors[0] != "":
+        owners = []
+        names = []
+        for i, hit in enumerate(hits):
+            for author in hit["_source"]["authors"]:
+                owners.append(i)
+                names.append(str_normilize(author))
+        if names:
+            scores = score_matrix([str_normilize(authors[0])], names,
+                                  scorer=fuzz.partial_ratio, processor=default_process)[0]
+            np.maximum.at(author_scores, owners, scores)
+    return title_scores, author_scores
+
+
+def best_match(title_work, authors, hits, thresholds):
+    """
+    Returns the first hit (in the order of elasticsearch) similar to the work: the title score must be
+    at least paper_thd_low if the author is found in the hit (author score at least author_thd),
+    otherwise at least paper_thd_high.
+
+    Parameters
+    ----------
+    title_work : str
+        title of the work.
+    authors : list
+        authors of the work.
+    hits : list
+        elasticsearch hits.
+    thresholds : dict
+        thresholds to consider a work as similar (author_thd, paper_thd_low, paper_thd_high).
+
+    Returns
+    -------
+    tuple
+        (hit, title_score, author_score), (None, None, None) if no hit is similar.
+    """
+    if not hits:
+        return None, None, None
+    title_scores, author_scores = score_hits(title_work, authors, hits)
+    for hit, title_score, author_score in zip(hits, title_scores, author_scores):
+        if title_score < 0:
+            continue
+        if author_score >= thresholds["author_thd"]:
+            threshold = thresholds["paper_thd_low"]
+        else:
+            threshold = thresholds["paper_thd_high"]
+        if title_score >= threshold:
+            return hit, int(title_score), int(author_score)
+    return None, None, None
+
+
+def check_work(title_work, authors, response, thresholds):
+    """
+    Check if the title and authors of the work are similar to the title and authors of the elasticsearch work.
+
+    Returns
+    -------
+    bool
+        True if the works are similar, False otherwise.
+    """
+    return best_match(title_work, authors, [response], thresholds)[0] is not None
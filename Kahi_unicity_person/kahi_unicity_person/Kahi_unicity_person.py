@@ -1,7 +1,8 @@
-from kahi_impactu_utils.Utils import compare_author
+from kahi_impactu_utils.Utils import compare_author, split_names, normalize_name
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
 from kahi.KahiBase import KahiBase
+from kahi_unicity_person.disjoint_set import DisjointSet
 from bson import ObjectId
 from time import time
 import copy
@@ -124,6 +125,11 @@ class Kahi_unicity_person(KahiBase):
             The target document where information will be merged.
         collection : Collection
             The MongoDB collection to be used.
+
+        Returns:
+        ----------
+        list
+            The _ids of the documents merged into the target document.
         """
         target_id = target_doc["_id"]
         other_docs = []
@@ -165,6 +171,7 @@ class Kahi_unicity_person(KahiBase):
                     "Error: The target document and the other document have the same id")
         # Update the target document in the collection
         self.collection.update_one({"_id": target_id}, {"$set": target_doc})
+        return [other_doc["_id"] for other_doc in other_docs]
 
     # Find the target document based on the 'provenance' of 'external_ids'
     def find_target_doc(self, author_docs, _id):
@@ -239,11 +246,115 @@ class Kahi_unicity_person(KahiBase):
         self.collection_merged_sets.insert_one(
             {"source": _id, _id: reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": [aid["_id"] for aid in author_docs]})
 
-    # Function to compare authors based on DOI
+    # Functions to generate candidate pairs of authors
+
+    def blocking_keys(self, author):
+        """
+        Computes the blocking keys of an author, two authors are only compared if they share at least one key.
+
+        compare_author can match authors by external ids, by full name and by last name together with
+        first names or initials, so the keys are:
+        - every external id
+        - the normalized full name
+        - every normalized last name combined with every initial (initials and first letters of the names),
+          all the last names are used because split_names_fix can move names between first and last names.
+        - every last name, and every first name of the authors without first_names/last_names, because
+          compare_author accepts the pair when split_names_fix finds a last name of one author in the
+          first names split from the full name of the other one.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        author : dict
+            Author document with first_names, last_names, initials, full_name and external_ids.
+
+        Returns:
+        ----------
+        set
+            The blocking keys of the author.
+        """
+        keys = set()
+        for ext in author.get("external_ids", []):
+            keys.add(("id", ext["source"], str(ext["id"])))
+        full_name = author.get("full_name") or ""
+        if full_name:
+            keys.add(("full_name", normalize_name(full_name)))
+        first_names = author.get("first_names") or []
+        last_names = author.get("last_names") or []
+        initials = author.get("initials") or ""
+        if not first_names or not last_names:
+            names = split_names(full_name)
+            first_names = names["first_names"]
+            last_names = names["last_names"]
+            initials = names["initials"]
+            for name in first_names:
+                keys.add(("token", name))
+        for name in last_names:
+            keys.add(("token", name))
+        letters = set(normalize_name(initials).replace(".", "").replace(" ", ""))
+        for name in first_names + last_names:
+            name = normalize_name(name)
+            if name:
+                letters.add(name[0])
+        for last_name in last_names:
+            last_name = normalize_name(last_name)
+            if not last_name:
+                continue
+            for letter in letters:
+                keys.add(("name", last_name, letter))
+        return keys
+
+    def candidate_pairs(self, author_docs, authors_filter=True):
+        """
+        Generates the ordered pairs (author, other_author) of documents sharing at least one blocking key,
+        every pair is generated once.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        author_docs : list
+            Author documents of a DOI group.
+        authors_filter : bool
+            If True, the first author of the pair must be updated by staff, scienti, minciencias or scholar.
 
-    def doi_unicity(self, reg, jobs, verbose=0):
+        Returns:
+        ----------
+        generator
+            Pairs of author documents.
+        """
+        blocks = {}
+        for author in author_docs:
+            for key in self.blocking_keys(author):
+                blocks.setdefault(key, []).append(author)
+        seen = set()
+        for block in blocks.values():
+            if len(block) < 2:
+                continue
+            for author in block:
+                # Filter authors based on the source of the related_works
+                if authors_filter:
+                    source_match = any(
+                        source in ['staff', 'scienti', 'minciencias', "scholar"] for source in [updt["source"] for updt in author["updated"]]
+                    )
+                    if not source_match:
+                        # Skip the author if the source of the related_works is not in ['staff', 'scienti', 'minciencias','scholar']
+                        continue
+                for other_author in block:
+                    if author["_id"] == other_author["_id"]:
+                        continue
+                    pair = (author["_id"], other_author["_id"])
+                    if pair in seen:
+                        continue
+                    seen.add(pair)
+                    yield author, other_author
+
+    # Functions to compare authors based on DOI
+
+    def doi_matches(self, reg, verbose=0):
         """
-        Checks unicity by DOI among a group of author documents.
+        Finds the pairs of matching authors in a DOI group, the database is only read.
 
         Parameters:
         ----------
@@ -251,63 +362,60 @@ class Kahi_unicity_person(KahiBase):
             The object instance.
         reg : dict
             A dictionary containing a registry of aggregated author documents by DOI.
-        collection : Collection
-            The MongoDB collection to be used.
+
+        Returns:
+        ----------
+        list
+            Pairs of person _ids that have to be merged.
         """
         # Fetch author documents from the database
         author_ids = reg["authors"]
         # Store the number of authors
         n_authors = len(author_ids)
-        # Fetch the author documents from the database
-        author_docs = self.collection.find({"_id": {"$in": author_ids}}, {
-            "first_names": 1, "last_names": 1, "full_name": 1, "updated": 1, "external_ids": 1, "initials": 1})
+        # Fetch the author documents from the database, once per DOI group
+        author_docs = list(self.collection.find({"_id": {"$in": author_ids}}, {
+            "first_names": 1, "last_names": 1, "full_name": 1, "updated": 1, "external_ids": 1, "initials": 1}))
 
         if not author_docs:
-            return
+            return []
 
-        # Set the authors_filter flag to True
-        authors_filter = True
+        matches = []
+        # only the pairs sharing a blocking key are compared
+        for author, other_author in self.candidate_pairs(author_docs, authors_filter=True):
+            # Perform the author comparison
+            if compare_author(author, other_author, n_authors):
+                matches.append((author["_id"], other_author["_id"]))
+        return matches
 
-        found = []  # we will create a list of sets of authors, every set in the list have to be merge
-        for author in author_docs:
-            # Filter authors based on the source of the related_works
-            if authors_filter:
-                source_match = any(
-                    source in ['staff', 'scienti', 'minciencias', "scholar"] for source in [updt["source"] for updt in author["updated"]]
-                )
-                if not source_match:
-                    # Skip the author if the source of the related_works is not in ['staff', 'scienti', 'minciencias','scholar']
-                    continue
+    def merge_component(self, author_found, dois, verbose=0):
+        """
+        Merges a connected component of matched authors into its target document.
 
-            for other_author in self.collection.find({"_id": {"$in": author_ids}}, {
-                    "first_names": 1, "last_names": 1, "full_name": 1, "updated": 1, "external_ids": 1, "initials": 1}):
-                if author["_id"] == other_author["_id"]:
-                    continue
-                # Perform the author comparison
-                if compare_author(author, other_author, n_authors):
-                    if not found:
-                        found.append(set([author["_id"], other_author["_id"]]))
-                    else:
-                        for i, author_set in enumerate(found):
-                            # if the author is in the current set then add it to the set
-                            if author_set.intersection([author["_id"], other_author["_id"]]):
-                                found[i] = author_set.union(
-                                    [author["_id"], other_author["_id"]])
-                            else:
-                                found.append(
-                                    set([author["_id"], other_author["_id"]]))
-        for author_found in found:
-            author_found = list(author_found)
-            author_docs_ = list(self.collection.find(
-                {"_id": {"$in": author_found}}))
-            if not author_docs_:
-                continue
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        author_found : list
+            The person _ids of the component.
+        dois : list
+            The DOIs where the authors of the component were matched.
+        """
+        author_docs_ = list(self.collection.find(
+            {"_id": {"$in": author_found}}))
+        if not author_docs_:
+            return
 
-            target_doc = self.find_target_doc(author_docs_, "doi")
-            if target_doc:
-                self.merge_documents(author_docs_, target_doc)
-            self.collection_merged_sets.insert_one(
-                {"source": "doi", "doi": reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": author_found})
+        target_doc = self.find_target_doc(author_docs_, "doi")
+        if not target_doc:
+            return
+        merged = self.merge_documents(author_docs_, target_doc)
+        if not merged:
+            return
+        # doi keeps the single DOI string of the previous format, dois has all the DOIs of the component
+        self.collection_merged_sets.insert_one(
+            {"source": "doi", "doi": dois[0] if dois else None, "dois": dois,
+             "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]},
+             "set": [target_doc["_id"]] + merged})
 
     def process_authors(self):
         """
@@ -374,20 +482,38 @@ class Kahi_unicity_person(KahiBase):
             print("INFO: DOI unicity for groups of authors is started!")
             print("INFO: Number of groups of authors to process: {}".format(
                 len(authors_cursor)))
-            print("INFO: Number of jobs set to 1, this can not be parallelized!")
-            # this can not be parallelized, because we need to merge the authors and delete the documents
-            # different dois can have the same authors and this can produce that the target author in one doi can not be the target in another doi
-            # then all the authors similar can be deleted
-            # at the moment jobs were hardcode to 1
-            Parallel(
-                n_jobs=1,
+            # the comparisons only read the database, so the DOI groups are processed in parallel
+            matches = Parallel(
+                n_jobs=self.n_jobs,
                 verbose=self.verbose,
                 backend="threading")(
-                delayed(self.doi_unicity)(
+                delayed(self.doi_matches)(
                     reg,
                     self.verbose
                 ) for reg in authors_cursor
             )
+            # different dois can have the same authors, the matches of all the dois are joined
+            # in connected components and every component is merged once into a single target
+            components = DisjointSet()
+            component_dois = {}
+            for reg, pairs in zip(authors_cursor, matches):
+                for author_id, other_author_id in pairs:
+                    components.union(author_id, other_author_id)
+                    component_dois.setdefault(author_id, set()).add(reg["_id"])
+            groups = list(components.groups().values())
+            print("INFO: Number of sets of authors to merge: {}".format(
+                len(groups)))
+            # the components are disjoint, then the merges do not conflict
+            Parallel(
+                n_jobs=self.n_jobs,
+                verbose=self.verbose,
+                backend="threading")(
+                delayed(self.merge_component)(
+                    group,
+                    sorted(set().union(*[component_dois.get(aid, set()) for aid in group])),
+                    self.verbose
+                ) for group in groups
+            )
             if self.verbose > 1:
                 print("DOI unicity for {} groups of authors is done!".format(
                     len(authors_cursor)))
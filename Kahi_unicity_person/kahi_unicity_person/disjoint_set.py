@@ -0,0 +1,59 @@
+class DisjointSet:
+    """
+    Union-find structure over hashable items (person _ids), with path compression and union by size.
+
+    It is used to join the pairs of matched authors found in every DOI group into connected components,
+    every component is a set of person documents that has to be merged into a single one.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def add(self, item):
+        """
+        Adds item as a single element set, if it is not already in the structure.
+        """
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        """
+        Returns the representative of the set of item, item is added if it is not in the structure.
+        """
+        self.add(item)
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item1, item2):
+        """
+        Joins the sets of item1 and item2, returns the representative of the joined set.
+        """
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return root1
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+        return root1
+
+    def groups(self):
+        """
+        Returns the sets of the structure.
+
+        Returns
+        -------
+        dict
+            {representative: list of items}
+        """
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
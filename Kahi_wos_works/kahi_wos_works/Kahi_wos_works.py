@@ -5,6 +5,7 @@ from joblib import Parallel, delayed
 from thefuzz import fuzz
 
 from kahi_impactu_utils.Utils import doi_processor, lang_poll
+from kahi_similarity_utils.checkpoint import Checkpoint, paginate, parse_id
 
 
 def parse_wos(reg, empty_work, verbose=0):
@@ -434,25 +435,53 @@ class Kahi_wos_works(KahiBase):
         self.verbose = config["wos_works"]["verbose"] if "verbose" in config["wos_works"].keys(
         ) else 0
 
+        # checkpoint: saves the last processed _id in the checkpoints collection of the log database to resume the run
+        self.checkpoint = config["wos_works"]["checkpoint"] if "checkpoint" in config["wos_works"].keys(
+        ) else False
+        self.checkpoint_db = self.client[config["log_database"]] if "log_database" in config.keys() else self.db
+        self.page_size = config["wos_works"]["page_size"] if "page_size" in config["wos_works"].keys(
+        ) else 1000
+        # optional bounded _id range (both inclusive)
+        self.start_id = parse_id(config["wos_works"]["start_id"]) if "start_id" in config["wos_works"].keys(
+        ) else None
+        self.end_id = parse_id(config["wos_works"]["end_id"]) if "end_id" in config["wos_works"].keys(
+        ) else None
+
     def process_wos(self):
-        paper_list = list(self.wos_collection.find())
+        checkpoint = None
+        last_id = None
+        if self.checkpoint:
+            checkpoint = Checkpoint(
+                self.checkpoint_db, f"wos_works/{self.wos_db.name}.{self.wos_collection.name}/all",
+                start_id=self.start_id, end_id=self.end_id)
+            last_id = checkpoint.load()
+            if last_id is not None:
+                print(f"INFO: resuming after _id {last_id}")
+        pages = paginate(self.wos_collection, {}, page_size=self.page_size,
+                         last_id=last_id, start_id=self.start_id, end_id=self.end_id)
 
         with MongoClient(self.mongodb_url) as client:
             db = client[self.config["database_name"]]
             collection = db["works"]
 
-            Parallel(
-                n_jobs=self.n_jobs,
-                verbose=self.verbose,
-                backend="threading")(
-                delayed(process_one)(
-                    paper,
-                    db,
-                    collection,
-                    self.empty_work(),
-                    verbose=self.verbose
-                ) for paper in paper_list
-            )
+            with Parallel(
+                    n_jobs=self.n_jobs,
+                    verbose=self.verbose,
+                    backend="threading") as parallel:
+                for page in pages:
+                    parallel(
+                        delayed(process_one)(
+                            paper,
+                            db,
+                            collection,
+                            self.empty_work(),
+                            verbose=self.verbose
+                        ) for paper in page
+                    )
+                    if checkpoint:
+                        checkpoint.save(page[-1]["_id"], len(page))
+            if checkpoint:
+                checkpoint.clear()
 
     def run(self):
         self.process_wos()
@@ -85,6 +85,7 @@ def main():
             'joblib',
             'thefuzz',
             'kahi_impactu_utils',
+            'Kahi_similarity_utils'
         ],
     )
 